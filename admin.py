@@ -0,0 +1,13 @@
+import os
+import secrets
+
+from fastapi import Header, HTTPException
+
+
+def require_admin(x_admin_token: str = Header(default="")):
+    # Admin/debug endpoints are disabled unless ADMIN_TOKEN is configured
+    token = os.getenv("ADMIN_TOKEN")
+    if not token:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled.")
+    if not secrets.compare_digest(x_admin_token.encode(), token.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token.")
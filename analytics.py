@@ -0,0 +1,206 @@
+import os
+import time
+from array import array
+from datetime import datetime, timezone
+
+from consensus import normalize_label
+
+# Live distributions of what we answer. Every analysis is reduced to a few
+# enum codes and counted in per-hour, per-model rows of one flat array, so
+# recording is O(1), queries read at most ANALYTICS_RETENTION_HOURS rows
+# per model whatever the traffic, and memory is fixed at start-up. Counts
+# are per worker process, like /api/metrics.
+ANALYTICS_RETENTION_HOURS = int(os.getenv("ANALYTICS_RETENTION_HOURS", "168"))
+# Most recent analyses kept individually, for spot checks
+ANALYTICS_RING_SIZE = int(os.getenv("ANALYTICS_RING_SIZE", "4096"))
+
+# Code 0 of every vocabulary is "Other": labels outside it, or models seen
+# after the table is full
+ARCHETYPES = (
+    "Other", "Dramatic", "Soft Dramatic", "Flamboyant Natural", "Natural", "Soft Natural",
+    "Dramatic Classic", "Classic", "Soft Classic", "Flamboyant Gamine", "Gamine", "Soft Gamine",
+    "Theatrical Romantic", "Romantic",
+)
+SEASONS = (
+    "Other", "Bright Spring", "True Spring", "Light Spring", "Light Summer", "True Summer",
+    "Soft Summer", "Soft Autumn", "True Autumn", "Dark Autumn", "Dark Winter", "True Winter",
+    "Bright Winter",
+)
+# Other names for the same twelve seasons
+SEASON_ALIASES = {
+    "Clear Spring": "Bright Spring", "Warm Spring": "True Spring", "Cool Summer": "True Summer",
+    "Warm Autumn": "True Autumn", "Deep Autumn": "Dark Autumn", "Deep Winter": "Dark Winter",
+    "Cool Winter": "True Winter", "Clear Winter": "Bright Winter",
+}
+OUTCOMES = ("analyzed", "cache_hit", "fallback")
+MAX_MODELS = 8
+
+_ARCHETYPE_CODES = {label: code for code, label in enumerate(ARCHETYPES)}
+_SEASON_CODES = {label: code for code, label in enumerate(SEASONS)}
+# One counter row per (hour, model): outcomes, then archetypes, then seasons
+_ARCHETYPE_BASE = len(OUTCOMES)
+_SEASON_BASE = _ARCHETYPE_BASE + len(ARCHETYPES)
+_ROW = _SEASON_BASE + len(SEASONS)
+
+
+def archetype_code(label):
+    return _ARCHETYPE_CODES.get(normalize_label(label), 0)
+
+
+def season_code(label):
+    label = normalize_label(label)
+    return _SEASON_CODES.get(SEASON_ALIASES.get(label, label), 0)
+
+
+def _pack(outcome, model, archetype, season):
+    # 2 + 3 + 5 + 5 bits in one unsigned short
+    return outcome << 13 | model << 10 | archetype << 5 | season
+
+
+def _unpack(packed):
+    return packed >> 13, packed >> 10 & 0x7, packed >> 5 & 0x1F, packed & 0x1F
+
+
+def _hour_iso(hour):
+    return datetime.fromtimestamp(hour * 3600, timezone.utc).strftime("%Y-%m-%dT%H:00Z")
+
+
+class Analytics:
+    def __init__(self, retention_hours=ANALYTICS_RETENTION_HOURS, ring_size=ANALYTICS_RING_SIZE):
+        self.retention = retention_hours
+        self.models = ["other"]
+        # Hour (since the epoch) each slot currently counts; -1 = never used
+        self.slot_hours = array("q", [-1]) * retention_hours
+        self.counts = array("I", bytes(4 * retention_hours * MAX_MODELS * _ROW))
+        self.ring_times = array("I", bytes(4 * ring_size))
+        self.ring_codes = array("H", bytes(2 * ring_size))
+        self.ring_next = 0
+        self.ring_len = 0
+
+    def _model_code(self, model):
+        try:
+            return self.models.index(model)
+        except ValueError:
+            if len(self.models) == MAX_MODELS:
+                return 0
+            self.models.append(model)
+            return len(self.models) - 1
+
+    def _slot(self, hour):
+        # The slot last used retention_hours ago is cleared before reuse
+        slot = hour % self.retention
+        if self.slot_hours[slot] != hour:
+            start = slot * MAX_MODELS * _ROW
+            self.counts[start:start + MAX_MODELS * _ROW] = array("I", bytes(4 * MAX_MODELS * _ROW))
+            self.slot_hours[slot] = hour
+        return slot
+
+    def record(self, model, outcome, result=None, now=None):
+        """Count one answer; ``outcome`` is one of OUTCOMES. Labels of
+        fallback answers are not counted, since the model did not give them."""
+        now = time.time() if now is None else now
+        outcome_code = OUTCOMES.index(outcome)
+        model_code = self._model_code(model)
+        archetype = season = 0
+        row = (self._slot(int(now // 3600)) * MAX_MODELS + model_code) * _ROW
+        self.counts[row + outcome_code] += 1
+        if result is not None and outcome != "fallback":
+            archetype = archetype_code(result.get("kibbe_archetype", ""))
+            season = season_code(result.get("color_season", ""))
+            self.counts[row + _ARCHETYPE_BASE + archetype] += 1
+            self.counts[row + _SEASON_BASE + season] += 1
+        self.ring_times[self.ring_next] = int(now)
+        self.ring_codes[self.ring_next] = _pack(outcome_code, model_code, archetype, season)
+        self.ring_next = (self.ring_next + 1) % len(self.ring_codes)
+        self.ring_len = min(self.ring_len + 1, len(self.ring_codes))
+
+    def _row_counts(self, row):
+        outcomes = dict(zip(OUTCOMES, self.counts[row:row + _ARCHETYPE_BASE]))
+        archetypes = self.counts[row + _ARCHETYPE_BASE:row + _SEASON_BASE]
+        seasons = self.counts[row + _SEASON_BASE:row + _ROW]
+        return outcomes, archetypes, seasons
+
+    def query(self, hours=24, model=None, now=None):
+        """Distributions over the last ``hours`` hours (the current one
+        included), in total and per hour, optionally for one model."""
+        now = time.time() if now is None else now
+        current = int(now // 3600)
+        hours = max(1, min(hours, self.retention))
+        models = [m for m in range(len(self.models)) if model is None or self.models[m] == model]
+        total_outcomes = dict.fromkeys(OUTCOMES, 0)
+        total_archetypes = [0] * len(ARCHETYPES)
+        total_seasons = [0] * len(SEASONS)
+        by_hour = []
+        for hour in range(current - hours + 1, current + 1):
+            slot = hour % self.retention
+            if self.slot_hours[slot] != hour:
+                continue
+            outcomes = dict.fromkeys(OUTCOMES, 0)
+            archetypes = [0] * len(ARCHETYPES)
+            seasons = [0] * len(SEASONS)
+            for m in models:
+                row_outcomes, row_archetypes, row_seasons = self._row_counts((slot * MAX_MODELS + m) * _ROW)
+                for name, count in row_outcomes.items():
+                    outcomes[name] += count
+                for code, count in enumerate(row_archetypes):
+                    archetypes[code] += count
+                for code, count in enumerate(row_seasons):
+                    seasons[code] += count
+            if not any(outcomes.values()):
+                continue
+            for name, count in outcomes.items():
+                total_outcomes[name] += count
+            for code, count in enumerate(archetypes):
+                total_archetypes[code] += count
+            for code, count in enumerate(seasons):
+                total_seasons[code] += count
+            by_hour.append({
+                "hour": _hour_iso(hour),
+                **outcomes,
+                "kibbe_archetype": _nonzero(ARCHETYPES, archetypes),
+                "color_season": _nonzero(SEASONS, seasons),
+            })
+        answered = sum(total_outcomes.values())
+        return {
+            "since": _hour_iso(current - hours + 1),
+            "hours": hours,
+            "model": model,
+            "models": self.models[1:],
+            **total_outcomes,
+            "fallback_rate": round(total_outcomes["fallback"] / answered, 4) if answered else 0.0,
+            "kibbe_archetype": _nonzero(ARCHETYPES, total_archetypes),
+            "color_season": _nonzero(SEASONS, total_seasons),
+            "by_hour": by_hour,
+        }
+
+    def recent(self, limit=20):
+        """The last ``limit`` answers, newest first, decoded from the ring."""
+        entries = []
+        for i in range(1, min(limit, self.ring_len) + 1):
+            index = (self.ring_next - i) % len(self.ring_codes)
+            outcome, model, archetype, season = _unpack(self.ring_codes[index])
+            entries.append({
+                "time": datetime.fromtimestamp(self.ring_times[index], timezone.utc).isoformat(),
+                "outcome": OUTCOMES[outcome],
+                "model": self.models[model],
+                "kibbe_archetype": ARCHETYPES[archetype] if outcome != 2 else None,
+                "color_season": SEASONS[season] if outcome != 2 else None,
+            })
+        return entries
+
+
+def _nonzero(labels, counts):
+    # Most frequent first
+    return dict(sorted(
+        ((label, count) for label, count in zip(labels, counts) if count), key=lambda item: -item[1]
+    ))
+
+
+_analytics = None
+
+
+def get_analytics():
+    global _analytics
+    if _analytics is None:
+        _analytics = Analytics()
+    return _analytics
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""Bulk, non-interactive analysis through the Message Batches API.
+
+Images are queued in a local SQLite state file, submitted in large batches
+and polled until the batches end. Results land in the same result store
+(and AnalysisResult schema) as the interactive endpoint. Every step is
+persisted, so an interrupted run picks up where it left off:
+
+    python batch_mode.py run photos/            # enqueue, submit, wait
+    python batch_mode.py poll --wait            # resume polling only
+    python batch_mode.py status
+
+Items are marked as submitting before their batch is created. If a run dies
+before recording the batch, the next run looks for it among the account's
+recent batches instead of paying for the same requests twice.
+
+Point ANTHROPIC_BASE_URL at upstream_stub.py to exercise this locally.
+"""
+import argparse
+import base64
+import json
+import mimetypes
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+import httpx
+
+from credential_pool import configured_keys
+from image_probe import ProbeError, check_limits, probe
+from main import MODEL, SYSTEM_PROMPT, build_messages
+from result_store import content_hash, get_store, is_valid_result
+from transcode import PASSTHROUGH_FORMATS, decodable_formats, transcode_sync
+from usage import get_ledger
+
+BATCH_STATE_PATH = os.getenv("BATCH_STATE_PATH", "batch_state.db")
+API_BASE_URL = os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com").rstrip("/")
+API_VERSION = "2023-06-01"
+
+# Upstream caps a batch at 100,000 requests / 256 MB; stay under both
+MAX_BATCH_REQUESTS = 10000
+MAX_BATCH_BYTES = 200 * 1024 * 1024
+
+# Allowance for clock drift between here and the upstream when looking for
+# a batch created by an interrupted run
+CLOCK_SKEW_SECONDS = 300
+
+IMAGE_TYPES = {"image/jpeg", "image/png", "image/webp", "image/avif", "image/heic", "image/heif"}
+
+
+class BatchState:
+    def __init__(self, path=BATCH_STATE_PATH):
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS items (
+                sha256 TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                media_type TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                batch_id TEXT,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS items_status ON items (status);
+            CREATE TABLE IF NOT EXISTS batches (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                request_count INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            );
+            """
+        )
+        # When items were last handed to a batch create call; only read for
+        # items left 'submitting' by an interrupted run
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(items)")}
+        if "submitted_at" not in columns:
+            self._db.execute("ALTER TABLE items ADD COLUMN submitted_at REAL")
+
+    def enqueue(self, sha256, path, media_type):
+        cur = self._db.execute(
+            "INSERT OR IGNORE INTO items (sha256, path, media_type) VALUES (?, ?, ?)",
+            (sha256, path, media_type),
+        )
+        return cur.rowcount == 1
+
+    def queued(self):
+        return self._db.execute(
+            "SELECT sha256, path, media_type FROM items WHERE status = 'queued'"
+        ).fetchall()
+
+    def mark_submitting(self, hashes):
+        self._db.executemany(
+            "UPDATE items SET status = 'submitting', submitted_at = ? WHERE sha256 = ?",
+            [(time.time(), h) for h in hashes],
+        )
+
+    def submitting(self):
+        """Hashes left 'submitting' and the earliest time they were sent."""
+        rows = self._db.execute(
+            "SELECT sha256, submitted_at FROM items WHERE status = 'submitting'"
+        ).fetchall()
+        return [row[0] for row in rows], min((row[1] for row in rows), default=None)
+
+    def requeue_submitting(self):
+        self._db.execute("UPDATE items SET status = 'queued' WHERE status = 'submitting'")
+
+    def batch_ids(self):
+        return {row[0] for row in self._db.execute("SELECT id FROM batches")}
+
+    def mark_submitted(self, batch_id, hashes):
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.execute(
+                "INSERT INTO batches VALUES (?, 'in_progress', ?, ?)",
+                (batch_id, len(hashes), time.time()),
+            )
+            self._db.executemany(
+                "UPDATE items SET status = 'submitted', batch_id = ? WHERE sha256 = ?",
+                [(batch_id, h) for h in hashes],
+            )
+
+    def open_batches(self):
+        return [row[0] for row in self._db.execute("SELECT id FROM batches WHERE status != 'ended'")]
+
+    def finish_item(self, sha256, status, error=None):
+        self._db.execute(
+            "UPDATE items SET status = ?, error = ? WHERE sha256 = ?", (status, error, sha256)
+        )
+
+    def finish_batch(self, batch_id):
+        # Anything the results file did not mention goes back in the queue
+        self._db.execute(
+            "UPDATE items SET status = 'queued', batch_id = NULL WHERE batch_id = ? AND status = 'submitted'",
+            (batch_id,),
+        )
+        self._db.execute("UPDATE batches SET status = 'ended' WHERE id = ?", (batch_id,))
+
+    def counts(self):
+        return dict(self._db.execute("SELECT status, COUNT(*) FROM items GROUP BY status"))
+
+
+class BatchClient:
+    def __init__(self, api_key, base_url=API_BASE_URL):
+        self._http = httpx.Client(
+            base_url=base_url,
+            headers={"x-api-key": api_key, "anthropic-version": API_VERSION},
+            timeout=httpx.Timeout(300.0, connect=10.0),
+        )
+
+    def create(self, requests):
+        response = self._http.post("/v1/messages/batches", json={"requests": requests})
+        response.raise_for_status()
+        return response.json()
+
+    def recent(self, since, page_size=100):
+        """Batches created at or after ``since`` (epoch seconds), newest first."""
+        params = {"limit": page_size}
+        while True:
+            response = self._http.get("/v1/messages/batches", params=params)
+            response.raise_for_status()
+            page = response.json()
+            for batch in page["data"]:
+                if datetime.fromisoformat(batch["created_at"]).timestamp() < since:
+                    return
+                yield batch
+            if not page.get("has_more"):
+                return
+            params["after_id"] = page["last_id"]
+
+    def retrieve(self, batch_id):
+        response = self._http.get(f"/v1/messages/batches/{batch_id}")
+        response.raise_for_status()
+        return response.json()
+
+    def results(self, results_url):
+        with self._http.stream("GET", results_url) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line.strip():
+                    yield json.loads(line)
+
+
+def iter_images(paths):
+    for root in paths:
+        if os.path.isfile(root):
+            candidates = [root]
+        else:
+            candidates = (
+                os.path.join(d, name) for d, _, names in os.walk(root) for name in sorted(names)
+            )
+        for path in candidates:
+            media_type = mimetypes.guess_type(path)[0]
+            if media_type in IMAGE_TYPES:
+                yield path, media_type
+
+
+def enqueue(state, paths):
+    store = get_store()
+    added = skipped = rejected = 0
+    for path, _ in iter_images(paths):
+        with open(path, "rb") as f:
+            data = f.read()
+        # Queue the type found in the headers, not the one the name suggests
+        try:
+            info = probe(data)
+            check_limits(info)
+            if info.format not in decodable_formats():
+                raise ProbeError(f"{info.format.upper()} needs Pillow/pillow-heif to transcode.")
+        except ProbeError as e:
+            print(f"{path}: {e}", file=sys.stderr)
+            rejected += 1
+            continue
+        sha256 = content_hash(data)
+        if sha256 in store or not state.enqueue(sha256, path, info.media_type):
+            skipped += 1
+        else:
+            added += 1
+    print(f"Queued {added} images ({skipped} already analyzed or queued, {rejected} rejected)")
+
+
+def _batch_request(sha256, data, media_type):
+    return {
+        "custom_id": sha256,
+        "params": {
+            "model": MODEL,
+            "max_tokens": 300,
+            "temperature": 0.3,
+            "system": SYSTEM_PROMPT,
+            "messages": build_messages(media_type, base64.b64encode(data).decode()),
+        },
+    }
+
+
+def reconcile(state, client):
+    """Settle items a previous run left 'submitting'.
+
+    That run died between creating a batch and recording it, or the create
+    call failed. A batch created since then that this state does not know
+    and that holds as many requests is taken to be theirs: it is recorded
+    and polled like any other, and results are matched by ``custom_id``,
+    so items it turns out not to hold go back to the queue when it ends.
+    Without such a batch the items are queued again.
+    """
+    hashes, since = state.submitting()
+    if not hashes:
+        return
+    known = state.batch_ids()
+    for batch in client.recent(since - CLOCK_SKEW_SECONDS):
+        if batch["id"] not in known and sum(batch["request_counts"].values()) == len(hashes):
+            state.mark_submitted(batch["id"], hashes)
+            print(f"Recovered batch {batch['id']} with {len(hashes)} requests")
+            return
+    state.requeue_submitting()
+    print(f"Queued {len(hashes)} images again; their batch was never created")
+
+
+def submit(state, client, batch_size=MAX_BATCH_REQUESTS):
+    pending, pending_bytes = [], 0
+
+    def flush():
+        nonlocal pending, pending_bytes
+        if pending:
+            state.mark_submitting([r["custom_id"] for r in pending])
+            batch = client.create(pending)
+            state.mark_submitted(batch["id"], [r["custom_id"] for r in pending])
+            print(f"Submitted batch {batch['id']} with {len(pending)} requests")
+        pending, pending_bytes = [], 0
+
+    for sha256, path, media_type in state.queued():
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # AVIF/HEIC are converted here, in this process; batch jobs are
+            # not latency-sensitive
+            if probe(data).format not in PASSTHROUGH_FORMATS:
+                data, info = transcode_sync(data)
+                media_type = info.media_type
+        except Exception as e:
+            state.finish_item(sha256, "failed", str(e))
+            continue
+        size = len(data) * 4 // 3
+        if len(pending) >= batch_size or pending_bytes + size > MAX_BATCH_BYTES:
+            flush()
+        pending.append(_batch_request(sha256, data, media_type))
+        pending_bytes += size
+    flush()
+
+
+def _store_result(store, entry):
+    result = entry["result"]
+    if result["type"] in ("expired", "canceled"):
+        return "queued", None  # picked up again by the next submit
+    if result["type"] == "errored":
+        # {"type": "error", "error": {"type": "overloaded_error", ...}}
+        error = result.get("error") or {}
+        error_type = (error.get("error") or error).get("type")
+        # Only a request the upstream rejects as invalid will never succeed;
+        # overloaded_error, api_error and the like are tried again
+        status = "failed" if error_type == "invalid_request_error" else "queued"
+        return status, json.dumps(error)
+    if result["type"] != "succeeded":
+        return "failed", json.dumps(result.get("error"))
+    message = result["message"]
+    tokens = message.get("usage") or {}
+    get_ledger().record(
+        "batch", message.get("model", MODEL),
+        tokens.get("input_tokens", 0), tokens.get("output_tokens", 0), batch=True,
+    )
+    try:
+        parsed = json.loads(message["content"][0]["text"])
+    except (KeyError, IndexError, ValueError):
+        return "failed", "unparseable response"
+    if not is_valid_result(parsed):
+        return "failed", "response does not match AnalysisResult"
+    store.put(entry["custom_id"], parsed, model=message.get("model", MODEL), source="batch")
+    return "done", None
+
+
+def poll(state, client, wait=False, interval=60.0):
+    store = get_store()
+    while True:
+        for batch_id in state.open_batches():
+            batch = client.retrieve(batch_id)
+            if batch["processing_status"] != "ended":
+                continue
+            for entry in client.results(batch["results_url"]):
+                state.finish_item(entry["custom_id"], *_store_result(store, entry))
+            state.finish_batch(batch_id)
+            print(f"Batch {batch_id} ended: {state.counts()}")
+        if not wait or not state.open_batches():
+            return
+        time.sleep(interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("enqueue", help="queue images from files or directories")
+    p.add_argument("paths", nargs="+")
+    p = sub.add_parser("submit", help="submit queued images as batches")
+    p.add_argument("--batch-size", type=int, default=MAX_BATCH_REQUESTS)
+    p = sub.add_parser("poll", help="collect results of submitted batches")
+    p.add_argument("--wait", action="store_true", help="keep polling until every batch ends")
+    p.add_argument("--interval", type=float, default=60.0)
+    p = sub.add_parser("run", help="enqueue, submit and wait for results")
+    p.add_argument("paths", nargs="*")
+    p.add_argument("--batch-size", type=int, default=MAX_BATCH_REQUESTS)
+    p.add_argument("--interval", type=float, default=60.0)
+    sub.add_parser("status", help="show queue counts")
+    args = parser.parse_args(argv)
+
+    state = BatchState()
+    if args.command == "status":
+        print(json.dumps({"items": state.counts(), "open_batches": state.open_batches()}))
+        return 0
+    if args.command in ("enqueue", "run") and args.paths:
+        enqueue(state, args.paths)
+    if args.command == "enqueue":
+        return 0
+
+    # Batches can only be polled with a key of the account that created
+    # them, so every run uses the first configured key
+    keys = configured_keys()
+    if not keys:
+        print("CLAUDE_API_KEYS or CLAUDE_API_KEY is not configured", file=sys.stderr)
+        return 1
+    client = BatchClient(keys[0])
+    reconcile(state, client)
+    if args.command in ("submit", "run"):
+        submit(state, client, args.batch_size)
+    if args.command in ("poll", "run"):
+        poll(state, client, wait=args.command == "run" or args.wait, interval=args.interval)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
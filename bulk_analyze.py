@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""Analyze a directory (or manifest) of images from the command line.
+
+Files are hashed, checked against the result store, transcoded where
+needed and base64-encoded in a process pool; only the encoded image of
+files that still need an analysis comes back to the main process. These
+are sent to Claude through a bounded pool of concurrent requests using the
+same analysis code as /api/analyze. Every finished image is appended to a
+checkpoint file, so a killed run resumes where it stopped:
+
+    python bulk_analyze.py photos/ -o results.jsonl
+    python bulk_analyze.py manifest.txt -o results.parquet --concurrency 16
+
+A manifest is a text file with one image path per line. Parquet output is
+written as a directory of part files and needs pyarrow.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from image_probe import ProbeError, check_limits, probe
+from main import MODEL, analyze_encoded
+from result_store import content_hash, difference_hash, get_store, is_valid_result
+from transcode import PASSTHROUGH_FORMATS, decodable_formats, transcode_sync
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".avif", ".heic", ".heif"}
+PARQUET_ROWS_PER_PART = 1000
+
+
+def iter_paths(inputs):
+    for source in inputs:
+        if os.path.isdir(source):
+            for d, _, names in os.walk(source):
+                for name in sorted(names):
+                    if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                        yield os.path.join(d, name)
+        else:
+            with open(source) as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        yield line
+
+
+def prepare(path):
+    # Runs in a worker process: everything CPU-bound before the upstream
+    # call. The file's bytes stay here; a stored result or the encoded image
+    # is all that goes back.
+    with open(path, "rb") as f:
+        data = f.read()
+    item = {"path": path, "sha256": content_hash(data), "bytes": len(data), "error": None}
+    item["result"] = get_store().get(item["sha256"])
+    if item["result"] is not None:
+        return item
+    try:
+        info = probe(data)
+        check_limits(info)
+        if info.format not in PASSTHROUGH_FORMATS:
+            if info.format not in decodable_formats():
+                raise ProbeError(f"{info.format.upper()} needs Pillow/pillow-heif to transcode.")
+            data, info = transcode_sync(data)
+    except Exception as e:
+        item["error"] = str(e)
+        return item
+    item["media_type"] = info.media_type
+    item["image"] = base64.b64encode(data).decode()
+    item["phash"] = difference_hash(data)
+    return item
+
+
+class Checkpoint:
+    """Append-only list of finished paths; re-read on start to skip work."""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = {line.rstrip("\n") for line in f if line.strip()}
+        self._file = open(path, "a")
+
+    def mark(self, paths):
+        for path in paths:
+            self._file.write(path + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class JsonlWriter:
+    def __init__(self, path, checkpoint):
+        self._file = open(path, "a")
+        self._checkpoint = checkpoint
+
+    def write(self, row):
+        self._file.write(json.dumps(row) + "\n")
+        self._file.flush()
+        # Output first, then checkpoint: a crash in between re-analyzes one
+        # image rather than losing it
+        self._checkpoint.mark([row["path"]])
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    def __init__(self, path, checkpoint):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise SystemExit("Parquet output requires pyarrow (pip install pyarrow)")
+        os.makedirs(path, exist_ok=True)
+        self._dir = path
+        self._checkpoint = checkpoint
+        self._rows = []
+
+    def write(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= PARQUET_ROWS_PER_PART:
+            self.flush()
+
+    def flush(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if not self._rows:
+            return
+        # Each flush is its own part file, written atomically, so a killed
+        # run never leaves a truncated file behind
+        name = f"part-{time.time_ns()}.parquet"
+        tmp = os.path.join(self._dir, "." + name)
+        pq.write_table(pa.Table.from_pylist(self._rows), tmp)
+        os.replace(tmp, os.path.join(self._dir, name))
+        self._checkpoint.mark(row["path"] for row in self._rows)
+        self._rows = []
+
+    def close(self):
+        self.flush()
+
+
+class Progress:
+    def __init__(self, total, stream=sys.stderr):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.cached = 0
+        self._start = time.monotonic()
+        self._last = 0.0
+        self._stream = stream
+
+    def update(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last < 0.5:
+            return
+        self._last = now
+        elapsed = now - self._start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        remaining = self.total - self.done - self.failed
+        eta = remaining / rate if rate > 0 else 0
+        self._stream.write(
+            f"\r{self.done}/{self.total} done, {self.cached} cached, {self.failed} failed"
+            f" | {rate:.1f} img/s | ETA {int(eta // 60):d}:{int(eta % 60):02d}  "
+        )
+        self._stream.flush()
+
+
+async def run(args):
+    checkpoint = Checkpoint(args.checkpoint or args.output + ".checkpoint")
+    paths = [p for p in iter_paths(args.inputs) if p not in checkpoint.done]
+    if args.output.endswith(".parquet"):
+        writer = ParquetWriter(args.output, checkpoint)
+    else:
+        writer = JsonlWriter(args.output, checkpoint)
+    print(f"{len(checkpoint.done)} already done, {len(paths)} to go", file=sys.stderr)
+
+    store = get_store()
+    progress = Progress(len(paths))
+    loop = asyncio.get_running_loop()
+    upstream = asyncio.Semaphore(args.concurrency)
+    # Bound how many prepared images sit in memory
+    in_flight = asyncio.Semaphore(args.concurrency * 2)
+
+    async def handle(pool, path):
+        try:
+            item = await loop.run_in_executor(pool, prepare, path)
+            result = item["result"]
+            cached = result is not None
+            if cached:
+                progress.cached += 1
+            elif item["error"] is not None:
+                raise ValueError(item["error"])
+            else:
+                async with upstream:
+                    result = await analyze_encoded(item["image"], item["media_type"], tenant="bulk", priority="batch")
+                if is_valid_result(result):
+                    store.put(item["sha256"], result, model=MODEL, phash=item["phash"])
+            writer.write({
+                "path": path,
+                "sha256": item["sha256"],
+                "bytes": item["bytes"],
+                "model": MODEL,
+                "cached": cached,
+                **result,
+            })
+            progress.done += 1
+        except Exception as e:
+            # Not checkpointed, so the next run retries it
+            progress.failed += 1
+            print(f"\n{path}: {type(e).__name__}: {e}", file=sys.stderr)
+        finally:
+            in_flight.release()
+            progress.update()
+
+    # Spawned, not forked: workers open their own result store connection
+    # rather than inheriting this process's
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        tasks = set()
+        for path in paths:
+            await in_flight.acquire()
+            task = asyncio.create_task(handle(pool, path))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+    writer.close()
+    checkpoint.close()
+    progress.update(force=True)
+    print(file=sys.stderr)
+    return 1 if progress.failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("inputs", nargs="+", help="image directories or manifest files")
+    parser.add_argument("-o", "--output", required=True, help="output .jsonl file or .parquet directory")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: <output>.checkpoint)")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent upstream requests")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="preprocessing processes")
+    args = parser.parse_args(argv)
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
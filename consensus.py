@@ -0,0 +1,140 @@
+import asyncio
+import os
+from collections import defaultdict
+
+import metrics
+
+# Multi-photo consensus: several photos of one person are analyzed and the
+# labels decided by a weighted vote. Analysis stops as soon as the leading
+# labels hold CONSENSUS_THRESHOLD of the weight of *all* photos, analyzed or
+# not, because no outstanding result could overturn them then. Keep the
+# threshold above 0.5 for that to hold.
+CONSENSUS_THRESHOLD = float(os.getenv("CONSENSUS_THRESHOLD", "0.6"))
+CONSENSUS_MAX_PHOTOS = int(os.getenv("CONSENSUS_MAX_PHOTOS", "5"))
+VOTED_FIELDS = ("kibbe_archetype", "color_season")
+# Photos with at least this many pixels get a full vote; smaller ones
+# show less detail and count for less (down to a quarter)
+FULL_WEIGHT_PIXELS = 1_000_000
+
+
+def photo_weight(info):
+    return max(0.25, min(1.0, info.pixels / FULL_WEIGHT_PIXELS))
+
+
+def normalize_label(label):
+    # "soft  natural" and "Soft Natural" are the same vote
+    return " ".join(str(label).split()).title()
+
+
+class Tally:
+    """Weighted votes per field over a fixed set of photos."""
+
+    def __init__(self, total_weight):
+        # Weight of every photo still in play, decided or not
+        self.total_weight = total_weight
+        self.votes = {field: defaultdict(float) for field in VOTED_FIELDS}
+        self.results = []
+
+    def add(self, weight, result):
+        for field in VOTED_FIELDS:
+            self.votes[field][normalize_label(result[field])] += weight
+        self.results.append((weight, result))
+
+    def drop(self, weight):
+        # A photo whose analysis failed no longer counts
+        self.total_weight -= weight
+
+    def leader(self, field):
+        votes = self.votes[field]
+        if not votes:
+            return None, 0.0
+        label = max(votes, key=votes.get)
+        return label, votes[label]
+
+    def reached(self, threshold):
+        return self.total_weight > 0 and all(
+            self.leader(field)[1] >= threshold * self.total_weight for field in VOTED_FIELDS
+        )
+
+    def agreement(self):
+        if self.total_weight <= 0:
+            return {field: 0.0 for field in VOTED_FIELDS}
+        return {field: round(self.leader(field)[1] / self.total_weight, 3) for field in VOTED_FIELDS}
+
+    def result(self):
+        labels = {field: self.leader(field)[0] for field in VOTED_FIELDS}
+
+        def agrees(result, fields):
+            return all(normalize_label(result[field]) == labels[field] for field in fields)
+
+        # The description comes from the heaviest photo that agrees with
+        # both labels, else with the season, since it describes the palette
+        for fields in (VOTED_FIELDS, ("color_season",), ()):
+            candidates = [(w, r) for w, r in self.results if agrees(r, fields)]
+            if candidates:
+                break
+        description = max(candidates, key=lambda c: c[0])[1]["palette_description"]
+        return {**labels, "palette_description": description}
+
+
+async def run_consensus(photos, analyze, known=(), threshold=CONSENSUS_THRESHOLD):
+    """Analyze ``photos`` concurrently until their labels agree.
+
+    ``photos`` is a list of ``(weight, item)`` and ``analyze(item)`` a
+    coroutine returning an analysis result; ``known`` holds ``(weight,
+    result)`` pairs already decided, e.g. from the result store. Calls are
+    started only while the results so far could still fall short of
+    consensus, heaviest photos first, and calls still running once it is
+    reached are cancelled. Photos whose analysis fails drop out of the
+    vote. Returns the :class:`Tally` and a dict of counts.
+    """
+    pending = sorted(photos, key=lambda p: p[0], reverse=True)
+    tally = Tally(sum(weight for weight, _ in photos) + sum(weight for weight, _ in known))
+    for weight, result in known:
+        tally.add(weight, result)
+    running = {}
+    stats = {
+        "photos": len(photos) + len(known), "cached": len(known),
+        "analyzed": 0, "failed": 0, "cancelled": 0, "skipped": 0,
+    }
+
+    def launch():
+        # Start photos until the ones in flight could bring every field to
+        # the threshold, whatever the others would have said
+        while pending:
+            in_flight = sum(running.values())
+            goal = threshold * tally.total_weight
+            if all(tally.leader(field)[1] + in_flight >= goal for field in VOTED_FIELDS):
+                return
+            weight, item = pending.pop(0)
+            running[asyncio.ensure_future(analyze(item))] = weight
+
+    try:
+        if not tally.reached(threshold):
+            launch()
+        while running:
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                weight = running.pop(task)
+                if task.exception() is None:
+                    tally.add(weight, task.result())
+                    stats["analyzed"] += 1
+                else:
+                    tally.drop(weight)
+                    stats["failed"] += 1
+            if tally.reached(threshold):
+                break
+            launch()
+    finally:
+        stats["cancelled"] = len(running)
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+    stats["skipped"] = len(pending)
+    metrics.incr("consensus_requests")
+    metrics.incr("consensus_calls_skipped", stats["skipped"])
+    metrics.incr("consensus_calls_cancelled", stats["cancelled"])
+    if tally.reached(threshold):
+        metrics.incr("consensus_reached")
+    return tally, stats
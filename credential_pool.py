@@ -0,0 +1,238 @@
+import asyncio
+import os
+import time
+from collections import deque
+from datetime import datetime
+
+import anthropic
+import httpx
+
+import metrics
+from retry_policy import parse_retry_after
+
+# Upstream keys: CLAUDE_API_KEYS="key1,key2,..." or the single CLAUDE_API_KEY.
+# Each key gets its own client and connection pool, and tracks the budget
+# the upstream reports in its rate-limit headers.
+POOL_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS_PER_KEY", "20"))
+DEFAULT_COOLDOWN_SECONDS = float(os.getenv("UPSTREAM_KEY_COOLDOWN_SECONDS", "10"))
+# Idle connections are closed after this long; httpx's own default (5s)
+# would drop the warm pool between keep-alive pings (see prewarm.py)
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "90"))
+# Handshake timings kept per key for percentiles
+_HANDSHAKE_SAMPLES = 256
+
+
+class KeysCoolingDown(Exception):
+    """Every key is rate limited for longer than the caller can wait."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"every upstream key is cooling down for {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+def configured_keys():
+    keys = os.getenv("CLAUDE_API_KEYS") or os.getenv("CLAUDE_API_KEY") or ""
+    return [k.strip() for k in keys.split(",") if k.strip()]
+
+
+def _parse_reset(value):
+    # anthropic-ratelimit-*-reset is an RFC 3339 timestamp
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
+
+def _percentiles(samples):
+    ordered = sorted(samples)
+    if not ordered:
+        return {"p50": None, "max": None}
+    return {"p50": round(ordered[len(ordered) // 2], 1), "max": round(ordered[-1], 1)}
+
+
+class ConnectionStats:
+    """New upstream connections of one key and how long their handshakes
+    took, from httpcore trace events. Connections opened by real requests
+    rather than by the warmer are counted as cold."""
+
+    __slots__ = ("opened", "cold", "connect_ms", "tls_ms")
+
+    def __init__(self):
+        self.opened = 0
+        self.cold = 0
+        self.connect_ms = deque(maxlen=_HANDSHAKE_SAMPLES)
+        self.tls_ms = deque(maxlen=_HANDSHAKE_SAMPLES)
+
+    async def attach(self, request):
+        # httpx request hook: have httpcore report this request's connection
+        # events (DNS and TCP connect, then TLS) to us
+        started = {}
+        warm = request.extensions.get("prewarm", False)
+
+        async def trace(event, info):
+            step, _, phase = event.rpartition(".")
+            if phase == "started":
+                started[step] = time.perf_counter()
+            elif phase == "complete" and step in started:
+                elapsed = (time.perf_counter() - started.pop(step)) * 1000
+                if step == "connection.connect_tcp":
+                    self.connect_ms.append(elapsed)
+                    self.opened += 1
+                    if not warm:
+                        self.cold += 1
+                        metrics.incr("upstream_cold_connections")
+                elif step == "connection.start_tls":
+                    self.tls_ms.append(elapsed)
+
+        request.extensions["trace"] = trace
+
+    def stats(self, idle=None):
+        return {
+            "idle": idle,
+            "opened": self.opened,
+            "cold": self.cold,
+            "connect_ms": _percentiles(self.connect_ms),
+            "tls_ms": _percentiles(self.tls_ms),
+        }
+
+
+class KeySlot:
+    __slots__ = (
+        "name", "http", "client", "connections", "in_flight", "cooldown_until",
+        "requests_limit", "requests_remaining", "tokens_limit", "tokens_remaining", "reset_at",
+    )
+
+    def __init__(self, name, api_key):
+        self.name = name
+        self.connections = ConnectionStats()
+        self.http = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=POOL_MAX_CONNECTIONS,
+                keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+            ),
+            timeout=60.0,
+            event_hooks={"request": [self.connections.attach]},
+        )
+        self.client = anthropic.AsyncAnthropic(
+            api_key=api_key,
+            timeout=60.0,
+            # Retries happen in run_analysis, so a 429 moves to another key
+            # instead of hammering this one
+            max_retries=0,
+            http_client=self.http,
+        )
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.requests_limit = self.requests_remaining = None
+        self.tokens_limit = self.tokens_remaining = None
+        self.reset_at = None
+
+    def headroom(self, now):
+        """Fraction of this key's budget still available, 0.0 - 1.0.
+
+        Unknown budgets count as full; calls already in flight are
+        subtracted so concurrent requests spread across keys before the
+        headers catch up.
+        """
+        if now < self.cooldown_until:
+            return -1.0
+        if self.reset_at is not None and now >= self.reset_at:
+            return 1.0  # the window has rolled over since we last heard
+        fractions = [1.0]
+        if self.requests_limit:
+            fractions.append((self.requests_remaining - self.in_flight) / self.requests_limit)
+        if self.tokens_limit:
+            fractions.append(self.tokens_remaining / self.tokens_limit)
+        return min(fractions)
+
+    def idle_connections(self):
+        # httpx has no public view of its pool; None if that ever changes
+        pool = getattr(self.http._transport, "_pool", None)
+        connections = getattr(pool, "connections", None)
+        return None if connections is None else sum(1 for c in connections if c.is_idle())
+
+    def stats(self):
+        return {
+            "key": self.name,
+            "in_flight": self.in_flight,
+            "requests_remaining": self.requests_remaining,
+            "tokens_remaining": self.tokens_remaining,
+            "cooling_down": time.monotonic() < self.cooldown_until,
+            "connections": self.connections.stats(self.idle_connections()),
+        }
+
+
+class CredentialPool:
+    def __init__(self, api_keys):
+        if not api_keys:
+            raise RuntimeError("Claude API key not configured")
+        # Keys are named by position so they never show up in logs or metrics
+        self.slots = [KeySlot(f"key{i}", key) for i, key in enumerate(api_keys)]
+        metrics.register_gauge("upstream_keys", lambda: [s.stats() for s in self.slots])
+
+    @classmethod
+    def from_env(cls):
+        return cls(configured_keys())
+
+    def acquire(self):
+        """Pick the key with the most headroom. Callers wait for
+        :meth:`ready` first; if every key went into cooldown since, the one
+        that recovers first is used."""
+        now = time.monotonic()
+        best = max(self.slots, key=lambda s: (s.headroom(now), -s.in_flight))
+        if best.headroom(now) < 0:
+            best = min(self.slots, key=lambda s: s.cooldown_until)
+        metrics.incr(f"upstream_{best.name}_requests")
+        return best
+
+    def update(self, slot, headers):
+        def number(name):
+            value = headers.get(name)
+            return int(value) if value and value.isdigit() else None
+
+        requests_limit = number("anthropic-ratelimit-requests-limit")
+        if requests_limit is not None:
+            slot.requests_limit = requests_limit
+            slot.requests_remaining = number("anthropic-ratelimit-requests-remaining") or 0
+        tokens_limit = number("anthropic-ratelimit-tokens-limit")
+        if tokens_limit is not None:
+            slot.tokens_limit = tokens_limit
+            slot.tokens_remaining = number("anthropic-ratelimit-tokens-remaining") or 0
+        reset = _parse_reset(headers.get("anthropic-ratelimit-requests-reset"))
+        if reset is not None:
+            # Convert wall-clock reset time onto the monotonic clock
+            slot.reset_at = time.monotonic() + max(0.0, reset - time.time())
+
+    def cooldown(self, slot, headers=None):
+        retry_after = parse_retry_after(headers.get("retry-after")) if headers else None
+        seconds = retry_after if retry_after is not None else DEFAULT_COOLDOWN_SECONDS
+        slot.cooldown_until = time.monotonic() + seconds
+        metrics.incr(f"upstream_{slot.name}_cooldowns")
+
+    def wait_time(self):
+        # Seconds until some key is out of cooldown (0 if one is ready now)
+        return max(0.0, min(s.cooldown_until for s in self.slots) - time.monotonic())
+
+    async def ready(self, deadline=None):
+        """Wait until some key is out of cooldown. A call now would only
+        earn another 429 and a longer cooldown. Raises
+        :class:`KeysCoolingDown` at once if that is past ``deadline``."""
+        wait = self.wait_time()
+        if not wait:
+            return
+        if deadline is not None and wait >= deadline.remaining():
+            metrics.incr("upstream_keys_exhausted")
+            raise KeysCoolingDown(wait)
+        metrics.incr("upstream_cooldown_waits")
+        await asyncio.sleep(wait)
+
+
+_pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = CredentialPool.from_env()
+    return _pool
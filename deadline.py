@@ -0,0 +1,88 @@
+import asyncio
+import contextlib
+import os
+import time
+
+import metrics
+
+# Total time budget for one analysis, across every retry. Clients may ask
+# for less (never more than the max) with an X-Request-Timeout header in
+# seconds, e.g. to match their own load-balancer timeout.
+ANALYZE_DEADLINE_SECONDS = float(os.getenv("ANALYZE_DEADLINE_SECONDS", "55"))
+MAX_DEADLINE_SECONDS = float(os.getenv("ANALYZE_MAX_DEADLINE_SECONDS", "120"))
+DEADLINE_HEADER = "x-request-timeout"
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class Deadline:
+    __slots__ = ("expires_at",)
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def from_request(cls, request):
+        seconds = ANALYZE_DEADLINE_SECONDS
+        value = request.headers.get(DEADLINE_HEADER)
+        if value:
+            try:
+                seconds = min(float(value), MAX_DEADLINE_SECONDS)
+            except ValueError:
+                pass
+        return cls(max(seconds, 0.0))
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+
+async def _wait_for_disconnect(request):
+    # The body has already been read, so the next ASGI message is the
+    # disconnect; this costs nothing while the client stays connected.
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def run_guarded(coro, request, deadline):
+    """Run ``coro`` until it finishes, the deadline passes or the client
+    goes away, cancelling the in-flight upstream work in the latter cases.
+    Without a ``request`` only the deadline applies."""
+    work = asyncio.ensure_future(coro)
+    waiting = {work}
+    watcher = None
+    if request is not None:
+        watcher = asyncio.ensure_future(_wait_for_disconnect(request))
+        waiting.add(watcher)
+    try:
+        done, _ = await asyncio.wait(
+            waiting, timeout=deadline.remaining(), return_when=asyncio.FIRST_COMPLETED
+        )
+    except asyncio.CancelledError:
+        work.cancel()
+        raise
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+    if work in done:
+        return work.result()
+
+    work.cancel()
+    with contextlib.suppress(asyncio.CancelledError, Exception):
+        await work
+    if watcher is not None and watcher in done:
+        metrics.incr("analyze_cancelled_client_disconnect")
+        raise ClientDisconnected()
+    metrics.incr("analyze_cancelled_deadline")
+    raise DeadlineExceeded()
@@ -1,4 +1,14 @@
 import { useState } from 'react';
+import { lookupAnalysis } from './imageHash';
+import { uploadResumable } from './resumableUpload';
+import { shrinkForUpload } from './shrinkImage';
+
+// The server transcodes AVIF/HEIC into a format the model accepts
+const ACCEPTED_TYPES = ['image/jpeg', 'image/png', 'image/webp', 'image/avif', 'image/heic', 'image/heif'];
+// Photos are shrunk before upload, so only the upload itself must fit in
+// 5MB; this just refuses files no phone camera produces
+const MAX_ORIGINAL_SIZE = 50 * 1024 * 1024;
+const MAX_UPLOAD_SIZE = 5 * 1024 * 1024;
 
 // Generate color swatches based on color season
 const getColorPalette = (season) => {
@@ -28,12 +38,14 @@ function App() {
   const handleFileChange = (e) => {
     const selectedFile = e.target.files[0];
     if (selectedFile) {
-      if (selectedFile.size > 5 * 1024 * 1024) {
-        setError('File size exceeds 5MB limit');
+      if (selectedFile.size > MAX_ORIGINAL_SIZE) {
+        setError('File size exceeds 50MB limit');
         return;
       }
-      if (!['image/jpeg', 'image/png'].includes(selectedFile.type)) {
-        setError('Please upload a JPG or PNG image');
+      // HEIC often arrives without a type outside Safari; the server sniffs it
+      const isHeic = /\.hei[cf]$/i.test(selectedFile.name);
+      if (!ACCEPTED_TYPES.includes(selectedFile.type) && !isHeic) {
+        setError('Please upload a JPG, PNG, WebP, AVIF or HEIC image');
         return;
       }
       setError('');
@@ -58,21 +70,24 @@ function App() {
     setLoading(true);
     setError('');
 
-    const formData = new FormData();
-    formData.append('file', file);
-
     try {
-      const response = await fetch('/api/analyze', {
-        method: 'POST',
-        body: formData,
-      });
+      // The server stores results under the hash of the bytes it received,
+      // so the lookup hashes exactly what would be uploaded: the shrunk photo
+      const upload = await shrinkForUpload(file);
+
+      // Skip the upload entirely when this photo was analyzed before
+      const lookup = await lookupAnalysis(upload);
+      if (lookup.result) {
+        setResults(lookup.result);
+        return;
+      }
 
-      if (!response.ok) {
-        const errorData = await response.json();
-        throw new Error(errorData.detail || 'Analysis failed');
+      if (upload.size > MAX_UPLOAD_SIZE) {
+        throw new Error('File size exceeds 5MB limit');
       }
 
-      const data = await response.json();
+      // Chunked, resumable upload; analysis starts when the last chunk lands
+      const data = await uploadResumable(upload);
       setResults(data);
     } catch (err) {
       setError(err.message || 'Failed to analyze image');
@@ -134,7 +149,7 @@ function App() {
               <input
                 type="file"
                 onChange={handleFileChange}
-                accept="image/jpeg,image/png"
+                accept={ACCEPTED_TYPES.join(',') + ',.heic,.heif'}
                 className="hidden"
                 id="fileInput"
               />
@@ -168,11 +183,11 @@ function App() {
                     <div className="flex justify-center space-x-8 text-sm text-slate-500">
                       <div className="flex items-center space-x-2">
                         <div className="w-2 h-2 bg-slate-400 rounded-full"></div>
-                        <span>JPG, PNG supported</span>
+                        <span>JPG, PNG, WebP, HEIC supported</span>
                       </div>
                       <div className="flex items-center space-x-2">
                         <div className="w-2 h-2 bg-slate-400 rounded-full"></div>
-                        <span>Max 5MB</span>
+                        <span>Large photos are resized for you</span>
                       </div>
                     </div>
                   </div>
@@ -0,0 +1,50 @@
+// Client-side hashing for the hash-first upload protocol: the server is
+// asked for a stored analysis by hash before the photo itself is uploaded.
+
+export async function sha256Hex(file) {
+  const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+  return Array.from(new Uint8Array(digest), (b) => b.toString(16).padStart(2, '0')).join('');
+}
+
+// 64-bit difference hash of a 9x8 grayscale thumbnail; stays the same when
+// a photo is re-encoded or resized
+export async function differenceHash(file) {
+  const bitmap = await createImageBitmap(file);
+  const canvas = document.createElement('canvas');
+  canvas.width = 9;
+  canvas.height = 8;
+  const ctx = canvas.getContext('2d');
+  ctx.drawImage(bitmap, 0, 0, 9, 8);
+  const px = ctx.getImageData(0, 0, 9, 8).data;
+  const gray = (i) => px[i] * 0.299 + px[i + 1] * 0.587 + px[i + 2] * 0.114;
+  let hex = '';
+  for (let row = 0; row < 8; row++) {
+    let byte = 0;
+    for (let col = 0; col < 8; col++) {
+      const i = (row * 9 + col) * 4;
+      byte = (byte << 1) | (gray(i) > gray(i + 4) ? 1 : 0);
+    }
+    hex += byte.toString(16).padStart(2, '0');
+  }
+  return hex;
+}
+
+// Returns { result }: the stored analysis on a hit, null on a miss.
+// Lookups never block analysis, so every failure is a miss.
+export async function lookupAnalysis(file) {
+  if (!window.crypto?.subtle) return { result: null }; // needs https or localhost
+  try {
+    const [sha256, phash] = await Promise.all([
+      sha256Hex(file),
+      differenceHash(file).catch(() => null),
+    ]);
+    const response = await fetch('/api/analyze/lookup', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ sha256, phash }),
+    });
+    return { result: response.ok ? await response.json() : null };
+  } catch {
+    return { result: null };
+  }
+}
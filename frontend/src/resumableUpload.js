@@ -0,0 +1,68 @@
+// Resumable upload against /api/uploads (tus-style). The photo goes up in
+// chunks; after a dropped connection only the missing part is re-sent, and
+// the server starts the analysis itself when the last chunk lands.
+
+const CHUNK_SIZE = 256 * 1024;
+const MAX_NETWORK_RETRIES = 5;
+const TUS_HEADERS = { 'Tus-Resumable': '1.0.0' };
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+async function readJson(response, fallbackMessage) {
+  const data = await response.json().catch(() => ({}));
+  if (!response.ok) throw new Error(data.detail || fallbackMessage);
+  return data;
+}
+
+async function serverOffset(url) {
+  const response = await fetch(url, { method: 'HEAD', headers: TUS_HEADERS });
+  if (!response.ok) throw new Error('Upload expired, please try again');
+  return Number(response.headers.get('Upload-Offset'));
+}
+
+// Resolves with the analysis result
+export async function uploadResumable(file) {
+  const metadata = [`filetype ${btoa(file.type)}`];
+  const created = await fetch('/api/uploads', {
+    method: 'POST',
+    headers: { ...TUS_HEADERS, 'Upload-Length': String(file.size), 'Upload-Metadata': metadata.join(',') },
+  });
+  if (created.status !== 201) await readJson(created, 'Upload failed');
+  const url = created.headers.get('Location');
+
+  let offset = 0;
+  let failures = 0;
+  for (;;) {
+    let response;
+    try {
+      if (offset >= file.size) {
+        // The last chunk arrived but its response was lost: fetch the result
+        response = await fetch(url);
+      } else {
+        response = await fetch(url, {
+          method: 'PATCH',
+          headers: {
+            ...TUS_HEADERS,
+            'Content-Type': 'application/offset+octet-stream',
+            'Upload-Offset': String(offset),
+          },
+          body: file.slice(offset, offset + CHUNK_SIZE),
+        });
+      }
+    } catch (err) {
+      // Network failure: back off, then ask the server how much it has
+      if (++failures > MAX_NETWORK_RETRIES) throw err;
+      await sleep(500 * 2 ** failures);
+      offset = await serverOffset(url).catch(() => offset);
+      continue;
+    }
+    failures = 0;
+    if (response.status === 204) {
+      offset = Number(response.headers.get('Upload-Offset'));
+    } else if (response.status === 409) {
+      offset = await serverOffset(url);
+    } else {
+      return readJson(response, 'Analysis failed');
+    }
+  }
+}
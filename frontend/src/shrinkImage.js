@@ -0,0 +1,68 @@
+// Server-driven pre-shrinking: photos are scaled to the size and format the
+// server asks for (/api/config/upload) before they are uploaded, so a
+// multi-megabyte phone photo goes up as a few hundred KB and the server
+// sends it upstream untouched.
+
+let configPromise = null;
+
+export function uploadConfig() {
+  configPromise ??= fetch('/api/config/upload')
+    .then((response) => (response.ok ? response.json() : null))
+    .catch(() => null);
+  return configPromise;
+}
+
+// Returns the re-encoded Blob, or null when the original is already fine
+// or cannot be improved on
+export async function encodeShrunk(file, { max_edge: maxEdge, formats, quality }) {
+  // Decoding applies the EXIF orientation; the re-encoded photo carries no
+  // EXIF metadata at all
+  const bitmap = await createImageBitmap(file);
+  const scale = Math.min(1, maxEdge / Math.max(bitmap.width, bitmap.height));
+  if (scale === 1 && formats.includes(file.type)) {
+    bitmap.close();
+    return null;
+  }
+  const width = Math.round(bitmap.width * scale);
+  const height = Math.round(bitmap.height * scale);
+  const canvas = new OffscreenCanvas(width, height);
+  const ctx = canvas.getContext('2d');
+  ctx.imageSmoothingQuality = 'high';
+  ctx.drawImage(bitmap, 0, 0, width, height);
+  bitmap.close();
+  for (const type of formats) {
+    const blob = await canvas.convertToBlob({ type, quality });
+    // Browsers that cannot encode a type silently return PNG instead
+    if (blob.type === type) return blob.size < file.size ? blob : null;
+  }
+  return null;
+}
+
+function encodeInWorker(file, config) {
+  return new Promise((resolve, reject) => {
+    const worker = new Worker(new URL('./shrinkWorker.js', import.meta.url), { type: 'module' });
+    worker.onmessage = ({ data }) => {
+      worker.terminate();
+      if (data.error) reject(new Error(data.error));
+      else resolve(data.blob);
+    };
+    worker.onerror = (event) => {
+      worker.terminate();
+      reject(event.error || new Error('Image worker failed'));
+    };
+    worker.postMessage({ file, config });
+  });
+}
+
+// Resolves with what to upload: the shrunk photo, or the original when the
+// browser cannot decode it (HEIC outside Safari; the server transcodes it)
+export async function shrinkForUpload(file) {
+  const config = await uploadConfig();
+  if (!config || typeof OffscreenCanvas === 'undefined') return file;
+  try {
+    const blob = await encodeInWorker(file, config).catch(() => encodeShrunk(file, config));
+    return blob || file;
+  } catch {
+    return file;
+  }
+}
@@ -0,0 +1,11 @@
+// Decodes, resizes and re-encodes a photo off the main thread, so large
+// phone photos do not freeze the page
+import { encodeShrunk } from './shrinkImage';
+
+self.onmessage = async ({ data: { file, config } }) => {
+  try {
+    self.postMessage({ blob: await encodeShrunk(file, config) });
+  } catch (err) {
+    self.postMessage({ error: String(err) });
+  }
+};
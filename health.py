@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+import httpx
+
+import metrics
+from credential_pool import get_pool
+from scheduler import get_scheduler
+
+# Readiness: whether this instance should get new traffic. Everything it
+# reports is measured in the background, so answering costs a few dict
+# lookups and never touches the upstream.
+READY_MAX_LOOP_LAG_MS = float(os.getenv("READY_MAX_LOOP_LAG_MS", "250"))
+READY_MAX_QUEUED = int(os.getenv("READY_MAX_QUEUED", "50"))
+# Consecutive failed upstream probes before the instance reports not-ready
+READY_UPSTREAM_FAILURES = int(os.getenv("READY_UPSTREAM_FAILURES", "3"))
+UPSTREAM_PROBE_SECONDS = float(os.getenv("UPSTREAM_PROBE_SECONDS", "30"))
+LOOP_LAG_INTERVAL = 0.5
+
+logger = logging.getLogger(__name__)
+# Lag is reported as the worst of the last few samples, so one stall is
+# still visible to the next readiness check
+_LAG_SAMPLES = 10
+
+
+class HealthMonitor:
+    def __init__(self):
+        self.lag_samples = deque([0.0], maxlen=_LAG_SAMPLES)
+        self.upstream_ok = None  # unknown until the first probe
+        self.upstream_failures = 0
+        self.upstream_checked_at = None
+        self.upstream_latency_ms = None
+        self.upstream_error = None
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [
+            asyncio.create_task(self._watch_loop()),
+            asyncio.create_task(self._probe_upstream()),
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _watch_loop(self):
+        # A sleep that wakes up late means something held the event loop
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.lag_samples.append(max(0.0, loop.time() - start - LOOP_LAG_INTERVAL))
+
+    async def _probe_upstream(self):
+        while True:
+            await self.probe_once()
+            await asyncio.sleep(UPSTREAM_PROBE_SECONDS)
+
+    async def probe_once(self):
+        # Any HTTP answer means the upstream is reachable; only connection
+        # failures, timeouts and 5xx count against it. No tokens are spent.
+        start = time.monotonic()
+        try:
+            slot = get_pool().slots[0]
+            response = await slot.http.get(slot.client.base_url, timeout=5.0)
+            ok = response.status_code < 500
+            self.upstream_error = None if ok else f"HTTP {response.status_code}"
+        except RuntimeError as e:
+            ok, self.upstream_error = False, str(e)  # no API key configured
+        except httpx.HTTPError as e:
+            ok, self.upstream_error = False, f"{type(e).__name__}: {e}"
+        except Exception as e:
+            # Anything else is a failed probe too; letting it out would end
+            # the probe loop and freeze the upstream state readiness reports
+            logger.exception("Upstream probe failed")
+            ok, self.upstream_error = False, f"{type(e).__name__}: {e}"
+        self.upstream_latency_ms = round((time.monotonic() - start) * 1000, 1)
+        self.upstream_checked_at = time.monotonic()
+        self.upstream_ok = ok
+        self.upstream_failures = 0 if ok else self.upstream_failures + 1
+        metrics.incr("upstream_probe_ok" if ok else "upstream_probe_failed")
+
+    def readiness(self):
+        scheduler = get_scheduler()
+        lag_ms = round(max(self.lag_samples) * 1000, 1)
+        reasons = []
+        if lag_ms > READY_MAX_LOOP_LAG_MS:
+            reasons.append("event_loop_lag")
+        if scheduler.queued > READY_MAX_QUEUED:
+            reasons.append("queue_full")
+        if self.upstream_failures >= READY_UPSTREAM_FAILURES:
+            reasons.append("upstream_unreachable")
+        return {
+            "ready": not reasons,
+            "reasons": reasons,
+            "loop_lag_ms": lag_ms,
+            "in_flight": scheduler.running,
+            "queued": scheduler.queued,
+            "capacity": scheduler.capacity,
+            "upstream": {
+                "ok": self.upstream_ok,
+                "consecutive_failures": self.upstream_failures,
+                "checked_seconds_ago": (
+                    round(time.monotonic() - self.upstream_checked_at, 1)
+                    if self.upstream_checked_at is not None else None
+                ),
+                "latency_ms": self.upstream_latency_ms,
+                "error": self.upstream_error,
+            },
+        }
+
+
+monitor = HealthMonitor()
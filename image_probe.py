@@ -0,0 +1,229 @@
+"""Header-only image probing.
+
+Reads dimensions, bit depth and frame count from the image headers (JPEG
+SOF, PNG IHDR, WebP VP8/VP8L/VP8X, AVIF/HEIC ispe) without decoding any
+pixels, so oversized images (decompression bombs) can be rejected before
+anything expands them in memory. Probing a typical photo takes a few
+microseconds (tens for AVIF/HEIC, whose headers are a box tree):
+
+    python image_probe.py photo.jpg other.png
+"""
+import os
+import struct
+import sys
+import time
+
+# Largest image accepted, in pixels per frame. 50 MP covers current phone
+# cameras; a 5 MB PNG declaring 30000x30000 is rejected.
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", "50000000"))
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC), which share the range
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Markers without a length field
+_JPEG_STANDALONE_MARKERS = frozenset(range(0xD0, 0xD8)) | {0x01}
+# Channels per PNG color type: gray, RGB, palette, gray+alpha, RGBA
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+# ISOBMFF brands (ftyp) of still AVIF and HEIC/HEIF images
+_AVIF_BRANDS = frozenset({b"avif", b"avis"})
+_HEIC_BRANDS = frozenset({b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1", b"msf1"})
+
+
+class ProbeError(ValueError):
+    """The bytes are not a readable image, or the image is over the limit."""
+
+
+class ImageInfo:
+    __slots__ = ("format", "media_type", "width", "height", "bit_depth", "channels", "frames")
+
+    def __init__(self, format, media_type, width, height, bit_depth, channels, frames=1):
+        self.format = format
+        self.media_type = media_type
+        self.width = width
+        self.height = height
+        self.bit_depth = bit_depth
+        self.channels = channels
+        self.frames = frames
+
+    @property
+    def pixels(self):
+        return self.width * self.height
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"ImageInfo({self.format} {self.width}x{self.height}, {self.bit_depth}-bit, {self.frames} frame(s))"
+
+
+def _probe_jpeg(data):
+    pos = 2
+    while True:
+        if data[pos] != 0xFF:
+            raise ProbeError("Corrupt JPEG marker stream.")
+        # Any number of 0xFF fill bytes may precede a marker
+        while data[pos] == 0xFF:
+            pos += 1
+        marker = data[pos]
+        pos += 1
+        if marker in _JPEG_STANDALONE_MARKERS:
+            continue
+        if marker in (0xD9, 0xDA):
+            raise ProbeError("JPEG has no frame header.")
+        (length,) = struct.unpack_from(">H", data, pos)
+        if marker in _JPEG_SOF_MARKERS:
+            bit_depth, height, width, channels = struct.unpack_from(">BHHB", data, pos + 2)
+            if not width or not height:
+                # Height 0 means it is only given later in a DNL segment
+                raise ProbeError("JPEG dimensions are not declared in the frame header.")
+            return ImageInfo("jpeg", "image/jpeg", width, height, bit_depth, channels)
+        pos += length
+
+
+def _probe_png(data):
+    length, chunk = struct.unpack_from(">I4s", data, 8)
+    if chunk != b"IHDR" or length != 13:
+        raise ProbeError("PNG does not start with an IHDR chunk.")
+    width, height, bit_depth, color_type = struct.unpack_from(">IIBB", data, 16)
+    if not width or not height or color_type not in _PNG_CHANNELS:
+        raise ProbeError("Invalid PNG header.")
+    # An animated PNG declares its frame count in acTL, before the first IDAT
+    frames = 1
+    pos = 33
+    while pos + 12 <= len(data):
+        length, chunk = struct.unpack_from(">I4s", data, pos)
+        if chunk in (b"IDAT", b"IEND"):
+            break
+        if chunk == b"acTL":
+            (frames,) = struct.unpack_from(">I", data, pos + 8)
+            break
+        pos += 12 + length
+    return ImageInfo("png", "image/png", width, height, bit_depth, _PNG_CHANNELS[color_type], max(frames, 1))
+
+
+def _probe_webp(data):
+    chunk = data[12:16]
+    if chunk == b"VP8 ":
+        # Lossy: keyframe start code, then 14-bit width and height
+        if data[23:26] != b"\x9d\x01\x2a":
+            raise ProbeError("Invalid WebP frame header.")
+        width, height = struct.unpack_from("<HH", data, 26)
+        return ImageInfo("webp", "image/webp", width & 0x3FFF, height & 0x3FFF, 8, 3)
+    if chunk == b"VP8L":
+        if data[20] != 0x2F:
+            raise ProbeError("Invalid WebP lossless header.")
+        (bits,) = struct.unpack_from("<I", data, 21)
+        width = (bits & 0x3FFF) + 1
+        height = ((bits >> 14) & 0x3FFF) + 1
+        return ImageInfo("webp", "image/webp", width, height, 8, 4 if bits >> 28 & 1 else 3)
+    if chunk == b"VP8X":
+        flags = data[20]
+        width = int.from_bytes(data[24:27], "little") + 1
+        height = int.from_bytes(data[27:30], "little") + 1
+        frames = 1
+        if flags & 0x02:
+            # Animated: one ANMF chunk per frame
+            frames = 0
+            pos = 30
+            while pos + 8 <= len(data):
+                chunk, length = struct.unpack_from("<4sI", data, pos)
+                frames += chunk == b"ANMF"
+                pos += 8 + length + (length & 1)
+        return ImageInfo("webp", "image/webp", width, height, 8, 4 if flags & 0x10 else 3, max(frames, 1))
+    raise ProbeError("Unknown WebP chunk.")
+
+
+def _iter_boxes(data, start, end):
+    # ISOBMFF boxes: 32-bit size (1 = 64-bit size follows, 0 = to the end)
+    pos = start
+    while pos + 8 <= end:
+        size, box = struct.unpack_from(">I4s", data, pos)
+        header = 8
+        if size == 1:
+            (size,) = struct.unpack_from(">Q", data, pos + 8)
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            raise ProbeError("Corrupt image container.")
+        yield box, pos + header, min(pos + size, end)
+        pos += size
+
+
+def _probe_heif(data):
+    # AVIF and HEIC share the HEIF container; dimensions are in the ispe
+    # item properties under meta/iprp/ipco
+    size, _, major = struct.unpack_from(">I4s4s", data, 0)
+    brands = {major} | {data[i:i + 4] for i in range(16, min(size, len(data)), 4)}
+    if brands & _AVIF_BRANDS:
+        format, media_type = "avif", "image/avif"
+    elif brands & _HEIC_BRANDS:
+        format, media_type = "heic", "image/heic"
+    else:
+        raise ProbeError("Unsupported image container.")
+    width = height = 0
+    bit_depth, channels = 8, 3
+    for box, start, end in _iter_boxes(data, 0, len(data)):
+        if box != b"meta":
+            continue
+        for box, start, end in _iter_boxes(data, start + 4, end):  # meta is a full box
+            if box != b"iprp":
+                continue
+            for box, start, end in _iter_boxes(data, start, end):
+                if box != b"ipco":
+                    continue
+                for box, start, end in _iter_boxes(data, start, end):
+                    if box == b"ispe":
+                        # Grid images also list each tile; the largest is the image
+                        w, h = struct.unpack_from(">II", data, start + 4)
+                        if w * h > width * height:
+                            width, height = w, h
+                    elif box == b"pixi":
+                        channels = data[start + 4]
+                        bit_depth = data[start + 5]
+        break
+    if not width or not height:
+        raise ProbeError("Image dimensions are not declared in the header.")
+    return ImageInfo(format, media_type, width, height, bit_depth, channels)
+
+
+def probe(data):
+    """Return the :class:`ImageInfo` of an encoded image.
+
+    Only headers are parsed. Raises :class:`ProbeError` for unknown,
+    truncated or corrupt images.
+    """
+    try:
+        if data.startswith(PNG_SIGNATURE):
+            return _probe_png(data)
+        if data.startswith(b"\xff\xd8"):
+            return _probe_jpeg(data)
+        if data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+            return _probe_webp(data)
+        if data[4:8] == b"ftyp":
+            return _probe_heif(data)
+    except (IndexError, struct.error):
+        raise ProbeError("Image is truncated.")
+    raise ProbeError("Not a JPEG, PNG, WebP, AVIF or HEIC image.")
+
+
+def check_limits(info, max_pixels=MAX_IMAGE_PIXELS):
+    if info.pixels > max_pixels:
+        raise ProbeError(
+            f"Image is {info.width}x{info.height} pixels; the maximum is {max_pixels:,} pixels."
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit(f"usage: {sys.argv[0]} IMAGE...")
+    for path in sys.argv[1:]:
+        with open(path, "rb") as f:
+            data = f.read()
+        rounds = 10000
+        start = time.perf_counter()
+        for _ in range(rounds):
+            info = probe(data)
+        elapsed = (time.perf_counter() - start) / rounds
+        print(f"{path}: {info!r}, {elapsed * 1e6:.1f} us per probe")
@@ -1,17 +1,83 @@
 import os
 import json
 import base64
-from fastapi import FastAPI, File, UploadFile, HTTPException
+import asyncio
+import math
+import time
+import logging
+from email.utils import formatdate
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import JSONResponse, HTMLResponse, PlainTextResponse, Response
 import anthropic
-from pydantic import BaseModel
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 
+import health
+import metrics
+import profiler
+import retry_policy
+import tracing
+import traffic
+import usage
+from admin import require_admin
+from analytics import ANALYTICS_RETENTION_HOURS, ANALYTICS_RING_SIZE, get_analytics
+from consensus import CONSENSUS_MAX_PHOTOS, CONSENSUS_THRESHOLD, photo_weight, run_consensus
+from credential_pool import KeysCoolingDown, get_pool
+from image_probe import ProbeError, check_limits, probe
+from prewarm import warmer
+from deadline import ANALYZE_DEADLINE_SECONDS, ClientDisconnected, Deadline, DeadlineExceeded, run_guarded
+from uploads import MAX_UPLOAD_BYTES, TUS_VERSION, UploadError, get_spool, parse_metadata
+from result_store import content_hash, difference_hash, get_store, is_valid_result
+from scheduler import PRIORITY_WEIGHTS, QueueFull, get_scheduler
+from transcode import (
+    TRANSCODE_FORMATS, TRANSCODE_MAX_EDGE, TRANSCODE_QUALITY, TranscodeError, decodable_formats, shutdown_pool,
+    transcode,
+)
+from rate_limit import RateLimitMiddleware, charge
+from usage import get_ledger, tenant_id
+
 # Load environment variables
 load_dotenv()
 
-app = FastAPI(title="Kibbe & Color Analysis")
+# Tag every log line with the id of the request that produced it
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s",
+)
+for handler in logging.getLogger().handlers:
+    handler.addFilter(tracing.RequestIdFilter())
+logger = logging.getLogger("kibbe")
+
+@asynccontextmanager
+async def lifespan(app):
+    # Open upstream connections before taking traffic, then keep them warm
+    await warmer.prewarm()
+    warmer.start()
+    # Background measurements behind /api/health/ready
+    health.monitor.start()
+    # Today's spend, then periodic usage flushes, off the request path;
+    # the last one on shutdown
+    await get_ledger().start()
+    # Removes expired resumable uploads from the spool
+    get_spool().start()
+    yield
+    await get_spool().stop()
+    await get_ledger().stop()
+    await health.monitor.stop()
+    await warmer.stop()
+    shutdown_pool()
+
+app = FastAPI(title="Kibbe & Color Analysis", lifespan=lifespan)
+
+# Per-client throttling of upstream-backed endpoints. Added before CORS so
+# that 429 responses still carry CORS headers.
+app.add_middleware(RateLimitMiddleware)
+
+# Request ids and per-stage spans (see tracing.py for export settings)
+app.add_middleware(tracing.TracingMiddleware)
 
 # Enable CORS
 app.add_middleware(
@@ -27,77 +93,305 @@ class AnalysisResult(BaseModel):
     color_season: str
     palette_description: str
 
+class HashLookup(BaseModel):
+    sha256: str = Field(pattern=r"^[0-9a-f]{64}$")
+    # 64-bit difference hash computed by the browser, as 16 hex digits
+    phash: Optional[str] = Field(default=None, pattern=r"^[0-9a-f]{16}$")
+
+MODEL = "claude-3-haiku-20240307"  # Use Haiku - faster and more reliable
+# Longest image edge sent for over-budget tenants in degraded mode
+DEGRADED_MAX_EDGE = int(os.getenv("TENANT_DEGRADED_MAX_EDGE", "512"))
+SYSTEM_PROMPT = "You are a professional stylist expert in Kibbe body typing and seasonal color analysis."
+ANALYSIS_PROMPT = "Analyze this person's facial features and overall appearance to determine their Kibbe archetype and seasonal color palette. Respond ONLY with valid JSON in this exact format: {\"kibbe_archetype\": \"[archetype]\", \"color_season\": \"[season]\", \"palette_description\": \"[description]\"}"
+
+def build_messages(media_type, base64_image):
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": media_type,
+                        "data": base64_image
+                    }
+                },
+                {
+                    "type": "text",
+                    "text": ANALYSIS_PROMPT
+                }
+            ]
+        }
+    ]
+
+async def run_analysis(contents, media_type, deadline=None, info=None,
+                       tenant="internal", degraded=False, priority="interactive"):
+    """Analyze one image with Claude and store the result.
+
+    Shared by the HTTP endpoint and the bulk tools. Raises on failure;
+    callers decide whether to fall back to a demo response. With a
+    ``deadline``, attempts are cut short and no retry is started that
+    could not finish in time. ``info`` is the image's probed header
+    (see image_probe.py); it is probed here if the caller has not. Token
+    usage is billed to ``tenant``; ``degraded`` sends a much smaller image
+    to save input tokens once that tenant is over budget. Each attempt
+    waits for a fair turn in the scheduler under ``priority``.
+    """
+    if info is None:
+        info = probe(contents)
+        check_limits(info)
+    
+    # AVIF/HEIC are re-encoded in the transcode pool; the store stays keyed
+    # by the hash of the bytes the client sent
+    with tracing.span("transcode") as span:
+        span.set("format", info.format)
+        upstream_bytes, info = await transcode(
+            contents, info, max_edge=DEGRADED_MAX_EDGE if degraded else None
+        )
+        span.set("upstream_format", info.format)
+    media_type = info.media_type
+    
+    # Convert to base64
+    with tracing.span("preprocess") as span:
+        span.set("width", info.width)
+        span.set("height", info.height)
+        base64_image = base64.b64encode(upstream_bytes).decode()
+    
+    result_json = await analyze_encoded(base64_image, media_type, deadline, tenant, priority)
+    
+    # Remember the result so bulk jobs and repeat uploads can reuse it
+    if is_valid_result(result_json):
+        with tracing.span("store"):
+            # Computed from the bytes analyzed: a client-supplied hash could
+            # attach this result to anyone's lookups
+            phash = await asyncio.to_thread(difference_hash, upstream_bytes)
+            get_store().put(content_hash(contents), result_json, model=MODEL, phash=phash)
+            traffic.note_phash(phash)
+    
+    return result_json
+
+async def analyze_encoded(base64_image, media_type, deadline=None, tenant="internal", priority="interactive"):
+    """Send one image, already in an upstream format and base64-encoded,
+    to Claude and return the parsed answer; nothing is stored. The bulk
+    tool prepares images in worker processes and calls this directly;
+    arguments are as for :func:`run_analysis`."""
+    # Upstream keys, each with its own pooled client
+    pool = get_pool()
+    scheduler = get_scheduler()
+    
+    # Make API call to Claude Vision, retrying per retry_policy
+    retry_policy.record_call()
+    with tracing.span("upstream") as upstream_span:
+        attempt = 0
+        while True:
+            try:
+                # No call while every key is rate limited, then wait for a
+                # fair turn at the upstream; retries queue again
+                await pool.ready(deadline)
+                async with scheduler.slot(tenant, priority) as waited:
+                    # Each attempt goes to the key with the most rate-limit headroom
+                    slot = pool.acquire()
+                    with tracing.span("upstream.attempt") as attempt_span:
+                        attempt_span.set("attempt", attempt + 1)
+                        attempt_span.set("key", slot.name)
+                        attempt_span.set("priority", priority)
+                        attempt_span.set("queue_ms", round(waited * 1000))
+                        slot.in_flight += 1
+                        call_start = time.perf_counter()
+                        try:
+                            raw = await slot.client.messages.with_raw_response.create(
+                                model=MODEL,
+                                max_tokens=300,
+                                temperature=0.3,
+                                system=SYSTEM_PROMPT,
+                                messages=build_messages(media_type, base64_image),
+                                extra_headers={"X-Request-ID": tracing.request_id_var.get()},
+                                timeout=min(60.0, deadline.remaining()) if deadline else 60.0,
+                            )
+                        finally:
+                            slot.in_flight -= 1
+                pool.update(slot, raw.headers)
+                response = raw.parse()
+                cost = get_ledger().record(
+                    tenant, MODEL, response.usage.input_tokens, response.usage.output_tokens
+                )
+                upstream_span.set("input_tokens", response.usage.input_tokens)
+                upstream_span.set("output_tokens", response.usage.output_tokens)
+                upstream_span.set("cost_usd", cost)
+                traffic.note(
+                    upstream_ms=round((time.perf_counter() - call_start) * 1000, 1),
+                    queue_ms=round(waited * 1000, 1),
+                    attempts=attempt + 1,
+                )
+                break  # Success, exit retry loop
+            except asyncio.CancelledError:
+                # Deadline passed or client left while the call was in flight
+                metrics.incr("upstream_attempts_cancelled")
+                raise
+            except (QueueFull, KeysCoolingDown):
+                raise
+            except Exception as error:
+                error_class, retryable = retry_policy.classify(error)
+                headers = error.response.headers if isinstance(error, anthropic.APIStatusError) else None
+                retry_after = retry_policy.parse_retry_after(headers.get("retry-after")) if headers else None
+                if error_class == "rate_limit":
+                    # The 429 is about this key; another one may be free now
+                    pool.cooldown(slot, headers)
+                    retry_after = pool.wait_time()
+                logger.warning("Upstream attempt %d failed (%s): %s", attempt + 1, error_class, error)
+                delay = retry_policy.next_delay(attempt, error_class, retryable, retry_after, deadline)
+                if delay is None:
+                    raise
+                with tracing.span("retry_wait") as wait_span:
+                    wait_span.set("delay_ms", round(delay * 1000))
+                    await asyncio.sleep(delay)
+                attempt += 1
+        upstream_span.set("attempts", attempt + 1)
+    
+    # Parse Claude's response
+    with tracing.span("parse"):
+        result_text = response.content[0].text
+        return json.loads(result_text)
+
+@app.get("/api/config/upload")
+async def upload_config():
+    # How clients should shrink photos before uploading. A JPEG/PNG/WebP no
+    # larger than max_edge is sent upstream exactly as uploaded, so a photo
+    # prepared this way is never decoded or re-encoded on the server.
+    return JSONResponse(
+        content={
+            "max_edge": TRANSCODE_MAX_EDGE,
+            "formats": [f"image/{f}" for f in TRANSCODE_FORMATS],
+            "quality": TRANSCODE_QUALITY / 100,
+            "max_bytes": MAX_UPLOAD_BYTES,
+        },
+        headers={"Cache-Control": "public, max-age=3600"},
+    )
+
+@app.post("/api/analyze/lookup")
+async def lookup_analysis(lookup: HashLookup):
+    # Hash-first protocol: clients send the image hash before uploading and
+    # only upload the bytes on a 404
+    store = get_store()
+    result = store.get(lookup.sha256)
+    if result is None and lookup.phash:
+        result = store.get_by_phash(lookup.phash)
+    if result is None:
+        metrics.incr("lookup_misses")
+        raise HTTPException(status_code=404, detail="No stored analysis for this image.")
+    metrics.incr("lookup_hits")
+    get_analytics().record(MODEL, "cache_hit", result)
+    return JSONResponse(content=result, headers={"X-Cache": "hit"})
+
 @app.post("/api/analyze")
-async def analyze_image(file: UploadFile = File(...)):
+async def analyze_image(
+    request: Request,
+    file: UploadFile = File(...),
+):
+    deadline = Deadline.from_request(request)
+    with tracing.span("upload") as span:
+        contents = await file.read()
+        span.set("bytes", len(contents))
+    # Request shape for replays, when TRAFFIC_CAPTURE_PATH is set
+    with traffic.capture(request, contents) as captured:
+        response = await analyze_upload(
+            contents, file.content_type, deadline, request, tenant_id(request), request_priority(request)
+        )
+        captured.finish(response)
+    return response
+
+def request_priority(request):
+    # Clients may move their own bulk traffic out of the way with
+    # X-Priority: batch|background; nobody can ask for more than interactive
+    priority = request.headers.get("x-priority", "interactive")
+    return priority if priority in PRIORITY_WEIGHTS else "interactive"
+
+def validate_image(contents, content_type):
+    """Check an uploaded image and return its probed ImageInfo; raises
+    HTTPException for anything that should not be analyzed."""
     # Validate file size (5MB limit)
-    contents = await file.read()
-    if len(contents) > 5 * 1024 * 1024:
+    if len(contents) > MAX_UPLOAD_BYTES:
         raise HTTPException(status_code=413, detail="File too large. Maximum size is 5MB.")
     
-    # Validate file type
-    if file.content_type not in ["image/jpeg", "image/png"]:
-        raise HTTPException(status_code=400, detail="Invalid file type. Only JPG/PNG allowed.")
+    # Validate file type. The format itself is sniffed by the probe below;
+    # browsers often send HEIC as application/octet-stream.
+    if content_type and not (content_type.startswith("image/") or content_type == "application/octet-stream"):
+        raise HTTPException(status_code=400, detail="Invalid file type. Only images are allowed.")
+    
+    # Read dimensions from the headers alone and refuse decompression bombs
+    # before any stage decodes the pixels
+    with tracing.span("probe") as span:
+        try:
+            info = probe(contents)
+            span.set("pixels", info.pixels)
+            check_limits(info)
+        except ProbeError as e:
+            metrics.incr("analyze_rejected_probe")
+            raise HTTPException(status_code=400, detail=str(e))
+    if info.format not in decodable_formats():
+        raise HTTPException(status_code=415, detail=f"{info.format.upper()} images are not supported on this server.")
+    return info
+
+def budget_exhausted():
+    return HTTPException(
+        status_code=429,
+        detail="Daily analysis budget used up. Previously analyzed photos are still available.",
+        headers={"Retry-After": str(math.ceil(usage.seconds_until_reset()))},
+    )
+
+async def analyze_upload(contents, content_type, deadline, request=None, tenant="internal",
+                         priority="interactive"):
+    """Validate an uploaded image and analyze it, answering from the result
+    store when possible. With a ``request``, the upstream call is cancelled
+    if that client disconnects. Over-budget tenants get stored results only,
+    or a degraded analysis (see TENANT_BUDGET_MODE in usage.py)."""
+    info = validate_image(contents, content_type)
+    metrics.incr("analyze_upload_bytes", len(contents))
+    
+    # Repeat uploads are answered from the result store
+    cached = get_store().get(content_hash(contents))
+    if cached is not None:
+        metrics.incr("analyze_cache_hits")
+        get_analytics().record(MODEL, "cache_hit", cached)
+        return JSONResponse(content=cached, headers={"X-Cache": "hit"})
+    
+    mode = get_ledger().mode(tenant)
+    if mode == "cache_only":
+        raise budget_exhausted()
     
     try:
-        # Convert to base64
-        base64_image = base64.b64encode(contents).decode()
-        
-        # Initialize Claude client
-        api_key = os.getenv("CLAUDE_API_KEY")
-        if not api_key:
-            raise HTTPException(status_code=500, detail="Claude API key not configured")
-        
-        client = anthropic.Anthropic(
-            api_key=api_key,
-            timeout=60.0  # 60 second timeout
+        # Stop paying for the upstream call once nobody will read the answer
+        result_json = await run_guarded(
+            run_analysis(contents, info.media_type, deadline, info, tenant, mode == "degraded", priority),
+            request, deadline,
         )
+        get_analytics().record(MODEL, "analyzed", result_json)
+        headers = {"X-Cache": "miss"}
+        if mode == "degraded":
+            headers["X-Budget-Mode"] = "degraded"
+        return JSONResponse(content=result_json, headers=headers)
         
-        # Make API call to Claude Vision with retry logic
-        import time
-        max_retries = 2
-        for attempt in range(max_retries):
-            try:
-                response = client.messages.create(
-                    model="claude-3-haiku-20240307",  # Use Haiku - faster and more reliable
-                    max_tokens=300,
-                    temperature=0.3,
-                    system="You are a professional stylist expert in Kibbe body typing and seasonal color analysis.",
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "image",
-                                    "source": {
-                                        "type": "base64",
-                                        "media_type": file.content_type,
-                                        "data": base64_image
-                                    }
-                                },
-                                {
-                                    "type": "text",
-                                    "text": "Analyze this person's facial features and overall appearance to determine their Kibbe archetype and seasonal color palette. Respond ONLY with valid JSON in this exact format: {\"kibbe_archetype\": \"[archetype]\", \"color_season\": \"[season]\", \"palette_description\": \"[description]\"}"
-                                }
-                            ]
-                        }
-                    ]
-                )
-                break  # Success, exit retry loop
-            except Exception as retry_error:
-                if attempt == max_retries - 1:  # Last attempt
-                    raise retry_error
-                time.sleep(2)  # Wait 2 seconds before retry
-        
-        # Parse Claude's response
-        result_text = response.content[0].text
-        result_json = json.loads(result_text)
-        
-        return JSONResponse(content=result_json)
-        
+    except DeadlineExceeded:
+        raise HTTPException(status_code=504, detail="Analysis timed out. Please try again.")
+    except TranscodeError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except QueueFull:
+        raise HTTPException(status_code=503, detail="Server is busy. Please try again shortly.",
+                            headers={"Retry-After": "5"})
+    except KeysCoolingDown as e:
+        raise HTTPException(status_code=503, detail="Analysis is rate limited right now. Please try again shortly.",
+                            headers={"Retry-After": str(math.ceil(e.retry_after))})
+    except ClientDisconnected:
+        return Response(status_code=499)
     except json.JSONDecodeError:
         raise HTTPException(status_code=500, detail="Failed to parse Claude's response")
     except anthropic.APIError as e:
         # If Claude API fails, return a demo response for testing
+        logger.error("Claude API error, returning demo response: %s", e)
+        with tracing.span("fallback"):
+            tracing.mark_error(f"api_error: {e}")
+        get_analytics().record(MODEL, "fallback")
         return JSONResponse(content={
             "kibbe_archetype": "Soft Natural", 
             "color_season": "Warm Autumn",
@@ -105,15 +399,275 @@ async def analyze_image(file: UploadFile = File(...)):
         })
     except Exception as e:
         # Return demo response for any other error
+        logger.exception("Analysis failed, returning demo response")
+        with tracing.span("fallback"):
+            tracing.mark_error(f"{type(e).__name__}: {e}")
+        get_analytics().record(MODEL, "fallback")
         return JSONResponse(content={
             "kibbe_archetype": "Classic", 
             "color_season": "True Winter",
             "palette_description": "Your true winter palette features bold, clear colors like pure white, black, royal blue, and bright red. These high-contrast colors complement your natural clarity. Note: This is a demo response due to technical issues."
         })
 
+@app.post("/api/analyze/consensus")
+async def analyze_consensus(request: Request, files: List[UploadFile] = File(...)):
+    # Several photos of one person, reconciled by a weighted vote. Photos
+    # are analyzed concurrently and the rest are skipped or cancelled once
+    # the labels agree (see consensus.py).
+    if len(files) > CONSENSUS_MAX_PHOTOS:
+        raise HTTPException(status_code=400, detail=f"Send at most {CONSENSUS_MAX_PHOTOS} photos.")
+    deadline = Deadline.from_request(request)
+    tenant = tenant_id(request)
+    priority = request_priority(request)
+    store = get_store()
+    photos, known, seen = [], [], set()
+    with tracing.span("upload") as span:
+        for file in files:
+            contents = await file.read()
+            try:
+                info = validate_image(contents, file.content_type)
+            except HTTPException as e:
+                raise HTTPException(status_code=e.status_code, detail=f"{file.filename}: {e.detail}")
+            sha256 = content_hash(contents)
+            if sha256 in seen:
+                continue  # the same photo twice is still one vote
+            seen.add(sha256)
+            cached = store.get(sha256)
+            if cached is not None:
+                with traffic.capture(request, contents):
+                    traffic.note(status=200, cache="hit")
+                known.append((photo_weight(info), cached))
+            else:
+                photos.append((photo_weight(info), (contents, info)))
+        span.set("photos", len(seen))
+    
+    mode = get_ledger().mode(tenant)
+    if mode == "cache_only":
+        if not known:
+            raise budget_exhausted()
+        photos = []  # vote with the stored results only
+    
+    # The rate limiter charged this request for one upstream call; every
+    # further photo analyzed is charged on its own, and fails when the
+    # client's bucket is empty
+    prepaid = 1
+    throttled = []
+
+    async def analyze(photo):
+        nonlocal prepaid
+        contents, info = photo
+        # One capture line per photo, like the /api/analyze requests
+        # replays stand them in for
+        with traffic.capture(request, contents):
+            if prepaid:
+                prepaid -= 1
+            else:
+                wait = charge(request.scope)
+                if wait:
+                    throttled.append(wait)
+                    raise HTTPException(status_code=429, detail="Too many requests. Please slow down.")
+            try:
+                result = await run_analysis(
+                    contents, info.media_type, deadline, info=info, tenant=tenant,
+                    degraded=mode == "degraded", priority=priority,
+                )
+            except Exception as e:
+                logger.warning("Consensus photo failed: %s", e)
+                raise
+            if not is_valid_result(result):
+                raise ValueError("Incomplete analysis result")
+            traffic.note(status=200, cache="miss")
+            return result
+    
+    try:
+        with tracing.span("consensus") as span:
+            tally, stats = await run_guarded(run_consensus(photos, analyze, known), request, deadline)
+            span.set("analyzed", stats["analyzed"])
+            span.set("skipped", stats["skipped"] + stats["cancelled"])
+    except DeadlineExceeded:
+        raise HTTPException(status_code=504, detail="Analysis timed out. Please try again.")
+    except ClientDisconnected:
+        return Response(status_code=499)
+    if not tally.results:
+        if throttled:
+            raise HTTPException(
+                status_code=429, detail="Too many requests. Please slow down.",
+                headers={"Retry-After": str(math.ceil(min(throttled)))},
+            )
+        raise HTTPException(status_code=502, detail="Analysis failed for every photo. Please try again.")
+    result = tally.result()
+    get_analytics().record(MODEL, "analyzed" if stats["analyzed"] else "cache_hit", result)
+    return {
+        **result,
+        "consensus": {
+            "reached": tally.reached(CONSENSUS_THRESHOLD),
+            "threshold": CONSENSUS_THRESHOLD,
+            "agreement": tally.agreement(),
+            **stats,
+        },
+        "budget_mode": mode,
+    }
+
+# Resumable uploads (tus-style create / HEAD / PATCH). Analysis starts by
+# itself when the last chunk lands.
+_upload_tasks = {}
+
+@app.exception_handler(UploadError)
+async def upload_error_handler(request: Request, exc: UploadError):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+        headers={"Tus-Resumable": TUS_VERSION},
+    )
+
+def _upload_headers(upload):
+    return {
+        "Tus-Resumable": TUS_VERSION,
+        "Upload-Offset": str(upload.offset),
+        "Upload-Length": str(upload.length),
+        "Upload-Expires": formatdate(upload.expires_at, usegmt=True),
+        "Cache-Control": "no-store",
+    }
+
+@app.post("/api/uploads")
+async def create_upload(request: Request):
+    try:
+        length = int(request.headers["upload-length"])
+    except (KeyError, ValueError):
+        raise UploadError(400, "Upload-Length header is required.")
+    metadata = parse_metadata(request.headers.get("upload-metadata"))
+    upload = await get_spool().create(length, metadata.get("filetype"))
+    headers = _upload_headers(upload)
+    headers["Location"] = f"/api/uploads/{upload.id}"
+    return Response(status_code=201, headers=headers)
+
+@app.head("/api/uploads/{upload_id}")
+async def upload_offset(upload_id: str):
+    return Response(status_code=200, headers=_upload_headers(await get_spool().get(upload_id)))
+
+@app.patch("/api/uploads/{upload_id}")
+async def upload_chunk(upload_id: str, request: Request):
+    if request.headers.get("content-type") != "application/offset+octet-stream":
+        raise UploadError(415, "Content-Type must be application/offset+octet-stream.")
+    try:
+        offset = int(request.headers["upload-offset"])
+    except (KeyError, ValueError):
+        raise UploadError(400, "Upload-Offset header is required.")
+    spool = get_spool()
+    upload = await spool.get(upload_id)
+    chunk = await _read_chunk(request, max(upload.length - offset, 0))
+    upload = await spool.append(upload_id, offset, chunk)
+    if not upload.complete:
+        return Response(status_code=204, headers=_upload_headers(upload))
+
+    # Last chunk: hand the bytes to the analyzer and free the spool. The
+    # analysis is not tied to this connection, so if the client drops now it
+    # can still fetch the result with GET.
+    contents = await spool.read(upload_id)
+    await spool.finish(upload_id, content_hash(contents))
+    task = asyncio.create_task(analyze_completed_upload(contents, upload, request))
+    _upload_tasks[upload_id] = task
+    task.add_done_callback(lambda _: _upload_tasks.pop(upload_id, None))
+    response = await asyncio.shield(task)
+    response.headers.update(_upload_headers(upload))
+    return response
+
+async def _read_chunk(request, limit):
+    # A chunk can be at most what is left of the declared Upload-Length;
+    # larger bodies are refused up front, or as soon as they run over
+    declared = request.headers.get("content-length")
+    if declared is not None and declared.isdigit() and int(declared) > limit:
+        raise UploadError(413, "Chunk exceeds the declared Upload-Length.")
+    chunk = bytearray()
+    async for part in request.stream():
+        chunk += part
+        if len(chunk) > limit:
+            raise UploadError(413, "Chunk exceeds the declared Upload-Length.")
+    return bytes(chunk)
+
+async def analyze_completed_upload(contents, upload, request):
+    # Captured like /api/analyze, from the last chunk on, so replays see the
+    # browser traffic that comes in through resumable uploads too
+    with traffic.capture(request, contents) as captured:
+        response = await analyze_upload(
+            contents, upload.content_type, Deadline(ANALYZE_DEADLINE_SECONDS),
+            tenant=tenant_id(request), priority=request_priority(request),
+        )
+        captured.finish(response)
+    return response
+
+@app.get("/api/uploads/{upload_id}")
+async def upload_result(upload_id: str):
+    upload = await get_spool().get(upload_id)
+    if upload.sha256 is None:
+        raise UploadError(409, "Upload is not complete yet.")
+    task = _upload_tasks.get(upload_id)
+    if task is not None:
+        return await asyncio.shield(task)
+    result = get_store().get(upload.sha256)
+    if result is None:
+        raise UploadError(404, "No stored analysis for this upload.")
+    return JSONResponse(content=result, headers={"X-Cache": "hit"})
+
 @app.get("/api/health")
 async def health_check():
-    return {"status": "healthy", "api_key_present": bool(os.getenv("CLAUDE_API_KEY"))}
+    return {"status": "healthy", "api_key_present": bool(os.getenv("CLAUDE_API_KEY") or os.getenv("CLAUDE_API_KEYS"))}
+
+@app.get("/api/health/live")
+async def liveness():
+    # Answering at all means the process and its event loop are alive
+    return {"status": "alive"}
+
+@app.get("/api/health/ready")
+async def readiness():
+    # Whether to route new traffic here; 503 when saturated or cut off
+    report = health.monitor.readiness()
+    return JSONResponse(content=report, status_code=200 if report["ready"] else 503,
+                        headers={"Cache-Control": "no-store"})
+
+@app.get("/api/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
+@app.get("/admin/usage", dependencies=[Depends(require_admin)])
+async def admin_usage(
+    day: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    tenant: Optional[str] = None,
+):
+    # Token usage and cost per tenant and model for one UTC day (default today)
+    return await get_ledger().report(day, tenant)
+
+@app.get("/admin/analytics", dependencies=[Depends(require_admin)])
+async def admin_analytics(
+    hours: int = Query(24, ge=1, le=ANALYTICS_RETENTION_HOURS),
+    model: Optional[str] = None,
+    recent: int = Query(0, ge=0, le=ANALYTICS_RING_SIZE),
+):
+    # Archetype and season distributions, cache hits and the demo-fallback
+    # rate over the last `hours` hours, from this worker's hourly counters
+    analytics = get_analytics()
+    report = analytics.query(hours, model)
+    if recent:
+        report["recent"] = analytics.recent(recent)
+    return report
+
+@app.get("/debug/profile", dependencies=[Depends(require_admin)])
+async def debug_profile(
+    seconds: float = Query(10, gt=0, le=60),
+    mode: str = Query("cpu", pattern="^(cpu|wall|alloc)$"),
+    block_ms: float = Query(100, gt=0),
+    top: int = Query(20, ge=1, le=200),
+    format: str = Query("json", pattern="^(json|collapsed)$"),
+):
+    # Attach a sampling profiler to this worker. Event-loop stalls longer
+    # than block_ms are reported with the stack that caused them.
+    try:
+        report = await profiler.profile(seconds, mode, block_ms, top)
+    except profiler.ProfileBusy:
+        raise HTTPException(status_code=409, detail="A profile is already running.")
+    if format == "collapsed":
+        return PlainTextResponse("\n".join(report["collapsed"]) + "\n")
+    return report
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -270,8 +824,8 @@ async def get_frontend():
                 <div class="upload-icon">📸</div>
                 <div class="upload-text">Upload Your Photo</div>
                 <div class="upload-desc">Drag and drop or click to select your image</div>
-                <div class="upload-details">Supports JPG, PNG • Maximum 5MB</div>
-                <input type="file" id="fileInput" accept="image/jpeg,image/png" style="display: none;" onchange="handleFile(this)">
+                <div class="upload-details">Supports JPG, PNG, WebP, HEIC • Large photos are resized for you</div>
+                <input type="file" id="fileInput" accept="image/jpeg,image/png,image/webp,image/avif,image/heic,image/heif,.heic,.heif" style="display: none;" onchange="handleFile(this)">
                 <img id="preview" class="hidden">
             </div>
             
@@ -290,8 +844,9 @@ async def get_frontend():
                 const file = input.files[0];
                 if (!file) return;
 
-                if (file.size > 5 * 1024 * 1024) {
-                    showError('File size exceeds 5MB limit');
+                // Photos are shrunk before upload; only the upload must fit in 5MB
+                if (file.size > 50 * 1024 * 1024) {
+                    showError('File size exceeds 50MB limit');
                     return;
                 }
 
@@ -303,6 +858,144 @@ async def get_frontend():
                 hideError();
             }
 
+            async function sha256Hex(file) {
+                const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+                return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+            }
+
+            // 64-bit difference hash of a 9x8 grayscale thumbnail; stays the
+            // same when a photo is re-encoded or resized
+            async function differenceHash(file) {
+                const bitmap = await createImageBitmap(file);
+                const canvas = document.createElement('canvas');
+                canvas.width = 9;
+                canvas.height = 8;
+                const ctx = canvas.getContext('2d');
+                ctx.drawImage(bitmap, 0, 0, 9, 8);
+                const px = ctx.getImageData(0, 0, 9, 8).data;
+                const gray = i => px[i] * 0.299 + px[i + 1] * 0.587 + px[i + 2] * 0.114;
+                let hex = '';
+                for (let row = 0; row < 8; row++) {
+                    let byte = 0;
+                    for (let col = 0; col < 8; col++) {
+                        const i = (row * 9 + col) * 4;
+                        byte = (byte << 1) | (gray(i) > gray(i + 4) ? 1 : 0);
+                    }
+                    hex += byte.toString(16).padStart(2, '0');
+                }
+                return hex;
+            }
+
+            // Hash-first upload: ask whether this photo was already analyzed
+            // and only send the bytes on a miss
+            async function lookupAnalysis(file) {
+                if (!window.crypto || !crypto.subtle) return { result: null };  // needs https or localhost
+                try {
+                    const [sha256, phash] = await Promise.all([
+                        sha256Hex(file),
+                        differenceHash(file).catch(() => null)
+                    ]);
+                    const response = await fetch('/api/analyze/lookup', {
+                        method: 'POST',
+                        headers: { 'Content-Type': 'application/json' },
+                        body: JSON.stringify({ sha256, phash })
+                    });
+                    return { result: response.ok ? await response.json() : null };
+                } catch (err) {
+                    return { result: null };
+                }
+            }
+
+            // Server-driven pre-shrinking: scale and re-encode the photo to the
+            // size and format the server sends upstream untouched
+            let uploadConfig = null;
+
+            async function shrinkForUpload(file) {
+                if (typeof OffscreenCanvas === 'undefined') return file;
+                try {
+                    uploadConfig = uploadConfig || fetch('/api/config/upload').then(r => r.ok ? r.json() : null).catch(() => null);
+                    const config = await uploadConfig;
+                    if (!config) return file;
+                    const bitmap = await createImageBitmap(file);  // fails for HEIC outside Safari
+                    const scale = Math.min(1, config.max_edge / Math.max(bitmap.width, bitmap.height));
+                    if (scale === 1 && config.formats.includes(file.type)) return file;
+                    const canvas = new OffscreenCanvas(Math.round(bitmap.width * scale), Math.round(bitmap.height * scale));
+                    const ctx = canvas.getContext('2d');
+                    ctx.imageSmoothingQuality = 'high';
+                    ctx.drawImage(bitmap, 0, 0, canvas.width, canvas.height);
+                    for (const type of config.formats) {
+                        const blob = await canvas.convertToBlob({ type, quality: config.quality });
+                        // Browsers that cannot encode a type return PNG instead
+                        if (blob.type === type) return blob.size < file.size ? blob : file;
+                    }
+                } catch (err) {
+                    // Undecodable here; the server transcodes it
+                }
+                return file;
+            }
+
+            // Resumable upload against /api/uploads (tus-style): after a
+            // dropped connection only the missing part is re-sent
+            const CHUNK_SIZE = 256 * 1024;
+            const TUS_HEADERS = { 'Tus-Resumable': '1.0.0' };
+
+            async function readJson(response, fallbackMessage) {
+                const data = await response.json().catch(() => ({}));
+                if (!response.ok) throw new Error(data.detail || fallbackMessage);
+                return data;
+            }
+
+            async function serverOffset(url) {
+                const response = await fetch(url, { method: 'HEAD', headers: TUS_HEADERS });
+                if (!response.ok) throw new Error('Upload expired, please try again');
+                return Number(response.headers.get('Upload-Offset'));
+            }
+
+            async function uploadResumable(file) {
+                const metadata = ['filetype ' + btoa(file.type)];
+                const created = await fetch('/api/uploads', {
+                    method: 'POST',
+                    headers: { ...TUS_HEADERS, 'Upload-Length': String(file.size), 'Upload-Metadata': metadata.join(',') }
+                });
+                if (created.status !== 201) await readJson(created, 'Upload failed');
+                const url = created.headers.get('Location');
+
+                let offset = 0;
+                let failures = 0;
+                for (;;) {
+                    let response;
+                    try {
+                        if (offset >= file.size) {
+                            // Last chunk arrived but its response was lost
+                            response = await fetch(url);
+                        } else {
+                            response = await fetch(url, {
+                                method: 'PATCH',
+                                headers: {
+                                    ...TUS_HEADERS,
+                                    'Content-Type': 'application/offset+octet-stream',
+                                    'Upload-Offset': String(offset)
+                                },
+                                body: file.slice(offset, offset + CHUNK_SIZE)
+                            });
+                        }
+                    } catch (err) {
+                        if (++failures > 5) throw err;
+                        await new Promise(resolve => setTimeout(resolve, 500 * 2 ** failures));
+                        offset = await serverOffset(url).catch(() => offset);
+                        continue;
+                    }
+                    failures = 0;
+                    if (response.status === 204) {
+                        offset = Number(response.headers.get('Upload-Offset'));
+                    } else if (response.status === 409) {
+                        offset = await serverOffset(url);
+                    } else {
+                        return readJson(response, 'Analysis failed');
+                    }
+                }
+            }
+
             async function analyzeImage() {
                 if (!selectedFile) return;
 
@@ -311,21 +1004,20 @@ async def get_frontend():
                 btn.disabled = true;
                 btn.classList.add('loading');
 
-                const formData = new FormData();
-                formData.append('file', selectedFile);
-
                 try {
-                    const response = await fetch('/api/analyze', {
-                        method: 'POST',
-                        body: formData
-                    });
-
-                    if (!response.ok) {
-                        const error = await response.json();
-                        throw new Error(error.detail || 'Analysis failed');
+                    // Results are stored under the hash of the bytes the server
+                    // received, so look up exactly what would be uploaded
+                    const upload = await shrinkForUpload(selectedFile);
+                    const lookup = await lookupAnalysis(upload);
+                    if (lookup.result) {
+                        showResults(lookup.result);
+                        return;
                     }
 
-                    const data = await response.json();
+                    if (upload.size > 5 * 1024 * 1024) throw new Error('File size exceeds 5MB limit');
+
+                    // Chunked, resumable upload; analysis starts when the last chunk lands
+                    const data = await uploadResumable(upload);
                     showResults(data);
                 } catch (err) {
                     showError(err.message);
@@ -0,0 +1,22 @@
+from collections import defaultdict
+
+# Process-wide counters and gauges, exposed at /api/metrics.
+# Counters are plain ints bumped from the event loop; gauges are callables
+# evaluated only when a snapshot is taken, so they cost nothing per request.
+_counters = defaultdict(int)
+_gauges = {}
+
+
+def incr(name, value=1):
+    _counters[name] += value
+
+
+def register_gauge(name, fn):
+    _gauges[name] = fn
+
+
+def snapshot():
+    data = dict(_counters)
+    for name, fn in _gauges.items():
+        data[name] = fn()
+    return data
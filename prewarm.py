@@ -0,0 +1,143 @@
+import asyncio
+import contextlib
+import logging
+import os
+import time
+
+import httpx
+
+import metrics
+from credential_pool import get_pool
+
+# Upstream connections opened before the first request and kept open while
+# traffic is quiet, so no analysis pays for DNS, TCP and TLS on a fresh
+# connection. Warming uses HEAD requests to the API root: the upstream
+# answers them without authentication and no tokens are spent.
+# Connections per key opened at start-up and kept warm afterwards
+UPSTREAM_PREWARM_CONNECTIONS = int(os.getenv("UPSTREAM_PREWARM_CONNECTIONS", "4"))
+# How long start-up waits for warming before serving anyway
+UPSTREAM_PREWARM_TIMEOUT = float(os.getenv("UPSTREAM_PREWARM_TIMEOUT", "10"))
+# Well below UPSTREAM_KEEPALIVE_EXPIRY and the idle timeouts of load
+# balancers and NAT gateways on the way (typically 60-350s)
+UPSTREAM_KEEPALIVE_SECONDS = float(os.getenv("UPSTREAM_KEEPALIVE_SECONDS", "20"))
+
+logger = logging.getLogger(__name__)
+
+
+class _Round:
+    # Releases the pings of one key together once all of them have answered
+    # or failed
+    def __init__(self, size):
+        self.waiting = size
+        self.released = asyncio.Event()
+
+    async def arrive(self, wait=True):
+        self.waiting -= 1
+        if self.waiting <= 0:
+            self.released.set()
+        elif wait:
+            # Bounded, in case another ping of the round hangs
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.released.wait(), 5.0)
+
+
+class ConnectionWarmer:
+    def __init__(self, connections=UPSTREAM_PREWARM_CONNECTIONS):
+        self.connections = connections
+        self.warmed_at = None
+        self.last_ping_ms = None
+        self._task = None
+
+    async def _ping(self, slot, batch):
+        start = time.perf_counter()
+        ok = False
+        try:
+            async with slot.http.stream(
+                "HEAD", slot.client.base_url, timeout=5.0, extensions={"prewarm": True}
+            ) as response:
+                # Any answer means the connection works. It stays busy until
+                # every ping of the round has one, so each ping goes over a
+                # different connection instead of reusing the first one freed;
+                # reading the (empty) body then hands it back to the pool.
+                ok = True
+                self.last_ping_ms = round((time.perf_counter() - start) * 1000, 1)
+                await batch.arrive()
+                await response.aread()
+        except httpx.HTTPError as e:
+            metrics.incr("upstream_warm_ping_failed")
+            logger.debug("Warm-up ping failed on %s: %s", slot.name, e)
+        except Exception:
+            metrics.incr("upstream_warm_ping_failed")
+            logger.exception("Warm-up ping failed on %s", slot.name)
+        finally:
+            if not ok:
+                await batch.arrive(wait=False)
+        return ok
+
+    async def warm(self):
+        """Bring every key up to ``connections`` open connections; returns
+        how many pings succeeded.
+
+        Connections busy with real requests count towards the target and
+        are left alone; the rest of the pool is refreshed, and replaced
+        where the upstream or something on the way has closed it.
+        """
+        try:
+            slots = get_pool().slots
+        except RuntimeError:
+            return 0  # no API key configured
+        pings = []
+        for slot in slots:
+            count = max(0, self.connections - slot.in_flight)
+            batch = _Round(count)
+            pings.extend(self._ping(slot, batch) for _ in range(count))
+        ok = sum(await asyncio.gather(*pings))
+        metrics.incr("upstream_warm_pings", len(pings))
+        self.warmed_at = time.monotonic()
+        return ok
+
+    async def prewarm(self, timeout=UPSTREAM_PREWARM_TIMEOUT):
+        # Run from the app lifespan: the server starts accepting requests
+        # once this returns
+        if self.connections <= 0:
+            return
+        start = time.perf_counter()
+        try:
+            ok = await asyncio.wait_for(self.warm(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Upstream warm-up did not finish within %.0fs", timeout)
+            return
+        logger.info("Opened %d warm upstream connections in %.0f ms", ok, (time.perf_counter() - start) * 1000)
+
+    def start(self):
+        if self.connections > 0:
+            self._task = asyncio.create_task(self._keep_alive())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _keep_alive(self):
+        while True:
+            await asyncio.sleep(UPSTREAM_KEEPALIVE_SECONDS)
+            try:
+                await self.warm()
+            except Exception:
+                # Letting it out would end the loop and let every idle
+                # connection expire unnoticed; try again next round
+                metrics.incr("upstream_warm_failed")
+                logger.exception("Keeping upstream connections warm failed")
+
+    def stats(self):
+        return {
+            "target_per_key": self.connections,
+            "warmed_seconds_ago": (
+                round(time.monotonic() - self.warmed_at, 1) if self.warmed_at is not None else None
+            ),
+            "last_ping_ms": self.last_ping_ms,
+        }
+
+
+warmer = ConnectionWarmer()
+metrics.register_gauge("upstream_warm", warmer.stats)
@@ -0,0 +1,192 @@
+import asyncio
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5")) / 1000
+MAX_STACK_DEPTH = 64
+
+_lock = asyncio.Lock()
+
+
+class ProfileBusy(Exception):
+    pass
+
+
+def _collapse(frame, prefix=""):
+    # Render a frame chain root-first in collapsed-stack format
+    # ("a;b;c"), which flamegraph.pl and speedscope read directly.
+    parts = []
+    while frame is not None and len(parts) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    parts.reverse()
+    if prefix:
+        parts.insert(0, prefix)
+    return ";".join(parts)
+
+
+class _WallSampler:
+    """Samples every thread's stack on a fixed interval, whether it is
+    running or waiting."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+
+    def run(self, seconds):
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                self.stacks[_collapse(frame, names.get(ident, str(ident)))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+
+class _CpuSampler:
+    """SIGPROF-driven sampler: the timer only advances while the process
+    burns CPU, so idle waits never show up. Samples the main thread, which
+    is where uvicorn runs the event loop."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+
+    def _handler(self, signum, frame):
+        self.stacks[_collapse(frame, "MainThread")] += 1
+        self.samples += 1
+
+    def start(self):
+        self._previous = signal.signal(signal.SIGPROF, self._handler)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous)
+
+
+class _LoopWatchdog:
+    """Detects event-loop stalls longer than ``threshold`` seconds.
+
+    A heartbeat task ticks on the loop; a watcher thread notices when the
+    heartbeat stops and grabs the loop thread's stack while it is still
+    blocked, so the report points at the offending call.
+    """
+
+    def __init__(self, threshold, max_events=50):
+        self.threshold = threshold
+        self.max_events = max_events
+        self.events = []
+        self._beat = time.monotonic()
+        self._stop = threading.Event()
+
+    async def _heartbeat(self):
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.threshold / 4)
+
+    def _watch(self, loop_thread):
+        current = None
+        while not self._stop.wait(self.threshold / 4):
+            stalled = time.monotonic() - self._beat
+            if stalled > self.threshold:
+                if current is None and len(self.events) < self.max_events:
+                    frame = sys._current_frames().get(loop_thread)
+                    current = {"stack": _collapse(frame) if frame else "", "blocked_ms": 0}
+                    self.events.append(current)
+                if current is not None:
+                    current["blocked_ms"] = round(stalled * 1000, 1)
+            else:
+                current = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._thread = threading.Thread(
+            target=self._watch, args=(threading.get_ident(),), name="loop-watchdog", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._task.cancel()
+        self._stop.set()
+        self._thread.join()
+
+
+def _alloc_report(before, after, top):
+    stats = after.compare_to(before, "traceback")
+    collapsed = collections.Counter()
+    for stat in stats:
+        if stat.size_diff <= 0:
+            continue
+        frames = ";".join(
+            f"{os.path.basename(f.filename)}:{f.lineno}" for f in reversed(stat.traceback)
+        )
+        collapsed[frames] += stat.size_diff
+    top_lines = [
+        {
+            "location": str(stat.traceback[0]),
+            "size_diff_kb": round(stat.size_diff / 1024, 1),
+            "count_diff": stat.count_diff,
+        }
+        for stat in after.compare_to(before, "lineno")[:top]
+    ]
+    return collapsed, top_lines
+
+
+async def profile(seconds, mode, block_ms, top):
+    """Profile the running worker for ``seconds`` and return a report with
+    collapsed stacks, event-loop blocking events and (in alloc mode) the
+    top-N allocation sites."""
+    if _lock.locked():
+        raise ProfileBusy()
+    async with _lock:
+        watchdog = _LoopWatchdog(block_ms / 1000)
+        watchdog.start()
+        report = {"mode": mode, "seconds": seconds}
+        try:
+            if mode == "alloc":
+                started = not tracemalloc.is_tracing()
+                if started:
+                    tracemalloc.start(MAX_STACK_DEPTH)
+                try:
+                    before = tracemalloc.take_snapshot()
+                    await asyncio.sleep(seconds)
+                    after = tracemalloc.take_snapshot()
+                finally:
+                    if started:
+                        tracemalloc.stop()
+                stacks, report["alloc_top"] = _alloc_report(before, after, top)
+                report["unit"] = "bytes"
+            elif mode == "cpu" and threading.current_thread() is threading.main_thread():
+                sampler = _CpuSampler(SAMPLE_INTERVAL)
+                sampler.start()
+                try:
+                    await asyncio.sleep(seconds)
+                finally:
+                    sampler.stop()
+                stacks, report["samples"] = sampler.stacks, sampler.samples
+                report["unit"] = "samples"
+            else:
+                # Wall-clock sampling; also the fallback for cpu mode when the
+                # loop is not on the main thread (signals need the main thread)
+                sampler = _WallSampler(SAMPLE_INTERVAL)
+                await asyncio.to_thread(sampler.run, seconds)
+                stacks, report["samples"] = sampler.stacks, sampler.samples
+                report["mode"] = "wall"
+                report["unit"] = "samples"
+        finally:
+            watchdog.stop()
+        report["collapsed"] = [f"{stack} {count}" for stack, count in stacks.most_common()]
+        report["blocking_events"] = watchdog.events
+        return report
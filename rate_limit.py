@@ -0,0 +1,158 @@
+import json
+import math
+import os
+import time
+
+import metrics
+
+# Only requests that can end up calling the upstream API are throttled:
+# POSTs that start an analysis (chunk PATCHes and status HEADs are free).
+RATE_LIMITED_PREFIXES = ("/api/analyze", "/api/uploads")
+# Cheap store lookups that never reach the upstream
+RATE_LIMIT_EXEMPT_PATHS = frozenset({"/api/analyze/lookup"})
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class TokenBucketTable:
+    """Per-client token buckets with lazy refill.
+
+    Buckets live in two generations. Every ``idle_ttl`` seconds the old
+    generation is dropped wholesale and the current one becomes old, so a
+    client that has been idle for a full generation is forgotten in O(1).
+    An idle bucket has refilled to ``burst`` by then, so forgetting it does
+    not change its behaviour.
+    """
+
+    def __init__(self, rate, burst, idle_ttl=300.0):
+        self.rate = rate
+        self.burst = burst
+        self.idle_ttl = max(idle_ttl, burst / rate)
+        self._current = {}
+        self._previous = {}
+        self._next_sweep = time.monotonic() + self.idle_ttl
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def take(self, key, cost=1.0, now=None):
+        """Take ``cost`` tokens for ``key``.
+
+        Returns 0.0 when the request is allowed, otherwise the number of
+        seconds until enough tokens will be available.
+        """
+        if now is None:
+            now = time.monotonic()
+        if now >= self._next_sweep:
+            self._sweep(now)
+
+        bucket = self._current.get(key)
+        if bucket is None:
+            bucket = self._previous.pop(key, None)
+            if bucket is None:
+                bucket = _Bucket(self.burst, now)
+            self._current[key] = bucket
+
+        # Lazy refill: tokens are only topped up when the client shows up
+        elapsed = now - bucket.updated
+        if elapsed > 0:
+            bucket.tokens = min(self.burst, bucket.tokens + elapsed * self.rate)
+            bucket.updated = now
+
+        if bucket.tokens >= cost:
+            bucket.tokens -= cost
+            return 0.0
+        return (cost - bucket.tokens) / self.rate
+
+    def _sweep(self, now):
+        metrics.incr("rate_limit_buckets_evicted", len(self._previous))
+        self._previous = self._current
+        self._current = {}
+        self._next_sweep = now + self.idle_ttl
+
+
+# Client API keys, comma-separated, that get a bucket of their own. Any
+# other X-API-Key value is ignored: clients can mint those at will, so
+# honouring them would hand out a fresh burst per made-up key.
+API_KEYS = frozenset(key.strip() for key in os.getenv("API_KEYS", "").split(",") if key.strip())
+
+
+def client_id(scope):
+    # Prefer a known API key so clients behind a shared NAT get their own
+    # bucket; fall back to the peer address (run uvicorn with --proxy-headers
+    # behind a load balancer so this is the real client).
+    if API_KEYS:
+        for name, value in scope.get("headers", ()):
+            if name == b"x-api-key" and value:
+                key = value.decode("latin-1")
+                if key in API_KEYS:
+                    return "key:" + key
+                metrics.incr("rate_limit_unknown_api_key")
+                break
+    client = scope.get("client")
+    return "ip:" + (client[0] if client else "unknown")
+
+
+_table = None
+
+
+def get_table():
+    # Shared by the middleware and the routes that charge per upstream call
+    global _table
+    if _table is None:
+        per_minute = float(os.getenv("RATE_LIMIT_PER_MINUTE", "10"))
+        burst = float(os.getenv("RATE_LIMIT_BURST", "5"))
+        _table = TokenBucketTable(rate=per_minute / 60.0, burst=burst)
+    return _table
+
+
+def charge(scope, cost=1.0):
+    """Take ``cost`` more tokens from the caller's bucket, for a request
+    that makes more upstream calls than the one the middleware charged.
+    Returns the wait like :meth:`TokenBucketTable.take`."""
+    wait = get_table().take(client_id(scope), cost)
+    metrics.incr("rate_limit_rejected" if wait else "rate_limit_allowed")
+    return wait
+
+
+class RateLimitMiddleware:
+    def __init__(self, app, table=None, prefixes=RATE_LIMITED_PREFIXES):
+        self.app = app
+        self.table = table if table is not None else get_table()
+        self.prefixes = prefixes
+        metrics.register_gauge("rate_limit_buckets", lambda: len(self.table))
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or not scope["path"].startswith(self.prefixes)
+            or scope["path"] in RATE_LIMIT_EXEMPT_PATHS
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        wait = self.table.take(client_id(scope))
+        if not wait:
+            metrics.incr("rate_limit_allowed")
+            await self.app(scope, receive, send)
+            return
+
+        metrics.incr("rate_limit_rejected")
+        body = json.dumps({"detail": "Too many requests. Please slow down."}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(math.ceil(wait)).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,120 @@
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+
+# Analysis results keyed by the SHA-256 of the uploaded image. Only the
+# hash and the AnalysisResult fields are stored, never image data.
+RESULT_STORE_PATH = os.getenv("RESULT_STORE_PATH", "results.db")
+
+RESULT_FIELDS = ("kibbe_archetype", "color_season", "palette_description")
+# Perceptual hashes with fewer bits set are not stored: flat and nearly
+# flat images all hash to about 0 and would match each other
+_MIN_PHASH_BITS = 4
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def difference_hash(data):
+    """64-bit difference hash of an image as 16 hex digits, computed like
+    the frontends do: a 9x8 grayscale thumbnail, one bit per pixel that is
+    brighter than its right neighbour. None without Pillow, for images it
+    cannot decode, and for nearly flat images."""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.draft("RGB", (64, 64))  # JPEG: decode at a fraction of the size
+            thumbnail = ImageOps.exif_transpose(image).convert("RGB").resize((9, 8), Image.Resampling.BILINEAR)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    px = thumbnail.tobytes()
+    gray = [px[i] * 0.299 + px[i + 1] * 0.587 + px[i + 2] * 0.114 for i in range(0, len(px), 3)]
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            i = row * 9 + col
+            bits = bits << 1 | (gray[i] > gray[i + 1])
+    if bin(bits).count("1") < _MIN_PHASH_BITS:
+        return None
+    return f"{bits:016x}"
+
+
+def is_valid_result(result):
+    # Same shape as main.AnalysisResult
+    return isinstance(result, dict) and all(isinstance(result.get(f), str) for f in RESULT_FIELDS)
+
+
+class ResultStore:
+    def __init__(self, path=RESULT_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS results (
+                sha256 TEXT PRIMARY KEY,
+                kibbe_archetype TEXT NOT NULL,
+                color_season TEXT NOT NULL,
+                palette_description TEXT NOT NULL,
+                model TEXT,
+                source TEXT,
+                created_at REAL NOT NULL
+            )"""
+        )
+        # Perceptual hash of the analyzed image, computed here from the
+        # uploaded bytes (never taken from the client), so a re-encoded copy
+        # of the same photo can still be answered without an upload
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(results)")}
+        if "phash" not in columns:
+            self._db.execute("ALTER TABLE results ADD COLUMN phash TEXT")
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_phash ON results (phash)")
+
+    def get(self, sha256):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT kibbe_archetype, color_season, palette_description FROM results WHERE sha256 = ?",
+                (sha256,),
+            ).fetchone()
+        return dict(zip(RESULT_FIELDS, row)) if row else None
+
+    def get_by_phash(self, phash):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT kibbe_archetype, color_season, palette_description FROM results"
+                " WHERE phash = ? ORDER BY created_at DESC LIMIT 1",
+                (phash,),
+            ).fetchone()
+        return dict(zip(RESULT_FIELDS, row)) if row else None
+
+    def put(self, sha256, result, model=None, source="interactive", phash=None):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results"
+                " (sha256, kibbe_archetype, color_season, palette_description, model, source, created_at, phash)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (sha256, *(result[f] for f in RESULT_FIELDS), model, source, time.time(), phash),
+            )
+
+    def __contains__(self, sha256):
+        with self._lock:
+            return self._db.execute(
+                "SELECT 1 FROM results WHERE sha256 = ?", (sha256,)
+            ).fetchone() is not None
+
+
+_store = None
+
+
+def get_store():
+    # Opened on first use so importing the app has no filesystem side effects
+    global _store
+    if _store is None:
+        _store = ResultStore()
+    return _store
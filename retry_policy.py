@@ -0,0 +1,115 @@
+import email.utils
+import os
+import random
+import time
+
+import anthropic
+
+import metrics
+
+# Upstream retry policy: classify the error, back off with full jitter
+# (never less than the upstream's retry-after), never past the request
+# deadline, and only while the process-wide retry budget allows it.
+MAX_ATTEMPTS = int(os.getenv("UPSTREAM_MAX_ATTEMPTS", "3"))
+BASE_DELAY = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY", "0.5"))
+MAX_DELAY = float(os.getenv("UPSTREAM_RETRY_MAX_DELAY", "8"))
+RETRY_BUDGET_RATIO = float(os.getenv("UPSTREAM_RETRY_BUDGET_RATIO", "0.1"))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("UPSTREAM_RETRY_BUDGET_MIN_PER_SECOND", "0.5"))
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header (delta-seconds or HTTP date)."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            parsed = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, parsed.timestamp() - time.time())
+
+
+def classify(error):
+    """Return ``(error_class, retryable)`` for an upstream failure."""
+    if isinstance(error, anthropic.APITimeoutError):
+        return "timeout", True
+    if isinstance(error, anthropic.APIConnectionError):
+        return "connection", True
+    if isinstance(error, anthropic.RateLimitError):
+        return "rate_limit", True
+    if isinstance(error, anthropic.APIStatusError):
+        if error.status_code == 529:
+            return "overloaded", True
+        if error.status_code >= 500:
+            return "server_error", True
+        if error.status_code in (408, 409):
+            return "conflict", True
+        # 400/401/403/404/413...: the same request will fail the same way
+        return "client_error", False
+    return "unexpected", False
+
+
+class RetryBudget:
+    """Caps retries at a fraction of calls, process-wide.
+
+    Every call deposits ``ratio`` tokens and every retry withdraws one, so
+    during an outage retries add at most ``ratio`` extra load instead of
+    multiplying it. A small time-based allowance keeps retries working when
+    traffic is too low to build up a balance.
+    """
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, min_per_second=RETRY_BUDGET_MIN_PER_SECOND, cap=100.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.cap = cap
+        self.balance = cap * ratio
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.balance = min(self.cap, self.balance + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def deposit(self):
+        self._refill()
+        self.balance = min(self.cap, self.balance + self.ratio)
+
+    def try_withdraw(self):
+        self._refill()
+        if self.balance >= 1.0:
+            self.balance -= 1.0
+            return True
+        return False
+
+
+budget = RetryBudget()
+metrics.register_gauge("upstream_retry_budget", lambda: round(budget.balance, 2))
+
+
+def record_call():
+    budget.deposit()
+
+
+def next_delay(attempt, error_class, retryable, retry_after=None, deadline=None):
+    """Seconds to wait before retrying after failed ``attempt`` (0-based),
+    or None if the call should not be retried."""
+    metrics.incr(f"upstream_errors_{error_class}")
+    if not retryable:
+        return None
+    if attempt + 1 >= MAX_ATTEMPTS:
+        metrics.incr("upstream_retries_exhausted")
+        return None
+    # Full jitter keeps clients that failed together from retrying together
+    delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    if deadline is not None and delay >= deadline.remaining():
+        metrics.incr("upstream_retries_denied_deadline")
+        return None
+    if not budget.try_withdraw():
+        metrics.incr("upstream_retries_denied_budget")
+        return None
+    metrics.incr(f"upstream_retries_{error_class}")
+    return delay
@@ -0,0 +1,190 @@
+import asyncio
+import contextlib
+import os
+import time
+from collections import OrderedDict, deque
+
+import metrics
+
+# Admission to the upstream. At most SCHEDULER_CONCURRENCY calls run at
+# once; the rest wait in per-class, per-tenant queues. Classes share the
+# capacity by deficit round robin with the weights below, and within a
+# class tenants take turns, so one tenant flooding the queue only delays
+# itself. SCHEDULER_INTERACTIVE_RESERVED slots are kept free of batch and
+# background work so interactive requests never wait behind a bulk job.
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "16"))
+SCHEDULER_INTERACTIVE_RESERVED = int(os.getenv("SCHEDULER_INTERACTIVE_RESERVED", "4"))
+# Waiting requests allowed per class before new ones get 503
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "500"))
+# Class -> DRR weight (share of capacity when every class is busy)
+PRIORITY_WEIGHTS = {"interactive": 8, "batch": 2, "background": 1}
+# Queue waits kept per class for percentiles
+_WAIT_SAMPLES = 1024
+
+
+class QueueFull(Exception):
+    pass
+
+
+class _Class:
+    __slots__ = ("name", "weight", "deficit", "tenants", "waiting", "running", "waits", "admitted")
+
+    def __init__(self, name, weight):
+        self.name = name
+        self.weight = weight
+        self.deficit = 0
+        # tenant -> deque of waiter futures, in round-robin order
+        self.tenants = OrderedDict()
+        self.waiting = 0
+        self.running = 0
+        self.waits = deque(maxlen=_WAIT_SAMPLES)
+        self.admitted = 0
+
+    def push(self, tenant, waiter):
+        self.tenants.setdefault(tenant, deque()).append(waiter)
+        self.waiting += 1
+
+    def pop(self):
+        # Next tenant in turn gives up its oldest waiter, then goes to the back
+        tenant, queue = next(iter(self.tenants.items()))
+        waiter = queue.popleft()
+        del self.tenants[tenant]
+        if queue:
+            self.tenants[tenant] = queue
+        self.waiting -= 1
+        return waiter
+
+    def remove(self, tenant, waiter):
+        queue = self.tenants.get(tenant)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self.waiting -= 1
+            if not queue:
+                del self.tenants[tenant]
+
+    def stats(self):
+        waits = sorted(self.waits)
+
+        def percentile(p):
+            return round(waits[min(len(waits) - 1, int(p * len(waits)))] * 1000, 1) if waits else 0.0
+
+        return {
+            "queued": self.waiting,
+            "running": self.running,
+            "admitted": self.admitted,
+            "wait_ms_p50": percentile(0.50),
+            "wait_ms_p99": percentile(0.99),
+            "wait_ms_max": round(waits[-1] * 1000, 1) if waits else 0.0,
+        }
+
+
+class Scheduler:
+    def __init__(self, capacity=SCHEDULER_CONCURRENCY, reserved=SCHEDULER_INTERACTIVE_RESERVED,
+                 max_queue=SCHEDULER_MAX_QUEUE, weights=PRIORITY_WEIGHTS):
+        self.capacity = capacity
+        self.reserved = min(reserved, capacity - 1)
+        self.max_queue = max_queue
+        self.classes = [_Class(name, weight) for name, weight in weights.items()]
+        self._by_name = {c.name: c for c in self.classes}
+        self._turn = 0
+        self.running = 0
+        metrics.register_gauge("scheduler", self.stats)
+
+    @property
+    def queued(self):
+        return sum(c.waiting for c in self.classes)
+
+    def _may_run(self, cls):
+        limit = self.capacity if cls.name == "interactive" else self.capacity - self.reserved
+        return self.running < limit
+
+    def _pick(self):
+        # Deficit round robin over classes: each visit to a class with work
+        # adds its weight, and every admission spends one. When nothing
+        # waiting may run (only the interactive reserve is free), the turn
+        # and the deficits stay as they are, so a class held back by the
+        # reserve keeps its place and its credit
+        if not any(c.waiting and self._may_run(c) for c in self.classes):
+            return None
+        n = len(self.classes)
+        while True:
+            cls = self.classes[self._turn]
+            if cls.waiting and self._may_run(cls) and cls.deficit >= 1:
+                cls.deficit -= 1
+                return cls
+            if not cls.waiting:
+                cls.deficit = 0  # idle classes do not bank credit
+            self._turn = (self._turn + 1) % n
+            cls = self.classes[self._turn]
+            if cls.waiting and self._may_run(cls):
+                cls.deficit += cls.weight
+
+    def _dispatch(self):
+        while self.running < self.capacity:
+            cls = self._pick()
+            if cls is None:
+                return
+            waiter = cls.pop()
+            if waiter.done():
+                continue  # cancelled while queued
+            self.running += 1
+            cls.running += 1
+            waiter.set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tenant, priority="interactive"):
+        """Hold one upstream slot for the duration of the block, waiting
+        for a fair turn if the upstream is busy; yields the seconds waited.
+        Raises :class:`QueueFull` when too many requests are waiting."""
+        cls = self._by_name[priority]
+        start = time.monotonic()
+        if not cls.waiting and self._may_run(cls):
+            self.running += 1
+            cls.running += 1
+        else:
+            # Per class, so a batch flood cannot fill the queue for everyone
+            if cls.waiting >= self.max_queue:
+                metrics.incr("scheduler_rejected_queue_full")
+                raise QueueFull()
+            waiter = asyncio.get_running_loop().create_future()
+            cls.push(tenant, waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Admitted just as the wait was cancelled; hand the slot on
+                    self._release(cls)
+                else:
+                    cls.remove(tenant, waiter)
+                raise
+        waited = time.monotonic() - start
+        cls.waits.append(waited)
+        cls.admitted += 1
+        metrics.incr(f"scheduler_wait_ms_{cls.name}", round(waited * 1000))
+        try:
+            yield waited
+        finally:
+            self._release(cls)
+
+    def _release(self, cls):
+        self.running -= 1
+        cls.running -= 1
+        self._dispatch()
+
+    def stats(self):
+        return {
+            "capacity": self.capacity,
+            "running": self.running,
+            "queued": self.queued,
+            "classes": {c.name: c.stats() for c in self.classes},
+        }
+
+
+_scheduler = None
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = Scheduler()
+    return _scheduler
@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+# Set before main is imported: the rate limiter reads these once
+os.environ.setdefault("RATE_LIMIT_BURST", "1000")
+os.environ.setdefault("CLAUDE_API_KEY", "test")
+
+RESULT = {
+    "kibbe_archetype": "Soft Classic",
+    "color_season": "Soft Summer",
+    "palette_description": "Muted, cool and gentle colors.",
+}
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """main with fresh stores and the upstream call replaced; the calls
+    that would have gone upstream are listed in ``main.upstream_calls``."""
+    import analytics
+    import main
+    import result_store
+    import uploads
+    import usage
+
+    monkeypatch.setattr(result_store, "_store", result_store.ResultStore(str(tmp_path / "results.db")))
+    monkeypatch.setattr(usage, "_ledger", usage.UsageLedger(str(tmp_path / "usage.db")))
+    monkeypatch.setattr(uploads, "_spool", uploads.UploadSpool(str(tmp_path / "uploads")))
+    monkeypatch.setattr(analytics, "_analytics", analytics.Analytics())
+    calls = []
+
+    async def analyze_encoded(base64_image, media_type, *args, **kwargs):
+        calls.append(media_type)
+        return dict(RESULT)
+
+    monkeypatch.setattr(main, "analyze_encoded", analyze_encoded)
+    monkeypatch.setattr(main, "upstream_calls", calls, raising=False)
+    return main
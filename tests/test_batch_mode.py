@@ -0,0 +1,75 @@
+import pytest
+
+from batch_mode import BatchState, _store_result, reconcile, submit
+
+
+def _errored(error_type):
+    return {
+        "custom_id": "a" * 64,
+        "result": {"type": "errored", "error": {"type": "error", "error": {"type": error_type, "message": "..."}}},
+    }
+
+
+@pytest.mark.parametrize("error_type", ["overloaded_error", "api_error", "rate_limit_error"])
+def test_transient_errors_are_queued_again(error_type):
+    status, error = _store_result(None, _errored(error_type))
+    assert status == "queued"
+    assert error_type in error
+
+
+def test_invalid_requests_fail_for_good():
+    assert _store_result(None, _errored("invalid_request_error"))[0] == "failed"
+
+
+@pytest.mark.parametrize("result_type", ["expired", "canceled"])
+def test_expired_and_canceled_are_queued_again(result_type):
+    assert _store_result(None, {"custom_id": "a" * 64, "result": {"type": result_type}}) == ("queued", None)
+
+
+class _Crashing:
+    """Creates the batch upstream, then dies before it is recorded."""
+
+    def __init__(self):
+        self.batches = []
+
+    def create(self, requests):
+        self.batches.append({
+            "id": f"msgbatch_{len(self.batches)}",
+            "request_counts": {"processing": len(requests), "succeeded": 0},
+        })
+        raise KeyboardInterrupt
+
+    def recent(self, since):
+        return reversed(self.batches)
+
+
+def _queued_images(tmp_path, n):
+    Image = pytest.importorskip("PIL.Image")
+    state = BatchState(str(tmp_path / "state.db"))
+    for i in range(n):
+        path = str(tmp_path / f"{i}.png")
+        Image.new("RGB", (8, 8), (i, 0, 0)).save(path)
+        state.enqueue(f"{i:064x}", path, "image/png")
+    return state
+
+
+def test_batch_created_by_an_interrupted_run_is_recovered(tmp_path):
+    state = _queued_images(tmp_path, 3)
+    client = _Crashing()
+    with pytest.raises(KeyboardInterrupt):
+        submit(state, client)
+    # Not queued, so a resumed run does not pay for them twice
+    assert state.counts() == {"submitting": 3}
+    reconcile(state, client)
+    assert state.counts() == {"submitted": 3}
+    assert state.open_batches() == ["msgbatch_0"]
+
+
+def test_items_are_queued_again_when_no_batch_was_created(tmp_path):
+    state = _queued_images(tmp_path, 3)
+    client = _Crashing()
+    with pytest.raises(KeyboardInterrupt):
+        submit(state, client)
+    client.batches[0]["request_counts"]["processing"] = 2  # someone else's batch
+    reconcile(state, client)
+    assert state.counts() == {"queued": 3}
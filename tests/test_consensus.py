@@ -0,0 +1,62 @@
+import io
+
+import pytest
+from fastapi.testclient import TestClient
+
+import rate_limit
+import traffic
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def _photos(n):
+    photos = []
+    for i in range(n):
+        buffer = io.BytesIO()
+        Image.new("RGB", (1200, 1000), (40 * i, 90, 120)).save(buffer, "JPEG")
+        photos.append(("files", (f"{i}.jpg", buffer.getvalue(), "image/jpeg")))
+    return photos
+
+
+def _client(app, monkeypatch, tokens):
+    # A client whose bucket holds ``tokens``; other tests keep their own
+    monkeypatch.setattr(rate_limit, "API_KEYS", frozenset({"consensus"}))
+    table = rate_limit.get_table()
+    table.take("key:consensus", cost=0)
+    monkeypatch.setattr(table._current["key:consensus"], "tokens", tokens)
+    return TestClient(app.app, headers={"X-API-Key": "consensus"})
+
+
+def _tokens():
+    return rate_limit.get_table()._current["key:consensus"].tokens
+
+
+class _Records:
+    def __init__(self):
+        self.records = []
+
+    def submit(self, record):
+        self.records.append(record)
+
+
+def test_each_photo_analyzed_is_charged(app, monkeypatch):
+    writer = _Records()
+    monkeypatch.setattr(traffic, "_writer", writer)
+    analytics = app.get_analytics()
+    client = _client(app, monkeypatch, 10)
+    response = client.post("/api/analyze/consensus", files=_photos(3))
+    assert response.status_code == 200
+    # Two photos settle a three-photo vote; the third is never analyzed
+    assert response.json()["consensus"]["analyzed"] == 2
+    assert 8 <= _tokens() < 8.5
+    assert sorted(r["cache"] for r in writer.records) == ["miss", "miss"]
+    assert analytics.query()["analyzed"] == 1
+
+
+def test_photos_past_the_bucket_are_refused(app, monkeypatch):
+    client = _client(app, monkeypatch, 1)
+    response = client.post("/api/analyze/consensus", files=_photos(3))
+    assert response.status_code == 200
+    assert response.json()["consensus"]["analyzed"] == 1
+    assert response.json()["consensus"]["failed"] == 2
+    assert len(app.upstream_calls) == 1
@@ -0,0 +1,38 @@
+import asyncio
+import time
+
+import pytest
+
+from credential_pool import CredentialPool, KeysCoolingDown, configured_keys
+from deadline import Deadline
+
+
+def _cool_all(pool, seconds):
+    for slot in pool.slots:
+        pool.cooldown(slot, {"retry-after": str(seconds)})
+
+
+def test_ready_fails_fast_when_every_key_outlasts_the_deadline():
+    pool = CredentialPool(["k1", "k2"])
+    _cool_all(pool, 30)
+    with pytest.raises(KeysCoolingDown) as error:
+        asyncio.run(pool.ready(Deadline(5)))
+    assert error.value.retry_after > 5
+
+
+def test_ready_waits_for_the_first_key_to_recover():
+    pool = CredentialPool(["k1", "k2"])
+    _cool_all(pool, 30)
+    pool.slots[1].cooldown_until = time.monotonic() + 0.05
+    start = time.monotonic()
+    asyncio.run(pool.ready(Deadline(5)))
+    assert time.monotonic() - start >= 0.04
+    assert pool.acquire() is pool.slots[1]
+
+
+def test_configured_keys_prefers_the_key_list(monkeypatch):
+    monkeypatch.setenv("CLAUDE_API_KEY", "single")
+    monkeypatch.setenv("CLAUDE_API_KEYS", "a, b,")
+    assert configured_keys() == ["a", "b"]
+    monkeypatch.delenv("CLAUDE_API_KEYS")
+    assert configured_keys() == ["single"]
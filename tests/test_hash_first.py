@@ -0,0 +1,53 @@
+import hashlib
+import io
+
+import pytest
+from fastapi.testclient import TestClient
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def _jpeg(image, **params):
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", **params)
+    return buffer.getvalue()
+
+
+def _upload(client, data):
+    created = client.post("/api/uploads", headers={"Upload-Length": str(len(data))})
+    return client.patch(
+        created.headers["location"], content=data,
+        headers={"Content-Type": "application/offset+octet-stream", "Upload-Offset": "0"},
+    )
+
+
+def test_repeat_of_a_shrunk_upload_is_found_by_lookup(app):
+    client = TestClient(app.app)
+    photo = Image.radial_gradient("L").resize((4032, 3024)).convert("RGB")
+    original = _jpeg(photo, quality=95)
+    # What the frontend uploads: scaled to max_edge and re-encoded
+    shrunk = _jpeg(photo.resize((app.TRANSCODE_MAX_EDGE, app.TRANSCODE_MAX_EDGE * 3 // 4)), quality=85)
+
+    first = _upload(client, shrunk)
+    assert first.status_code == 200 and first.headers["x-cache"] == "miss"
+    assert len(app.upstream_calls) == 1
+
+    # Results are keyed by the bytes received, so the frontend looks up the
+    # shrunk photo; the original's hash is not a key
+    lookup = client.post("/api/analyze/lookup", json={"sha256": hashlib.sha256(shrunk).hexdigest()})
+    assert lookup.status_code == 200 and lookup.headers["x-cache"] == "hit"
+    miss = client.post("/api/analyze/lookup", json={"sha256": hashlib.sha256(original).hexdigest()})
+    assert miss.status_code == 404
+
+    again = _upload(client, shrunk)
+    assert again.headers["x-cache"] == "hit"
+    assert len(app.upstream_calls) == 1
+
+
+def test_lookup_hits_are_counted_as_cache_hits(app):
+    client = TestClient(app.app)
+    data = _jpeg(Image.new("RGB", (640, 480), (200, 150, 120)))
+    _upload(client, data)
+    client.post("/api/analyze/lookup", json={"sha256": hashlib.sha256(data).hexdigest()})
+    counts = app.get_analytics().query()
+    assert (counts["analyzed"], counts["cache_hit"]) == (1, 1)
@@ -0,0 +1,25 @@
+import asyncio
+
+import health
+
+
+def test_unexpected_probe_errors_count_as_failures(monkeypatch):
+    def broken_pool():
+        raise ValueError("bad base URL")
+
+    monkeypatch.setattr(health, "get_pool", broken_pool)
+    monkeypatch.setattr(health, "UPSTREAM_PROBE_SECONDS", 0.01)
+
+    async def run():
+        monitor = health.HealthMonitor()
+        probes = asyncio.create_task(monitor._probe_upstream())
+        await asyncio.sleep(0.1)
+        assert not probes.done()
+        probes.cancel()
+        return monitor
+
+    monitor = asyncio.run(run())
+    assert monitor.upstream_ok is False
+    assert monitor.upstream_failures >= health.READY_UPSTREAM_FAILURES
+    assert monitor.upstream_error == "ValueError: bad base URL"
+    assert "upstream_unreachable" in monitor.readiness()["reasons"]
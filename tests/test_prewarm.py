@@ -0,0 +1,39 @@
+import asyncio
+from types import SimpleNamespace
+
+import prewarm
+
+
+class _BrokenHTTP:
+    def stream(self, *args, **kwargs):
+        raise ValueError("bad base URL")
+
+
+def test_unexpected_ping_errors_count_as_failed_pings():
+    slot = SimpleNamespace(name="key-0", http=_BrokenHTTP(), client=SimpleNamespace(base_url="http://upstream"))
+
+    async def run():
+        return await prewarm.ConnectionWarmer()._ping(slot, prewarm._Round(1))
+
+    assert asyncio.run(run()) is False
+
+
+def test_keep_alive_survives_unexpected_errors(monkeypatch):
+    calls = []
+
+    def broken_pool():
+        calls.append(1)
+        raise ValueError("bad base URL")
+
+    monkeypatch.setattr(prewarm, "get_pool", broken_pool)
+    monkeypatch.setattr(prewarm, "UPSTREAM_KEEPALIVE_SECONDS", 0.01)
+
+    async def run():
+        warmer = prewarm.ConnectionWarmer(connections=1)
+        warmer.start()
+        await asyncio.sleep(0.1)
+        assert not warmer._task.done()
+        await warmer.stop()
+
+    asyncio.run(run())
+    assert len(calls) > 1
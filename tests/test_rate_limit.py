@@ -0,0 +1,27 @@
+import rate_limit
+from rate_limit import TokenBucketTable, client_id
+
+
+def _scope(key=None, ip="10.0.0.7"):
+    headers = [(b"x-api-key", key.encode())] if key else []
+    return {"headers": headers, "client": (ip, 5000)}
+
+
+def test_unknown_api_keys_share_the_ip_bucket(monkeypatch):
+    monkeypatch.setattr(rate_limit, "API_KEYS", frozenset({"known"}))
+    assert client_id(_scope("known")) == "key:known"
+    assert client_id(_scope("made-up-1")) == client_id(_scope("made-up-2")) == "ip:10.0.0.7"
+    assert client_id(_scope()) == "ip:10.0.0.7"
+
+
+def test_api_keys_ignored_unless_configured(monkeypatch):
+    monkeypatch.setattr(rate_limit, "API_KEYS", frozenset())
+    assert client_id(_scope("anything")) == "ip:10.0.0.7"
+
+
+def test_rotating_keys_does_not_refill_the_burst(monkeypatch):
+    monkeypatch.setattr(rate_limit, "API_KEYS", frozenset({"known"}))
+    table = TokenBucketTable(rate=1 / 60, burst=2)
+    waits = [table.take(client_id(_scope(f"key-{i}")), now=100.0) for i in range(3)]
+    assert waits[:2] == [0.0, 0.0]
+    assert waits[2] > 0
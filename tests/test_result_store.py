@@ -0,0 +1,38 @@
+import io
+
+import pytest
+
+from result_store import ResultStore, difference_hash
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def _encode(image, format, **params):
+    buffer = io.BytesIO()
+    image.save(buffer, format, **params)
+    return buffer.getvalue()
+
+
+def _photo(size=(640, 480)):
+    # Horizontal and vertical gradients, so the hash has bits of both values
+    base = Image.radial_gradient("L").resize(size)
+    return Image.merge("RGB", (base, base.transpose(Image.Transpose.FLIP_LEFT_RIGHT), base))
+
+
+def test_difference_hash_survives_resizing_and_re_encoding():
+    original = difference_hash(_encode(_photo(), "PNG"))
+    assert original is not None and len(original) == 16
+    assert difference_hash(_encode(_photo((320, 240)), "JPEG", quality=80)) == original
+
+
+def test_flat_and_undecodable_images_get_no_hash():
+    assert difference_hash(_encode(Image.new("RGB", (200, 200), (90, 90, 90)), "PNG")) is None
+    assert difference_hash(b"not an image") is None
+
+
+def test_lookup_by_phash(tmp_path):
+    store = ResultStore(str(tmp_path / "results.db"))
+    result = {"kibbe_archetype": "Classic", "color_season": "Soft Summer", "palette_description": "..."}
+    store.put("a" * 64, result, phash="0f0f0f0f0f0f0f0f")
+    assert store.get_by_phash("0f0f0f0f0f0f0f0f") == result
+    assert store.get_by_phash("0000000000000000") is None
@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from scheduler import Scheduler
+
+
+async def _admission_order(capacity, reserved, jobs=30):
+    scheduler = Scheduler(capacity=capacity, reserved=reserved)
+    order = []
+    release = asyncio.Event()
+
+    async def blocker():
+        async with scheduler.slot("blocker"):
+            await release.wait()
+
+    async def job(priority, tenant):
+        async with scheduler.slot(tenant, priority):
+            order.append(priority)
+            await asyncio.sleep(0)
+
+    # Fill every slot, queue the bulk work behind it, then let it drain
+    blockers = [asyncio.create_task(blocker()) for _ in range(capacity)]
+    await asyncio.sleep(0)
+    queued = [asyncio.create_task(job("batch", f"b{i % 3}")) for i in range(jobs)]
+    queued += [asyncio.create_task(job("background", f"g{i % 3}")) for i in range(jobs)]
+    await asyncio.sleep(0)
+    assert scheduler.queued == 2 * jobs
+    release.set()
+    await asyncio.gather(*blockers, *queued)
+    return order
+
+
+@pytest.mark.parametrize("capacity, reserved", [(4, 0), (4, 1), (16, 4)])
+def test_batch_and_background_share_capacity_by_weight(capacity, reserved):
+    order = asyncio.run(_admission_order(capacity, reserved))
+    # Weights batch 2, background 1: while both are saturated background
+    # gets a third of the admissions, whatever the interactive reserve
+    head = order[:30]
+    assert head.count("background") == 10
+    assert head.count("batch") == 20
+    assert "background" in order[:3]
+
+
+def test_reserve_is_kept_for_interactive():
+    async def run():
+        scheduler = Scheduler(capacity=4, reserved=1)
+        release = asyncio.Event()
+        admitted = []
+
+        async def job(priority):
+            async with scheduler.slot("t", priority):
+                admitted.append(priority)
+                await release.wait()
+
+        tasks = [asyncio.create_task(job("batch")) for _ in range(4)]
+        await asyncio.sleep(0)
+        assert admitted == ["batch"] * 3
+        tasks.append(asyncio.create_task(job("interactive")))
+        await asyncio.sleep(0)
+        assert admitted[-1] == "interactive"
+        release.set()
+        await asyncio.gather(*tasks)
+        assert admitted.count("batch") == 4
+
+    asyncio.run(run())
@@ -0,0 +1,38 @@
+import io
+
+import pytest
+from fastapi.testclient import TestClient
+
+import traffic
+from result_store import difference_hash
+
+Image = pytest.importorskip("PIL.Image")
+
+
+class _Records:
+    def __init__(self):
+        self.records = []
+
+    def submit(self, record):
+        self.records.append(record)
+
+
+def test_capture_records_the_keyed_server_phash(app, monkeypatch):
+    writer = _Records()
+    monkeypatch.setattr(traffic, "_writer", writer)
+    monkeypatch.setattr(traffic, "TRAFFIC_CAPTURE_SAMPLE", 1.0)
+    buffer = io.BytesIO()
+    Image.radial_gradient("L").resize((800, 600)).convert("RGB").save(buffer, "JPEG")
+    data = buffer.getvalue()
+
+    client = TestClient(app.app)
+    client.post("/api/analyze", files={"file": ("photo.jpg", data, "image/jpeg")})
+    client.post("/api/analyze", files={"file": ("photo.jpg", data, "image/jpeg")})
+
+    analyzed, repeat = writer.records
+    phash = difference_hash(data)
+    assert phash is not None
+    assert analyzed["cache"] == "miss" and analyzed["phash"] == traffic._keyed(phash)
+    assert phash not in str(analyzed)
+    # Cache hits are not hashed again
+    assert repeat["cache"] == "hit" and repeat["phash"] is None
@@ -0,0 +1,48 @@
+import asyncio
+import io
+import os
+import signal
+
+import pytest
+
+pillow_heif = pytest.importorskip("pillow_heif")
+pillow_heif.register_heif_opener()
+
+import transcode
+from image_probe import probe
+from transcode import TranscodeError
+
+
+def _heic(size, noise=False):
+    from PIL import Image
+
+    image = Image.effect_noise(size, 50).convert("RGB") if noise else Image.new("RGB", size, (1, 2, 3))
+    buffer = io.BytesIO()
+    image.save(buffer, "HEIF")
+    return buffer.getvalue()
+
+
+def test_pool_is_replaced_after_a_worker_dies():
+    small, large = _heic((300, 300)), _heic((1600, 1200), noise=True)
+
+    async def run():
+        await transcode.transcode(small, probe(small))
+        executor = transcode._executor
+
+        async def kill_workers():
+            await asyncio.sleep(0.05)
+            for pid in list(executor._processes):
+                os.kill(pid, signal.SIGKILL)
+
+        failed, _ = await asyncio.gather(
+            transcode.transcode(large, probe(large)), kill_workers(), return_exceptions=True
+        )
+        assert isinstance(failed, TranscodeError) and failed.status_code == 503
+        # The next upload gets a fresh pool instead of the broken one
+        _, info = await transcode.transcode(small, probe(small))
+        assert info.format in transcode.TRANSCODE_FORMATS
+
+    try:
+        asyncio.run(run())
+    finally:
+        transcode.shutdown_pool()
@@ -0,0 +1,73 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from uploads import UploadError, UploadSpool
+
+
+def test_completed_upload_rejects_more_chunks(tmp_path):
+    async def run():
+        spool = UploadSpool(directory=str(tmp_path))
+        upload = await spool.create(3, "image/png")
+        upload = await spool.append(upload.id, 0, b"abc")
+        assert upload.complete
+        await spool.finish(upload.id, "a" * 64)
+        # An empty chunk at the end must not reopen or re-hash the upload
+        with pytest.raises(UploadError) as error:
+            await spool.append(upload.id, 3, b"")
+        assert error.value.status_code == 409
+        assert not os.path.exists(tmp_path / f"{upload.id}.part")
+        assert (await spool.get(upload.id)).sha256 == "a" * 64
+
+    asyncio.run(run())
+
+
+def test_reservations_are_tracked_without_listing_the_spool(tmp_path):
+    async def run():
+        spool = UploadSpool(directory=str(tmp_path), max_bytes=10)
+        first = await spool.create(6, "image/png")
+        assert spool.reserved_bytes == 6
+        with pytest.raises(UploadError) as error:
+            await spool.create(6, "image/png")
+        assert error.value.status_code == 503
+        await spool.append(first.id, 0, b"abcdef")
+        await spool.finish(first.id, "b" * 64)
+        assert spool.reserved_bytes == 0
+        await spool.create(6, "image/png")
+
+    asyncio.run(run())
+
+
+def test_sweep_releases_expired_and_foreign_uploads(tmp_path):
+    async def run():
+        spool = UploadSpool(directory=str(tmp_path))
+        expired = await spool.create(4, "image/png")
+        finished_elsewhere = await spool.create(5, "image/png")
+        await spool.create(3, "image/png")
+        with open(tmp_path / f"{expired.id}.json", "w") as f:
+            json.dump({"length": 4, "content_type": "image/png", "expires_at": time.time() - 1}, f)
+        meta_path = tmp_path / f"{finished_elsewhere.id}.json"
+        meta = json.loads(meta_path.read_text())
+        meta_path.write_text(json.dumps({**meta, "sha256": "c" * 64}))
+        # A spool opened later picks up what is still pending
+        assert UploadSpool(directory=str(tmp_path)).reserved_bytes == 3
+        await spool.sweep()
+        assert spool.reserved_bytes == 3
+        assert not os.path.exists(tmp_path / f"{expired.id}.json")
+
+    asyncio.run(run())
+
+
+def test_oversized_chunks_are_refused_before_they_are_read(app):
+    client = TestClient(app.app)
+    location = client.post("/api/uploads", headers={"Upload-Length": "3"}).headers["location"]
+    headers = {"Content-Type": "application/offset+octet-stream", "Upload-Offset": "0"}
+    assert client.patch(location, content=b"x" * 1024, headers=headers).status_code == 413
+    # Without a Content-Length the body is cut off once it runs over
+    streamed = client.patch(location, content=iter([b"xx", b"xx"]), headers=headers)
+    assert streamed.status_code == 413
+    assert client.head(location).headers["upload-offset"] == "0"
@@ -0,0 +1,72 @@
+import asyncio
+import sqlite3
+
+from starlette.requests import Request
+
+import rate_limit
+import usage
+from usage import UsageLedger, tenant_id
+
+
+def _request(key, ip="10.0.0.7"):
+    return Request({"type": "http", "headers": [(b"x-api-key", key.encode())], "client": (ip, 5000)})
+
+
+def test_rotating_unlisted_keys_stays_one_tenant(monkeypatch):
+    monkeypatch.setattr(rate_limit, "API_KEYS", frozenset({"known"}))
+    assert tenant_id(_request("fake-1")) == tenant_id(_request("fake-2")) == "ip:10.0.0.7"
+    assert tenant_id(_request("known")).startswith("key:")
+    assert "known" not in tenant_id(_request("known"))
+
+
+def test_budget_holds_across_made_up_keys(monkeypatch, tmp_path):
+    monkeypatch.setattr(rate_limit, "API_KEYS", frozenset())
+    monkeypatch.setattr(usage, "TENANT_DAILY_BUDGET_USD", 0.001)
+    ledger = UsageLedger(path=str(tmp_path / "usage.db"))
+    ledger.record(tenant_id(_request("fake-1")), "claude-3-haiku-20240307", 4000, 0)
+    assert ledger.over_budget(tenant_id(_request("fake-2")))
+
+
+def test_record_leaves_writes_to_the_flush_task(tmp_path):
+    path = str(tmp_path / "usage.db")
+
+    def stored():
+        return sqlite3.connect(path).execute("SELECT SUM(requests) FROM usage").fetchone()[0]
+
+    async def run():
+        ledger = UsageLedger(path=path, flush_interval=0.01)
+        ledger.record("ip:10.0.0.7", "claude-3-haiku-20240307", 1000, 100)
+        assert stored() is None
+        await ledger.start()
+        assert stored() == 1
+        ledger.record("ip:10.0.0.7", "claude-3-haiku-20240307", 1000, 100)
+        await ledger.stop()
+        assert stored() == 2
+
+    asyncio.run(run())
+
+
+def test_day_rollover_and_reports_stay_off_the_event_loop(monkeypatch, tmp_path):
+    path = str(tmp_path / "usage.db")
+
+    async def run():
+        ledger, other = UsageLedger(path=path), UsageLedger(path=path)
+        await ledger.start()
+        await other.start()
+        other.record("ip:10.0.0.7", "claude-3-haiku-20240307", 4000, 0)
+        report = await other.report()
+        assert report["tenants"][0]["cost_usd"] == 0.001
+        # Another worker's spend shows up at the next flush
+        await ledger.refresh()
+        assert ledger.spent_today("ip:10.0.0.7") == 0.001
+
+        def no_sqlite_here(day):
+            raise AssertionError("read the store on the event loop")
+
+        monkeypatch.setattr(ledger, "_read_spent", no_sqlite_here)
+        monkeypatch.setattr(usage, "_today", lambda: "2999-01-01")
+        assert ledger.spent_today("ip:10.0.0.7") == 0.0
+        await ledger.stop()
+        await other.stop()
+
+    asyncio.run(run())
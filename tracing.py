@@ -0,0 +1,261 @@
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+import uuid
+
+import metrics
+
+# Tracing is off unless an exporter is configured:
+#   TRACE_EXPORT_PATH=traces.jsonl          one JSON trace per line
+#   TRACE_OTLP_ENDPOINT=http://host:4318/v1/traces   OTLP/HTTP JSON
+# Every request records a handful of in-memory spans; only traces that are
+# head-sampled (TRACE_SAMPLE_RATE), slow (TRACE_SLOW_MS) or errored are
+# serialized and handed to the exporter thread.
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "5000"))
+
+request_id_var = contextvars.ContextVar("request_id", default="-")
+_trace_var = contextvars.ContextVar("trace", default=None)
+_span_var = contextvars.ContextVar("span", default=None)
+
+
+class Span:
+    __slots__ = ("span_id", "parent_id", "name", "start", "end", "attrs", "error")
+
+    def __init__(self, name, parent_id):
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time()
+        self.end = None
+        self.attrs = {}
+        self.error = None
+
+    def set(self, key, value):
+        self.attrs[key] = value
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, key, value):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    __slots__ = ("trace_id", "request_id", "sampled", "spans", "error")
+
+    def __init__(self, request_id, sampled):
+        self.trace_id = uuid.uuid4().hex
+        self.request_id = request_id
+        self.sampled = sampled
+        self.spans = []
+        self.error = False
+
+
+class span:
+    """Context manager recording a child span of the current request.
+
+    Outside a traced request this is a no-op and yields a span whose
+    ``set`` does nothing.
+    """
+
+    __slots__ = ("name", "_span", "_token")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        trace = _trace_var.get()
+        if trace is None:
+            self._span = None
+            return _NOOP_SPAN
+        parent = _span_var.get()
+        self._span = Span(self.name, parent.span_id if parent else None)
+        trace.spans.append(self._span)
+        self._token = _span_var.set(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb):
+        s = self._span
+        if s is None:
+            return False
+        s.end = time.time()
+        if exc_type is not None:
+            s.error = f"{exc_type.__name__}: {exc}"
+            _trace_var.get().error = True
+        _span_var.reset(self._token)
+        return False
+
+
+def mark_error(message):
+    # Flag the current request as errored even though it did not raise, e.g.
+    # when the analyze endpoint falls back to a demo response.
+    s = _span_var.get()
+    trace = _trace_var.get()
+    if s is not None:
+        s.error = message
+    if trace is not None:
+        trace.error = True
+
+
+class _Exporter:
+    def __init__(self, path=None, endpoint=None):
+        self.path = path
+        self.endpoint = endpoint
+        self._queue = queue.Queue(maxsize=1000)
+        threading.Thread(target=self._run, name="trace-exporter", daemon=True).start()
+
+    def submit(self, trace, duration_ms):
+        try:
+            self._queue.put_nowait((trace, duration_ms))
+        except queue.Full:
+            metrics.incr("traces_dropped")
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 100:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if self.path:
+                    self._write_jsonl(batch)
+                if self.endpoint:
+                    self._post_otlp(batch)
+                metrics.incr("traces_exported", len(batch))
+            except Exception:
+                metrics.incr("traces_export_errors")
+                logging.getLogger(__name__).exception("Trace export failed")
+
+    def _write_jsonl(self, batch):
+        with open(self.path, "a") as f:
+            for trace, duration_ms in batch:
+                f.write(json.dumps({
+                    "trace_id": trace.trace_id,
+                    "request_id": trace.request_id,
+                    "duration_ms": round(duration_ms, 3),
+                    "error": trace.error,
+                    "spans": [
+                        {
+                            "span_id": s.span_id,
+                            "parent_id": s.parent_id,
+                            "name": s.name,
+                            "start": s.start,
+                            "duration_ms": round(((s.end or s.start) - s.start) * 1000, 3),
+                            "attrs": s.attrs,
+                            "error": s.error,
+                        }
+                        for s in trace.spans
+                    ],
+                }) + "\n")
+
+    def _post_otlp(self, batch):
+        spans = []
+        for trace, _ in batch:
+            for s in trace.spans:
+                attrs = dict(s.attrs, request_id=trace.request_id)
+                spans.append({
+                    "traceId": trace.trace_id,
+                    "spanId": s.span_id,
+                    "parentSpanId": s.parent_id or "",
+                    "name": s.name,
+                    "kind": 2 if s.parent_id is None else 1,
+                    "startTimeUnixNano": str(int(s.start * 1e9)),
+                    "endTimeUnixNano": str(int((s.end or s.start) * 1e9)),
+                    "attributes": [
+                        {"key": k, "value": {"stringValue": str(v)}} for k, v in attrs.items()
+                    ],
+                    "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+                })
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [
+                    {"key": "service.name", "value": {"stringValue": "kibbe-analyzer"}},
+                ]},
+                "scopeSpans": [{"scope": {"name": "kibbe-analyzer"}, "spans": spans}],
+            }]
+        }
+        req = urllib.request.Request(
+            self.endpoint,
+            data=json.dumps(payload).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        urllib.request.urlopen(req, timeout=5).close()
+
+
+_exporter = None
+if TRACE_EXPORT_PATH or TRACE_OTLP_ENDPOINT:
+    _exporter = _Exporter(TRACE_EXPORT_PATH, TRACE_OTLP_ENDPOINT)
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class TracingMiddleware:
+    """Assigns every HTTP request an id (honouring an incoming X-Request-ID),
+    echoes it in the response and, when an exporter is configured, records a
+    root span for the request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope.get("headers", ()):
+            if name == b"x-request-id" and value:
+                request_id = value.decode("latin-1")[:64]
+                break
+        if request_id is None:
+            request_id = uuid.uuid4().hex
+        rid_token = request_id_var.set(request_id)
+
+        trace = None
+        if _exporter is not None:
+            trace = Trace(request_id, random.random() < TRACE_SAMPLE_RATE)
+            trace_token = _trace_var.set(trace)
+        status = 500
+
+        async def send_with_request_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-request-id", request_id.encode("latin-1"))
+                ]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            with span(f"{scope['method']} {scope['path']}") as root:
+                await self.app(scope, receive, send_with_request_id)
+                root.set("http.status_code", status)
+        finally:
+            if trace is not None:
+                _trace_var.reset(trace_token)
+                duration_ms = (time.perf_counter() - start) * 1000
+                if status >= 500:
+                    trace.error = True
+                if trace.sampled or trace.error or duration_ms >= TRACE_SLOW_MS:
+                    _exporter.submit(trace, duration_ms)
+            request_id_var.reset(rid_token)
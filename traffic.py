@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+"""Capture of analyze traffic shapes, and replay against a test server.
+
+With TRAFFIC_CAPTURE_PATH set, every analysis requested through
+/api/analyze or a completed resumable upload (or a
+TRAFFIC_CAPTURE_SAMPLE fraction of them) appends one JSON line describing
+its shape: arrival time, byte size, format and dimensions, keyed hashes of
+the image, its perceptual hash (as computed by the server) and the client,
+and how it was answered (status, cache hit, latency, upstream and queue
+time). No pixels
+and no raw hashes are written. Hashes are keyed with TRAFFIC_CAPTURE_SALT,
+so repeats stay recognisable within a capture but cannot be matched against
+known images; set the same salt on every worker and change it per capture.
+
+Replay regenerates synthetic images of the recorded size, format and
+dimensions (the same keyed hash always gives the same bytes, so duplicate
+and cache-hit patterns carry over) and sends them at the recorded arrival
+times, optionally sped up:
+
+    python traffic.py capture.jsonl --spawn --speed 10
+    python traffic.py capture.jsonl --url http://127.0.0.1:8000 --json report.json
+
+``--spawn`` starts upstream_stub.py (answering with the recorded upstream
+latencies) and a fresh server from this tree with empty stores, so two
+builds can be compared on the same capture.
+"""
+import argparse
+import asyncio
+import contextvars
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import queue
+import random
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+from image_probe import ProbeError, probe
+from usage import tenant_id
+
+TRAFFIC_CAPTURE_PATH = os.getenv("TRAFFIC_CAPTURE_PATH")
+TRAFFIC_CAPTURE_SAMPLE = float(os.getenv("TRAFFIC_CAPTURE_SAMPLE", "1.0"))
+# Without a configured salt each process gets its own, which keeps repeats
+# linkable only within that process's lines
+TRAFFIC_CAPTURE_SALT = (os.getenv("TRAFFIC_CAPTURE_SALT") or secrets.token_hex(16)).encode()
+
+_entry_var = contextvars.ContextVar("traffic_entry", default=None)
+
+
+def _keyed(value, digits=16):
+    return hmac.new(TRAFFIC_CAPTURE_SALT, value.encode(), hashlib.sha256).hexdigest()[:digits]
+
+
+class _Writer:
+    # Appends on a background thread so the request path never waits on disk
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.Queue(maxsize=10000)
+        threading.Thread(target=self._run, name="traffic-capture", daemon=True).start()
+
+    def submit(self, entry):
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            metrics.incr("traffic_capture_dropped")
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 500:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with open(self.path, "a") as f:
+                    f.write("".join(json.dumps(entry) + "\n" for entry in batch))
+                metrics.incr("traffic_captured", len(batch))
+            except Exception:
+                metrics.incr("traffic_capture_errors")
+                logging.getLogger(__name__).exception("Traffic capture write failed")
+
+
+_writer = _Writer(TRAFFIC_CAPTURE_PATH) if TRAFFIC_CAPTURE_PATH else None
+
+
+class _NoopEntry:
+    __slots__ = ()
+
+    def finish(self, response):
+        pass
+
+
+_NOOP_ENTRY = _NoopEntry()
+
+
+class _Entry:
+    __slots__ = ("record", "start")
+
+    def __init__(self, record):
+        self.record = record
+        self.start = time.perf_counter()
+
+    def finish(self, response):
+        self.record["status"] = response.status_code
+        self.record["cache"] = response.headers.get("x-cache")
+
+
+class capture:
+    """Context manager recording the shape of one analyze request.
+
+    A no-op unless capture is on and the request is sampled. Call
+    ``finish(response)`` on the yielded entry with the response sent;
+    requests that end in an exception are recorded with its status code.
+    """
+
+    __slots__ = ("request", "contents", "_entry", "_token")
+
+    def __init__(self, request, contents):
+        self.request = request
+        self.contents = contents
+
+    def __enter__(self):
+        if _writer is None or random.random() >= TRAFFIC_CAPTURE_SAMPLE:
+            self._entry = None
+            return _NOOP_ENTRY
+        try:
+            info = probe(self.contents)
+            shape = {"format": info.format, "width": info.width, "height": info.height}
+        except ProbeError:
+            shape = {"format": None, "width": None, "height": None}
+        self._entry = _Entry({
+            "t": round(time.time(), 3),
+            "client": _keyed(tenant_id(self.request), 8),
+            "priority": self.request.headers.get("x-priority", "interactive"),
+            "bytes": len(self.contents),
+            **shape,
+            "image": _keyed(hashlib.sha256(self.contents).hexdigest()),
+            # Set by note_phash once the server has hashed an analyzed image
+            "phash": None,
+        })
+        self._token = _entry_var.set(self._entry)
+        return self._entry
+
+    def __exit__(self, exc_type, exc, tb):
+        entry = self._entry
+        if entry is None:
+            return False
+        _entry_var.reset(self._token)
+        if exc_type is asyncio.CancelledError:
+            # Abandoned before answering, e.g. a consensus photo no
+            # longer needed; recorded like a client disconnect
+            entry.record["status"] = 499
+        elif exc_type is not None:
+            entry.record["status"] = getattr(exc, "status_code", 500)
+        entry.record["latency_ms"] = round((time.perf_counter() - entry.start) * 1000, 1)
+        _writer.submit(entry.record)
+        return False
+
+
+def note(**fields):
+    # Add fields (upstream timings, or the outcome when there is no
+    # response to finish with) to the captured request, if any
+    entry = _entry_var.get()
+    if entry is not None:
+        entry.record.update(fields)
+
+
+def note_phash(phash):
+    # The perceptual hash the server computed, keyed like the image hash
+    entry = _entry_var.get()
+    if entry is not None and phash is not None:
+        entry.record["phash"] = _keyed(phash)
+
+
+# --- Replay -----------------------------------------------------------------
+
+# Formats whose decoders ignore trailing bytes, so they are padded to the
+# recorded size exactly
+_PADDABLE = ("jpeg", "png")
+
+
+# Side of the crop the encoder quality is tuned on; full-size AVIF and HEIC
+# encodes take seconds, so only the final image is encoded at full size
+_SAMPLE_EDGE = 512
+
+
+def _encode(image, format, quality):
+    buffer = io.BytesIO()
+    image.save(buffer, format, quality=quality)
+    return buffer.getvalue()
+
+
+def synthesize(record):
+    """Deterministic image bytes with the recorded shape of ``record``."""
+    size = record["bytes"]
+    rng = random.Random(record["image"])
+    if record["format"] is None:
+        return rng.randbytes(size)  # was not a recognisable image either
+    from PIL import Image
+
+    if record["format"] == "heic":
+        import pillow_heif
+
+        pillow_heif.register_heif_opener()
+    width, height = record["width"], record["height"]
+    # Smooth colour fields with fine noise compress roughly like a photo
+    base = Image.frombytes("RGB", (16, 12), rng.randbytes(16 * 12 * 3))
+    base = base.resize((width, height), Image.Resampling.BICUBIC)
+    noise_size = (max(1, width // 2), max(1, height // 2))
+    noise = Image.frombytes("L", noise_size, rng.randbytes(noise_size[0] * noise_size[1]))
+    noise = Image.merge("RGB", [noise.resize((width, height))] * 3)
+
+    format = "HEIF" if record["format"] == "heic" else record["format"].upper()
+    crop_w, crop_h = min(width, _SAMPLE_EDGE), min(height, _SAMPLE_EDGE)
+    left, top = (width - crop_w) // 2, (height - crop_h) // 2
+    scale = width * height / (crop_w * crop_h)
+    # Less noise until the image can fit the recorded size, then the
+    # highest quality that still does (PNG has no quality knob)
+    for amount in (0.12, 0.03, 0.0):
+        image = Image.blend(base, noise, amount)
+        sample = image.crop((left, top, left + crop_w, top + crop_h))
+        low, high, quality = 10, 95, 10
+        while low <= high:
+            middle = (low + high) // 2
+            if len(_encode(sample, format, middle)) * scale <= size:
+                quality, low = middle, middle + 1
+            else:
+                high = middle - 1
+            if record["format"] == "png":
+                break
+        if len(_encode(sample, format, quality)) * scale <= size:
+            break
+    data = _encode(image, format, quality)
+    if record["format"] in _PADDABLE and len(data) < size:
+        data += bytes(size - len(data))
+    return data
+
+
+def _synthesize_all(records, workers, cache_dir):
+    # One image per distinct keyed hash, generated before the replay starts
+    # and kept in cache_dir so later replays of the capture start at once
+    os.makedirs(cache_dir, exist_ok=True)
+    images, missing = {}, {}
+    for record in records:
+        path = os.path.join(cache_dir, record["image"])
+        if record["image"] in images or record["image"] in missing:
+            continue
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                images[record["image"]] = f.read()
+        else:
+            missing[record["image"]] = record
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for image, data in zip(missing, pool.map(synthesize, missing.values())):
+            with open(os.path.join(cache_dir, image), "wb") as f:
+                f.write(data)
+            images[image] = data
+    return images, len(missing)
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(p * len(values)))], 1) if values else None
+
+
+def summarize(results):
+    """Status mix, cache hit rate and latency percentiles of request outcomes."""
+    statuses = {}
+    for r in results:
+        statuses[str(r.get("status"))] = statuses.get(str(r.get("status")), 0) + 1
+    ok = [r for r in results if r.get("status") == 200]
+    hits = [r for r in ok if r.get("cache") == "hit"]
+    misses = [r for r in ok if r.get("cache") == "miss"]
+    summary = {
+        "requests": len(results),
+        "statuses": statuses,
+        "cache_hit_rate": round(len(hits) / len(ok), 3) if ok else None,
+        # Demo answers after an upstream failure carry no X-Cache header
+        "fallbacks": len(ok) - len(hits) - len(misses),
+    }
+    for label, group in (("all", ok), ("hit", hits), ("miss", misses)):
+        latencies = [r["latency_ms"] for r in group if r.get("latency_ms") is not None]
+        summary[f"latency_ms_{label}"] = {
+            "p50": _percentile(latencies, 0.50),
+            "p90": _percentile(latencies, 0.90),
+            "p99": _percentile(latencies, 0.99),
+            "max": round(max(latencies), 1) if latencies else None,
+        }
+    return summary
+
+
+async def replay(records, images, url, speed):
+    import httpx
+
+    start_t = records[0]["t"]
+    results = []
+    lags = []
+
+    async def send(client, record, delay):
+        await asyncio.sleep(delay)
+        lags.append(max(0.0, time.perf_counter() - begin - delay) * 1000)
+        headers = {"X-API-Key": f"replay-{record['client']}"}
+        if record.get("priority", "interactive") != "interactive":
+            headers["X-Priority"] = record["priority"]
+        files = {"file": ("replay", images[record["image"]], "application/octet-stream")}
+        sent = time.perf_counter()
+        try:
+            response = await client.post(url + "/api/analyze", files=files, headers=headers)
+            status, cache = response.status_code, response.headers.get("x-cache")
+        except httpx.HTTPError:
+            status, cache = None, None
+        results.append({
+            "status": status,
+            "cache": cache,
+            "latency_ms": (time.perf_counter() - sent) * 1000,
+        })
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=100)
+    async with httpx.AsyncClient(limits=limits, timeout=120.0) as client:
+        begin = time.perf_counter()
+        # Open loop: requests go out on schedule whether or not earlier ones
+        # have been answered, as real clients would
+        await asyncio.gather(*(
+            send(client, record, (record["t"] - start_t) / speed) for record in records
+        ))
+    return results, lags
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_until_up(url, process, timeout=30.0):
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"{url} exited during start-up")
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    sys.exit(f"{url} did not start within {timeout:.0f}s")
+
+
+def spawn(records, workdir, speed):
+    """Start an upstream stub and a server from this tree; returns
+    ``(server_url, processes)``. Rate limits are scaled by ``speed`` so a
+    sped-up replay is throttled like the original traffic was."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    latencies = [r["upstream_ms"] for r in records if r.get("upstream_ms") is not None]
+    profile = os.path.join(workdir, "latency.json")
+    with open(profile, "w") as f:
+        json.dump(latencies or [800], f)
+    stub_port, server_port = _free_port(), _free_port()
+    env = dict(os.environ, STUB_LATENCY_PROFILE=profile)
+    env.pop("TRAFFIC_CAPTURE_PATH", None)
+    stub = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "upstream_stub:app", "--port", str(stub_port), "--log-level", "warning"],
+        cwd=here, env=env,
+    )
+    _wait_until_up(f"http://127.0.0.1:{stub_port}/", stub)
+    env.update(
+        ANTHROPIC_BASE_URL=f"http://127.0.0.1:{stub_port}",
+        CLAUDE_API_KEY="stub",
+        RESULT_STORE_PATH=os.path.join(workdir, "results.db"),
+        USAGE_STORE_PATH=os.path.join(workdir, "usage.db"),
+        UPLOAD_SPOOL_DIR=os.path.join(workdir, "uploads"),
+    )
+    env.pop("CLAUDE_API_KEYS", None)
+    # Replayed clients are told apart by their X-API-Key, as in the capture
+    env["API_KEYS"] = ",".join(sorted({f"replay-{r['client']}" for r in records}))
+    env["RATE_LIMIT_PER_MINUTE"] = str(float(os.getenv("RATE_LIMIT_PER_MINUTE", "10")) * speed)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(server_port), "--log-level", "warning"],
+        cwd=here, env=env,
+    )
+    url = f"http://127.0.0.1:{server_port}"
+    _wait_until_up(url + "/api/health/live", server)
+    return url, [server, stub]
+
+
+def _print_comparison(recorded, replayed, lags):
+    print(f"{'':<22}{'recorded':>12}{'replayed':>12}")
+    print(f"{'requests':<22}{recorded['requests']:>12}{replayed['requests']:>12}")
+    print(f"{'cache hit rate':<22}{recorded['cache_hit_rate']!s:>12}{replayed['cache_hit_rate']!s:>12}")
+    print(f"{'fallbacks':<22}{recorded['fallbacks']:>12}{replayed['fallbacks']:>12}")
+    for label in ("all", "hit", "miss"):
+        for p in ("p50", "p90", "p99", "max"):
+            key = f"latency_ms_{label}"
+            print(f"{label + ' latency ' + p + ' ms':<22}{recorded[key][p]!s:>12}{replayed[key][p]!s:>12}")
+    print(f"statuses recorded {recorded['statuses']}, replayed {replayed['statuses']}")
+    print(f"send lag p99 {_percentile(lags, 0.99)} ms (high values mean the replayer fell behind)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a traffic capture against a server.")
+    parser.add_argument("capture", help="JSONL file written with TRAFFIC_CAPTURE_PATH")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="server to replay against, e.g. http://127.0.0.1:8000")
+    target.add_argument("--spawn", action="store_true", help="start a stub-backed server from this tree")
+    parser.add_argument("--speed", type=float, default=1.0, help="arrival-time speed-up factor")
+    parser.add_argument("--limit", type=int, help="replay only the first N requests")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="image generation processes")
+    parser.add_argument("--images", help="where generated images are kept (default: <capture>.images)")
+    parser.add_argument("--json", help="also write the comparison to this file")
+    args = parser.parse_args()
+
+    with open(args.capture) as f:
+        records = sorted((json.loads(line) for line in f if line.strip()), key=lambda r: r["t"])
+    records = records[:args.limit] if args.limit else records
+    if not records:
+        sys.exit("capture is empty")
+
+    start = time.perf_counter()
+    images, generated = _synthesize_all(records, args.workers, args.images or args.capture + ".images")
+    print(f"{len(images)} distinct images for {len(records)} requests, {generated} generated"
+          f" in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    processes = []
+    with tempfile.TemporaryDirectory(prefix="kibbe-replay-") as workdir:
+        try:
+            url = args.url.rstrip("/") if args.url else None
+            if args.spawn:
+                url, processes = spawn(records, workdir, args.speed)
+            span = (records[-1]["t"] - records[0]["t"]) / args.speed
+            print(f"replaying against {url} over {span:.1f}s", file=sys.stderr)
+            results, lags = asyncio.run(replay(records, images, url, args.speed))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+    recorded, replayed = summarize(records), summarize(results)
+    _print_comparison(recorded, replayed, lags)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"recorded": recorded, "replayed": replayed, "speed": args.speed}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
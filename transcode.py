@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""Transcoding of uploads the upstream does not accept.
+
+The upstream takes JPEG, PNG and WebP as they are. AVIF and HEIC (most
+iPhone photos) are decoded in a dedicated process pool, scaled down to
+TRANSCODE_MAX_EDGE (the model resizes anything larger itself) and
+re-encoded as each of TRANSCODE_FORMATS; whichever comes out smallest is
+sent. This needs Pillow, plus pillow-heif for HEIC; without them those
+uploads are refused with 415.
+
+Benchmark transcoding throughput per input format, on a synthetic photo
+or on your own files:
+
+    python transcode.py
+    python transcode.py IMG_0001.HEIC photo.avif --rounds 20
+"""
+import argparse
+import asyncio
+import functools
+import io
+import multiprocessing
+import os
+import sys
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from importlib.util import find_spec
+
+import metrics
+from image_probe import MAX_IMAGE_PIXELS, ImageInfo
+
+# Formats sent upstream as uploaded
+PASSTHROUGH_FORMATS = frozenset({"jpeg", "png", "webp"})
+TRANSCODE_FORMATS = tuple(
+    f.strip() for f in os.getenv("TRANSCODE_FORMATS", "webp,jpeg").split(",") if f.strip()
+)
+TRANSCODE_QUALITY = int(os.getenv("TRANSCODE_QUALITY", "85"))
+TRANSCODE_MAX_EDGE = int(os.getenv("TRANSCODE_MAX_EDGE", "1568"))
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", str(min(2, os.cpu_count() or 1))))
+
+_MEDIA_TYPES = {"jpeg": "image/jpeg", "png": "image/png", "webp": "image/webp"}
+
+
+class TranscodeError(Exception):
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+@functools.lru_cache(maxsize=None)
+def decodable_formats():
+    """Input formats this server can accept, given the installed codecs."""
+    formats = set(PASSTHROUGH_FORMATS)
+    if find_spec("PIL") is not None:
+        from PIL import features
+
+        if features.check("avif"):
+            formats.add("avif")
+        if find_spec("pillow_heif") is not None:
+            formats.add("heic")
+    return frozenset(formats)
+
+
+@functools.lru_cache(maxsize=None)
+def _register_plugins():
+    if find_spec("pillow_heif") is not None:
+        import pillow_heif
+
+        pillow_heif.register_heif_opener()
+
+
+def transcode_sync(data, formats=TRANSCODE_FORMATS, quality=TRANSCODE_QUALITY, max_edge=TRANSCODE_MAX_EDGE):
+    """Decode ``data``, fit it within ``max_edge`` and re-encode it as each
+    of ``formats``.
+
+    Returns ``(encoded, info)`` for the smallest encoding. Runs in the
+    transcode pool; the pixel ceiling is enforced again at decode time in
+    case the headers lied.
+    """
+    from PIL import Image, ImageOps
+
+    _register_plugins()
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", Image.DecompressionBombWarning)
+        with Image.open(io.BytesIO(data)) as image:
+            image = ImageOps.exif_transpose(image).convert("RGB")
+    image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    best = None
+    for format in formats:
+        buffer = io.BytesIO()
+        image.save(buffer, format.upper(), quality=quality)
+        if best is None or buffer.tell() < len(best[0]):
+            best = (buffer.getvalue(), format)
+    encoded, format = best
+    return encoded, ImageInfo(format, _MEDIA_TYPES[format], image.width, image.height, 8, 3)
+
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # Spawned, not forked: a forked worker would inherit the server's
+        # listening socket and signal handlers and could outlive it
+        _executor = ProcessPoolExecutor(
+            max_workers=TRANSCODE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _executor
+
+
+def _replace_broken(executor):
+    # A worker that died (OOM kill, decoder crash) breaks the whole pool for
+    # good; the next transcode starts a fresh one. Concurrent failures on the
+    # same pool only replace it once.
+    global _executor
+    if _executor is executor:
+        _executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+        metrics.incr("transcode_pool_restarts")
+
+
+def shutdown_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None
+
+
+async def transcode(data, info, max_edge=None):
+    """Return ``(data, info)`` in a format the upstream accepts.
+
+    Accepted formats are returned unchanged unless ``max_edge`` asks for a
+    smaller image; anything else is re-encoded in the transcode pool.
+    Raises :class:`TranscodeError` when the format is unsupported here or
+    the image cannot be decoded (4xx), or when a pool worker died (503).
+    """
+    if info.format in PASSTHROUGH_FORMATS and (
+        max_edge is None or max(info.width, info.height) <= max_edge or find_spec("PIL") is None
+    ):
+        metrics.incr("transcode_passthrough")
+        return data, info
+    if info.format not in decodable_formats():
+        metrics.incr(f"transcode_unsupported_{info.format}")
+        raise TranscodeError(415, f"{info.format.upper()} images are not supported on this server.")
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    executor = _get_executor()
+    try:
+        encoded, encoded_info = await loop.run_in_executor(
+            executor, transcode_sync, data, TRANSCODE_FORMATS, TRANSCODE_QUALITY,
+            max_edge or TRANSCODE_MAX_EDGE,
+        )
+    except (BrokenProcessPool, MemoryError) as e:
+        # Server-side failures, not the upload's fault
+        metrics.incr(f"transcode_failed_{info.format}")
+        if isinstance(e, BrokenProcessPool):
+            _replace_broken(executor)
+        raise TranscodeError(503, f"Could not convert the {info.format.upper()} image right now. Please try again.")
+    except Exception as e:
+        metrics.incr(f"transcode_failed_{info.format}")
+        raise TranscodeError(400, f"Could not decode {info.format.upper()} image: {e}")
+    metrics.incr(f"transcode_{info.format}_to_{encoded_info.format}")
+    metrics.incr("transcode_ms", round((time.perf_counter() - start) * 1000))
+    metrics.incr("transcode_bytes_saved", len(data) - len(encoded))
+    return encoded, encoded_info
+
+
+def _synthetic_photo(width=4032, height=3024):
+    # Smooth gradients plus noise compress roughly like a real photo
+    from PIL import Image
+
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 6)
+    return Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+
+
+def _benchmark_inputs(paths):
+    if paths:
+        for path in paths:
+            with open(path, "rb") as f:
+                yield path, f.read()
+        return
+    _register_plugins()
+    photo = _synthetic_photo()
+    for format in sorted(decodable_formats() - PASSTHROUGH_FORMATS):
+        buffer = io.BytesIO()
+        photo.save(buffer, "HEIF" if format == "heic" else format.upper(), quality=80)
+        yield f"synthetic 12 MP {format}", buffer.getvalue()
+
+
+def benchmark(paths, rounds, workers):
+    if find_spec("PIL") is None:
+        sys.exit("Transcoding needs Pillow (pip install Pillow pillow-heif)")
+    from image_probe import probe
+
+    print(f"decodable formats: {', '.join(sorted(decodable_formats()))}; "
+          f"targets: {', '.join(TRANSCODE_FORMATS)}; workers: {workers}")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for label, data in _benchmark_inputs(paths):
+            info = probe(data)
+            # Warm the workers so process start-up is not measured
+            list(pool.map(transcode_sync, [data] * workers))
+            start = time.perf_counter()
+            encoded, out = list(pool.map(transcode_sync, [data] * rounds))[-1]
+            elapsed = time.perf_counter() - start
+            print(f"{label}: {info.width}x{info.height} {info.format} {len(data) / 1024:.0f} KB"
+                  f" -> {out.format} {len(encoded) / 1024:.0f} KB,"
+                  f" {rounds / elapsed:.1f} images/s, {elapsed / rounds * workers * 1000:.0f} ms per image per worker")
+    print("Keep the per-image time well below the upstream call (typically 2-5 s).")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark transcoding throughput per format.")
+    parser.add_argument("paths", nargs="*", help="images to transcode (default: synthetic photos)")
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=TRANSCODE_WORKERS)
+    args = parser.parse_args()
+    benchmark(args.paths, args.rounds, args.workers)
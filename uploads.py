@@ -0,0 +1,274 @@
+import asyncio
+import base64
+import json
+import os
+import secrets
+import tempfile
+import time
+
+import metrics
+
+# Resumable (tus-style) uploads. Chunks are appended to a spool file whose
+# size is the upload offset, with a small JSON sidecar for metadata, so any
+# worker process can resume an upload. Spool files are deleted as soon as
+# the upload is analyzed or expires. File I/O runs on worker threads;
+# reservations and locks are only touched on the event loop.
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "kibbe-uploads"))
+UPLOAD_SPOOL_MAX_BYTES = int(os.getenv("UPLOAD_SPOOL_MAX_BYTES", str(200 * 1024 * 1024)))
+UPLOAD_EXPIRY_SECONDS = float(os.getenv("UPLOAD_EXPIRY_SECONDS", "3600"))
+# How often expired uploads are removed from the spool
+UPLOAD_SWEEP_SECONDS = 60
+MAX_UPLOAD_BYTES = 5 * 1024 * 1024
+TUS_VERSION = "1.0.0"
+
+
+class UploadError(Exception):
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def parse_metadata(header):
+    # tus Upload-Metadata: "key base64value,key2 base64value2"
+    metadata = {}
+    for pair in (header or "").split(","):
+        parts = pair.strip().split(" ", 1)
+        if not parts[0]:
+            continue
+        try:
+            metadata[parts[0]] = base64.b64decode(parts[1]).decode() if len(parts) == 2 else ""
+        except (ValueError, UnicodeDecodeError):
+            raise UploadError(400, "Malformed Upload-Metadata header.")
+    return metadata
+
+
+class Upload:
+    __slots__ = ("id", "length", "offset", "content_type", "expires_at", "sha256")
+
+    def __init__(self, upload_id, length, offset, content_type, expires_at, sha256=None):
+        self.id = upload_id
+        self.length = length
+        self.offset = offset
+        self.content_type = content_type
+        self.expires_at = expires_at
+        # Set once the last chunk has landed and the bytes were handed off
+        self.sha256 = sha256
+
+    @property
+    def complete(self):
+        return self.offset >= self.length
+
+
+class UploadSpool:
+    def __init__(self, directory=UPLOAD_SPOOL_DIR, max_bytes=UPLOAD_SPOOL_MAX_BYTES,
+                 expiry=UPLOAD_EXPIRY_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.expiry = expiry
+        self._locks = {}
+        self._task = None
+        os.makedirs(directory, exist_ok=True)
+        # Space is reserved for the full declared length of every pending
+        # upload. Tracked in memory so admission never lists the spool; the
+        # uploads already pending are read once, when the spool is opened,
+        # and the sweep drops ones finished or removed by other workers.
+        self._reserved = self._pending_uploads()
+        self.reserved_bytes = sum(self._reserved.values())
+        metrics.register_gauge("upload_spool_bytes", lambda: self.reserved_bytes)
+
+    def _data_path(self, upload_id):
+        return os.path.join(self.directory, upload_id + ".part")
+
+    def _meta_path(self, upload_id):
+        return os.path.join(self.directory, upload_id + ".json")
+
+    def _read_metas(self):
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                meta = None
+            yield name[:-5], meta
+
+    def _pending_uploads(self):
+        return {
+            upload_id: meta.get("length", 0)
+            for upload_id, meta in self._read_metas()
+            if meta and not meta.get("sha256") and meta.get("expires_at", 0) > time.time()
+        }
+
+    def _reserve(self, upload_id, length):
+        self._reserved[upload_id] = length
+        self.reserved_bytes += length
+
+    def _release(self, upload_id):
+        self.reserved_bytes -= self._reserved.pop(upload_id, 0)
+
+    def start(self):
+        self._task = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(UPLOAD_SWEEP_SECONDS)
+            await self.sweep()
+
+    async def sweep(self):
+        gone = await asyncio.to_thread(self._sweep_files, set(self._reserved))
+        for upload_id in gone:
+            self._release(upload_id)
+            self._locks.pop(upload_id, None)
+
+    def _sweep_files(self, reserved):
+        # Deletes expired uploads; returns which of ``reserved`` are no
+        # longer pending (expired, finished, or gone)
+        now = time.time()
+        pending = set()
+        for upload_id, meta in self._read_metas():
+            try:
+                expired = meta["expires_at"] <= now
+            except (TypeError, KeyError):
+                expired = True
+            if expired:
+                self._remove_files(upload_id)
+                metrics.incr("uploads_expired")
+            elif not meta.get("sha256"):
+                pending.add(upload_id)
+        return reserved - pending
+
+    async def create(self, length, content_type):
+        if length <= 0 or length > MAX_UPLOAD_BYTES:
+            raise UploadError(413, "File too large. Maximum size is 5MB.")
+        if self.reserved_bytes + length > self.max_bytes:
+            metrics.incr("uploads_rejected_spool_full")
+            raise UploadError(503, "Upload spool is full. Please try again shortly.")
+        upload_id = secrets.token_urlsafe(16)
+        expires_at = time.time() + self.expiry
+        # Reserved before the files are written so concurrent creates
+        # cannot overcommit the spool meanwhile
+        self._reserve(upload_id, length)
+        try:
+            await asyncio.to_thread(self._create_files, upload_id, {
+                "length": length,
+                "content_type": content_type,
+                "expires_at": expires_at,
+            })
+        except BaseException:
+            self._release(upload_id)
+            raise
+        metrics.incr("uploads_created")
+        return Upload(upload_id, length, 0, content_type, expires_at)
+
+    def _create_files(self, upload_id, meta):
+        with open(self._meta_path(upload_id), "w") as f:
+            json.dump(meta, f)
+        open(self._data_path(upload_id), "wb").close()
+
+    async def get(self, upload_id):
+        if not upload_id.replace("-", "").replace("_", "").isalnum():
+            raise UploadError(404, "Upload not found.")
+        upload = await asyncio.to_thread(self._load, upload_id)
+        if upload.expires_at <= time.time():
+            await self.delete(upload_id)
+            raise UploadError(410, "Upload expired.")
+        return upload
+
+    def _load(self, upload_id):
+        try:
+            with open(self._meta_path(upload_id)) as f:
+                meta = json.load(f)
+            if meta.get("sha256"):
+                offset = meta["length"]
+            else:
+                offset = os.path.getsize(self._data_path(upload_id))
+        except (OSError, ValueError):
+            raise UploadError(404, "Upload not found.")
+        return Upload(upload_id, meta["length"], offset, meta["content_type"],
+                      meta["expires_at"], meta.get("sha256"))
+
+    async def append(self, upload_id, offset, chunk):
+        """Append ``chunk`` at ``offset`` and return the updated upload."""
+        lock = self._locks.setdefault(upload_id, asyncio.Lock())
+        async with lock:
+            upload = await self.get(upload_id)
+            if upload.sha256 is not None or upload.complete:
+                # Its bytes were already handed to the analyzer
+                raise UploadError(409, "Upload is already complete.")
+            if offset != upload.offset:
+                raise UploadError(409, "Upload-Offset does not match the current offset.")
+            if upload.offset + len(chunk) > upload.length:
+                raise UploadError(413, "Chunk exceeds the declared Upload-Length.")
+            await asyncio.to_thread(self._write, upload_id, chunk)
+            upload.offset += len(chunk)
+            metrics.incr("upload_bytes_received", len(chunk))
+            return upload
+
+    def _write(self, upload_id, chunk):
+        # Never creates the spool file: a missing one means the upload was
+        # finished or deleted meanwhile
+        try:
+            fd = os.open(self._data_path(upload_id), os.O_WRONLY | os.O_APPEND)
+        except FileNotFoundError:
+            raise UploadError(404, "Upload not found.")
+        with os.fdopen(fd, "ab") as f:
+            f.write(chunk)
+
+    async def read(self, upload_id):
+        return await asyncio.to_thread(self._read, upload_id)
+
+    def _read(self, upload_id):
+        with open(self._data_path(upload_id), "rb") as f:
+            return f.read()
+
+    async def finish(self, upload_id, sha256):
+        """Drop the spooled bytes of a complete upload, keeping only its
+        hash so the result can still be fetched until it expires."""
+        upload = await self.get(upload_id)
+        await asyncio.to_thread(self._finish_files, upload, sha256)
+        self._locks.pop(upload_id, None)
+        self._release(upload_id)
+        metrics.incr("uploads_completed")
+
+    def _finish_files(self, upload, sha256):
+        with open(self._meta_path(upload.id), "w") as f:
+            json.dump({
+                "length": upload.length,
+                "content_type": upload.content_type,
+                "expires_at": upload.expires_at,
+                "sha256": sha256,
+            }, f)
+        try:
+            os.remove(self._data_path(upload.id))
+        except FileNotFoundError:
+            pass
+
+    async def delete(self, upload_id):
+        await asyncio.to_thread(self._remove_files, upload_id)
+        self._locks.pop(upload_id, None)
+        self._release(upload_id)
+
+    def _remove_files(self, upload_id):
+        for path in (self._data_path(upload_id), self._meta_path(upload_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+_spool = None
+
+
+def get_spool():
+    global _spool
+    if _spool is None:
+        _spool = UploadSpool()
+    return _spool
@@ -0,0 +1,190 @@
+"""Local stand-in for the upstream Messages API.
+
+Answers /v1/messages and the Message Batches endpoints with deterministic
+analyses (the same image always gets the same labels) after a configurable
+delay, so load tests and bulk runs never touch the paid API:
+
+    uvicorn upstream_stub:app --port 8001
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8001 CLAUDE_API_KEY=stub uvicorn main:app
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "800"))
+# Optional JSON list of latencies in ms (traffic.py writes one from a
+# capture); each image gets one of them, picked by its hash, so a replay
+# sees the recorded latency mix and the same image always takes as long
+STUB_LATENCY_PROFILE = os.getenv("STUB_LATENCY_PROFILE")
+STUB_BATCH_SECONDS = float(os.getenv("STUB_BATCH_SECONDS", "5"))
+# Per-API-key request limit per minute, reported in anthropic-ratelimit-*
+# headers and enforced with 429s (0 disables it)
+STUB_REQUESTS_PER_MINUTE = int(os.getenv("STUB_REQUESTS_PER_MINUTE", "0"))
+
+ARCHETYPES = [
+    "Dramatic", "Soft Dramatic", "Flamboyant Natural", "Soft Natural", "Dramatic Classic",
+    "Soft Classic", "Flamboyant Gamine", "Soft Gamine", "Theatrical Romantic", "Romantic",
+]
+SEASONS = [
+    "Bright Spring", "True Spring", "Light Spring", "Light Summer", "True Summer", "Soft Summer",
+    "Soft Autumn", "True Autumn", "Dark Autumn", "Dark Winter", "True Winter", "Bright Winter",
+]
+
+app = FastAPI(title="Upstream stub")
+
+_batches = {}
+_windows = {}
+_latencies = None
+if STUB_LATENCY_PROFILE:
+    with open(STUB_LATENCY_PROFILE) as f:
+        _latencies = json.load(f)
+
+
+def _image_data(params):
+    for block in params["messages"][0]["content"]:
+        if block.get("type") == "image":
+            return block["source"]["data"]
+    return ""
+
+
+def _message(params):
+    data = _image_data(params)
+    digest = hashlib.sha256(data.encode()).digest()
+    season = SEASONS[digest[1] % len(SEASONS)]
+    text = json.dumps({
+        "kibbe_archetype": ARCHETYPES[digest[0] % len(ARCHETYPES)],
+        "color_season": season,
+        "palette_description": f"Stub palette for {season}.",
+    })
+    return {
+        "id": "msg_" + uuid.uuid4().hex[:24],
+        "type": "message",
+        "role": "assistant",
+        "model": params.get("model", "stub"),
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        # Rough stand-in for image token counts: ~1 token per 750 base64 chars
+        "usage": {"input_tokens": 60 + len(data) // 750, "output_tokens": len(text) // 4},
+    }
+
+
+def _latency_ms(params):
+    if not _latencies:
+        return STUB_LATENCY_MS
+    digest = hashlib.sha256(_image_data(params).encode()).digest()
+    return _latencies[int.from_bytes(digest[:4], "big") % len(_latencies)]
+
+
+def _rate_limit(api_key):
+    # Fixed one-minute window per key; returns (allowed, headers)
+    if not STUB_REQUESTS_PER_MINUTE:
+        return True, {}
+    now = time.time()
+    window_start, used = _windows.get(api_key, (now, 0))
+    if now - window_start >= 60:
+        window_start, used = now, 0
+    allowed = used < STUB_REQUESTS_PER_MINUTE
+    if allowed:
+        used += 1
+    _windows[api_key] = (window_start, used)
+    reset = datetime.fromtimestamp(window_start + 60, timezone.utc)
+    headers = {
+        "anthropic-ratelimit-requests-limit": str(STUB_REQUESTS_PER_MINUTE),
+        "anthropic-ratelimit-requests-remaining": str(STUB_REQUESTS_PER_MINUTE - used),
+        "anthropic-ratelimit-requests-reset": reset.isoformat().replace("+00:00", "Z"),
+    }
+    if not allowed:
+        headers["retry-after"] = str(max(1, int(window_start + 60 - now)))
+    return allowed, headers
+
+
+@app.post("/v1/messages")
+async def create_message(request: Request):
+    params = await request.json()
+    allowed, headers = _rate_limit(request.headers.get("x-api-key", ""))
+    if not allowed:
+        return JSONResponse(
+            {"type": "error", "error": {"type": "rate_limit_error", "message": "Rate limited"}},
+            status_code=429,
+            headers=headers,
+        )
+    await asyncio.sleep(_latency_ms(params) / 1000)
+    return JSONResponse(_message(params), headers=headers)
+
+
+def _batch_view(request, batch):
+    ended = time.time() >= batch["ends_at"]
+    count = len(batch["requests"])
+    return {
+        "id": batch["id"],
+        "type": "message_batch",
+        "processing_status": "ended" if ended else "in_progress",
+        "request_counts": {
+            "processing": 0 if ended else count,
+            "succeeded": count if ended else 0,
+            "errored": 0,
+            "canceled": 0,
+            "expired": 0,
+        },
+        "created_at": datetime.fromtimestamp(batch["created_at"], timezone.utc).isoformat().replace("+00:00", "Z"),
+        "results_url": str(request.url_for("batch_results", batch_id=batch["id"])) if ended else None,
+    }
+
+
+@app.post("/v1/messages/batches")
+async def create_batch(request: Request):
+    body = await request.json()
+    now = time.time()
+    batch = {
+        "id": "msgbatch_" + uuid.uuid4().hex[:24],
+        "requests": body["requests"],
+        "created_at": now,
+        "ends_at": now + STUB_BATCH_SECONDS,
+    }
+    _batches[batch["id"]] = batch
+    return _batch_view(request, batch)
+
+
+@app.get("/v1/messages/batches")
+async def list_batches(request: Request, limit: int = 20, after_id: str = None):
+    # Newest first, paged with after_id like the real endpoint
+    ordered = sorted(_batches.values(), key=lambda b: b["created_at"], reverse=True)
+    ids = [b["id"] for b in ordered]
+    start = ids.index(after_id) + 1 if after_id in ids else 0
+    page = ordered[start:start + limit]
+    return {
+        "data": [_batch_view(request, b) for b in page],
+        "has_more": start + limit < len(ordered),
+        "first_id": page[0]["id"] if page else None,
+        "last_id": page[-1]["id"] if page else None,
+    }
+
+
+@app.get("/v1/messages/batches/{batch_id}")
+async def get_batch(batch_id: str, request: Request):
+    if batch_id not in _batches:
+        raise HTTPException(status_code=404, detail="batch not found")
+    return _batch_view(request, _batches[batch_id])
+
+
+@app.get("/v1/messages/batches/{batch_id}/results", name="batch_results")
+async def batch_results(batch_id: str):
+    batch = _batches.get(batch_id)
+    if batch is None or time.time() < batch["ends_at"]:
+        raise HTTPException(status_code=404, detail="results not available")
+    lines = (
+        json.dumps({
+            "custom_id": r["custom_id"],
+            "result": {"type": "succeeded", "message": _message(r["params"])},
+        })
+        for r in batch["requests"]
+    )
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="application/x-jsonl")
@@ -0,0 +1,256 @@
+import asyncio
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+
+import metrics
+from rate_limit import client_id
+
+# Token usage and cost per UTC day, tenant and model. Calls are added to
+# small in-memory counters, which a background task started from the app
+# lifespan writes to USAGE_STORE_PATH every USAGE_FLUSH_SECONDS on a worker
+# thread, reading back today's totals at the same time, so the request path
+# never waits on the disk.
+USAGE_STORE_PATH = os.getenv("USAGE_STORE_PATH", "usage.db")
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "30"))
+
+# Daily spend per tenant in USD (0 = unlimited). TENANT_BUDGETS overrides it
+# per tenant as JSON, e.g. {"key:3f2a9c1b7d4e": 20, "ip:10.0.0.7": 0.5}.
+TENANT_DAILY_BUDGET_USD = float(os.getenv("TENANT_DAILY_BUDGET_USD", "0"))
+TENANT_BUDGETS = json.loads(os.getenv("TENANT_BUDGETS") or "{}")
+# What an over-budget tenant gets: "cache_only" (stored results only) or
+# "degraded" (analysis continues on a small image, far fewer input tokens)
+TENANT_BUDGET_MODE = os.getenv("TENANT_BUDGET_MODE", "cache_only")
+
+# USD per million input / output tokens
+MODEL_PRICES = {
+    "claude-3-haiku-20240307": (0.25, 1.25),
+    "claude-3-5-haiku-20241022": (0.80, 4.00),
+    "claude-3-5-sonnet-20240620": (3.00, 15.00),
+}
+# Message Batches are billed at half price
+BATCH_DISCOUNT = 0.5
+
+
+def tenant_id(request):
+    # Same identity as the rate limiter: a key listed in API_KEYS or the
+    # client IP, never a value the client can mint, so rotating X-API-Key
+    # does not escape a budget. Keys are reduced to a short fingerprint so
+    # they never reach the usage store or the admin API
+    ident = client_id(request.scope)
+    if ident.startswith("key:"):
+        return "key:" + hashlib.sha256(ident[4:].encode()).hexdigest()[:12]
+    return ident
+
+
+def cost_micro_usd(model, input_tokens, output_tokens):
+    # Price per million tokens is exactly micro-USD per token
+    price_in, price_out = MODEL_PRICES.get(model, (0.0, 0.0))
+    return input_tokens * price_in + output_tokens * price_out
+
+
+def _today():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+def seconds_until_reset():
+    now = datetime.now(timezone.utc)
+    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (midnight - now).total_seconds()
+
+
+class _Counter:
+    __slots__ = ("requests", "input_tokens", "output_tokens", "cost")
+
+    def __init__(self):
+        self.requests = self.input_tokens = self.output_tokens = 0
+        self.cost = 0.0
+
+
+class UsageLedger:
+    """Per-tenant usage counters with periodic flushes to SQLite.
+
+    Today's spend per tenant is kept in memory for budget checks and
+    reloaded from the store on every flush. Between flushes each worker
+    process only adds its own calls, so with several workers budgets are
+    approximate. When the day rolls over, spend starts from zero until the
+    next flush reloads it.
+    """
+
+    def __init__(self, path=USAGE_STORE_PATH, flush_interval=USAGE_FLUSH_SECONDS):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS usage (
+                day TEXT NOT NULL,
+                tenant TEXT NOT NULL,
+                model TEXT NOT NULL,
+                requests INTEGER NOT NULL,
+                input_tokens INTEGER NOT NULL,
+                output_tokens INTEGER NOT NULL,
+                cost_micro_usd REAL NOT NULL,
+                PRIMARY KEY (day, tenant, model)
+            )"""
+        )
+        self._pending = {}
+        self._task = None
+        self._day = None
+        self._spent = {}
+
+    def _roll_day(self):
+        day = _today()
+        if self._day is None:
+            # First use outside the app (batch and bulk runs); the app
+            # loads the day on a worker thread in start()
+            self._day, self._spent = day, self._read_spent(day)
+        elif day != self._day:
+            self._day, self._spent = day, {}
+        return day
+
+    def _read_spent(self, day):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT tenant, SUM(cost_micro_usd) FROM usage WHERE day = ? GROUP BY tenant", (day,)
+            ).fetchall()
+        return dict(rows)
+
+    def _write_and_read(self, pending, day):
+        self._write(pending)
+        return self._read_spent(day)
+
+    async def refresh(self):
+        """Flush the counters and reload today's spend, both off the event
+        loop. Calls recorded meanwhile are added back on top."""
+        day = _today()
+        spent = await asyncio.to_thread(self._write_and_read, self._take_pending(), day)
+        for (pending_day, tenant, _), counter in self._pending.items():
+            if pending_day == day:
+                spent[tenant] = spent.get(tenant, 0.0) + counter.cost
+        self._day, self._spent = day, spent
+
+    def record(self, tenant, model, input_tokens, output_tokens, batch=False):
+        """Add one upstream call; returns its cost in USD."""
+        day = self._roll_day()
+        cost = cost_micro_usd(model, input_tokens, output_tokens) * (BATCH_DISCOUNT if batch else 1.0)
+        counter = self._pending.get((day, tenant, model))
+        if counter is None:
+            counter = self._pending[(day, tenant, model)] = _Counter()
+        counter.requests += 1
+        counter.input_tokens += input_tokens
+        counter.output_tokens += output_tokens
+        counter.cost += cost
+        self._spent[tenant] = self._spent.get(tenant, 0.0) + cost
+        metrics.incr("usage_input_tokens", input_tokens)
+        metrics.incr("usage_output_tokens", output_tokens)
+        metrics.incr("usage_cost_micro_usd", round(cost))
+        return cost / 1e6
+
+    async def start(self):
+        await self.refresh()
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await asyncio.to_thread(self._write, self._take_pending())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # Counters are swapped out on the event loop, where record()
+            # runs, and only the SQLite work goes to a thread
+            await self.refresh()
+
+    def _take_pending(self):
+        pending, self._pending = self._pending, {}
+        return pending
+
+    def flush(self):
+        self._write(self._take_pending())
+
+    def _write(self, pending):
+        if not pending:
+            return
+        with self._lock:
+            self._db.executemany(
+                "INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (day, tenant, model) DO UPDATE SET"
+                " requests = requests + excluded.requests,"
+                " input_tokens = input_tokens + excluded.input_tokens,"
+                " output_tokens = output_tokens + excluded.output_tokens,"
+                " cost_micro_usd = cost_micro_usd + excluded.cost_micro_usd",
+                [
+                    (day, tenant, model, c.requests, c.input_tokens, c.output_tokens, c.cost)
+                    for (day, tenant, model), c in pending.items()
+                ],
+            )
+        metrics.incr("usage_flushes")
+
+    def spent_today(self, tenant):
+        self._roll_day()
+        return self._spent.get(tenant, 0.0) / 1e6
+
+    def budget(self, tenant):
+        budget = TENANT_BUDGETS.get(tenant, TENANT_DAILY_BUDGET_USD)
+        return budget or None
+
+    def over_budget(self, tenant):
+        budget = self.budget(tenant)
+        return budget is not None and self.spent_today(tenant) >= budget
+
+    def mode(self, tenant):
+        # "normal", or TENANT_BUDGET_MODE once today's budget is spent
+        if not self.over_budget(tenant):
+            return "normal"
+        metrics.incr(f"budget_{TENANT_BUDGET_MODE}")
+        return TENANT_BUDGET_MODE
+
+    async def report(self, day=None, tenant=None):
+        day = day or _today()
+        rows = await asyncio.to_thread(self._write_and_query, self._take_pending(), day, tenant)
+        tenants = {}
+        for tenant, model, requests, input_tokens, output_tokens, cost in rows:
+            entry = tenants.setdefault(tenant, {"tenant": tenant, "cost_usd": 0.0, "models": []})
+            entry["cost_usd"] += cost / 1e6
+            entry["models"].append({
+                "model": model,
+                "requests": requests,
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "cost_usd": round(cost / 1e6, 6),
+            })
+        for entry in tenants.values():
+            entry["cost_usd"] = round(entry["cost_usd"], 6)
+            entry["budget_usd"] = self.budget(entry["tenant"])
+            if day == _today():
+                entry["mode"] = TENANT_BUDGET_MODE if self.over_budget(entry["tenant"]) else "normal"
+        return {"day": day, "tenants": list(tenants.values())}
+
+    def _write_and_query(self, pending, day, tenant):
+        self._write(pending)
+        query = "SELECT tenant, model, requests, input_tokens, output_tokens, cost_micro_usd FROM usage WHERE day = ?"
+        params = [day]
+        if tenant:
+            query += " AND tenant = ?"
+            params.append(tenant)
+        with self._lock:
+            return self._db.execute(query + " ORDER BY cost_micro_usd DESC", params).fetchall()
+
+
+_ledger = None
+
+
+def get_ledger():
+    global _ledger
+    if _ledger is None:
+        _ledger = UsageLedger()
+        atexit.register(_ledger.flush)
+    return _ledger